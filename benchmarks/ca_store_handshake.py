@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Compare cost of verified TLS handshakes with CA certificates given to curl
+as c_rehash'd directory (CAPATH) and as a single preloaded bundle (CAINFO,
+see CertificatePlatforms.buildBundles).
+
+Usage (from repository root, with the package importable):
+
+    PYTHONPATH=src python benchmarks/ca_store_handshake.py \\
+        https://www.eff.org/ platform_certs/default
+
+Each handshake uses a fresh curl handle and connection, like a handshake in
+a new fetcher subprocess. With --reuse-handle one handle is reused per mode,
+like handles kept by CurlHandlePool, and with --multi fresh handles run in
+one CurlMulti like in the multi fetch engine; both let libcurl cache the
+loaded CA store. With --fresh-process every handshake runs in a new
+Python process, so nothing is cached between them.
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+import pycurl
+
+from https_everywhere_checker.http_client import CertificatePlatforms
+
+def handshake(url, caPath=None, caBundle=None, c=None, multi=None):
+	"""Do one verified handshake with URL's server.
+
+	@param c: curl handle to reuse, a fresh one is used if None
+	@param multi: pycurl.CurlMulti to run the handshake in, like
+	MultiFetchEngine does
+	@returns: tuple (seconds spent in perform(), TLS handshake seconds)
+	"""
+	reused = c is not None
+	if not reused:
+		c = pycurl.Curl()
+	else:
+		c.reset()
+	c.setopt(pycurl.URL, url)
+	c.setopt(pycurl.CONNECT_ONLY, 1)
+	c.setopt(pycurl.FRESH_CONNECT, 1)
+	c.setopt(pycurl.FORBID_REUSE, 1)
+	c.setopt(pycurl.CONNECTTIMEOUT, 10)
+	if caBundle:
+		c.setopt(pycurl.CAINFO, caBundle)
+		c.unsetopt(pycurl.CAPATH)
+	else:
+		c.setopt(pycurl.CAPATH, caPath)
+	start = time.time()
+	if multi is None:
+		c.perform()
+	else:
+		multi.add_handle(c)
+		while True:
+			ret, numHandles = multi.perform()
+			if ret != pycurl.E_CALL_MULTI_PERFORM and not numHandles:
+				break
+			multi.select(0.01)
+		(numQueued, okList, errList) = multi.info_read()
+		multi.remove_handle(c)
+		if errList:
+			raise pycurl.error(errList[0][1], errList[0][2])
+	total = time.time() - start
+	tls = c.getinfo(pycurl.APPCONNECT_TIME) - c.getinfo(pycurl.CONNECT_TIME)
+	if not reused:
+		c.close()
+	return (total, tls)
+
+def freshProcessHandshake(url, caPath, caBundle):
+	"""Run handshake() in a new interpreter."""
+	args = [sys.executable, __file__, "--single", url, caPath]
+	if caBundle:
+		args.extend(["--bundle", caBundle])
+	output = subprocess.check_output(args)
+	return tuple(float(x) for x in output.split())
+
+def summary(name, times):
+	times = sorted(times)
+	return "%-8s mean %7.2f ms, median %7.2f ms, max %7.2f ms" % (name,
+		1000 * sum(times) / len(times), 1000 * times[len(times) // 2],
+		1000 * times[-1])
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument("url", help="https URL whose server is verified")
+	parser.add_argument("ca_path", help="c_rehash'd CA directory (platform)")
+	parser.add_argument("-n", type=int, default=50, help="handshakes per mode")
+	parser.add_argument("--fresh-process", action="store_true",
+		help="run every handshake in a new process")
+	parser.add_argument("--reuse-handle", action="store_true",
+		help="reuse one curl handle per mode (new connection every time)")
+	parser.add_argument("--multi", action="store_true",
+		help="run fresh handles through one CurlMulti per mode")
+	parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+	parser.add_argument("--bundle", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.single:
+		print "%f %f" % handshake(args.url, args.ca_path, args.bundle)
+		return
+
+	start = time.time()
+	platforms = CertificatePlatforms(args.ca_path)
+	caBundle = platforms.buildBundles()[args.ca_path]
+	print "Built bundle in %.2f s" % (time.time() - start)
+
+	if args.fresh_process:
+		run = freshProcessHandshake
+	elif args.reuse_handle:
+		#like handles kept by CurlHandlePool
+		run = lambda url, caPath, bundle: handshake(url, caPath, bundle, reusedHandles[bundle])
+		reusedHandles = {None: pycurl.Curl(), caBundle: pycurl.Curl()}
+	elif args.multi:
+		multis = {None: pycurl.CurlMulti(), caBundle: pycurl.CurlMulti()}
+		run = lambda url, caPath, bundle: handshake(url, caPath, bundle, multi=multis[bundle])
+	else:
+		run = handshake
+	#warm up DNS and server
+	handshake(args.url, args.ca_path)
+
+	for (name, bundle) in (("CAPATH", None), ("CAINFO", caBundle)):
+		results = [run(args.url, args.ca_path, bundle) for i in range(args.n)]
+		print summary(name, [total for (total, tls) in results]), "(perform)"
+		print summary(name, [tls for (total, tls) in results]), "(TLS handshake)"
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Measure memory held by loaded rulesets and the rule trie.
+
+Usage (from repository root, with the package importable):
+
+    PYTHONPATH=src python benchmarks/ruleset_memory.py \\
+        /path/to/https-everywhere/src/chrome/content/rules
+
+Rulesets are loaded by RulesetLoader like in check_rules. With --processes
+above 1 they are parsed in worker processes and rebuilt from descriptions
+(like from the ruleset cache), so their regexes are not compiled.
+
+Reports deep size of the objects (each object counted once, strings shared
+between rulesets included once) per ruleset, per target in the rule trie
+index and per node of the DomainNode tree built for graphviz dumps, and
+growth of the process RSS.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import types
+
+from https_everywhere_checker.check_rules import RulesetLoader
+from https_everywhere_checker.rule_trie import RuleTrie
+from https_everywhere_checker.rules import Ruleset
+
+#objects not owned by the model
+_skipTypes = (type, types.ModuleType, types.FunctionType, types.MethodType,
+	types.BuiltinFunctionType)
+
+def rssBytes():
+	"""Resident set size of this process."""
+	with open("/proc/self/statm") as f:
+		return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def deepSize(roots, stopTypes=()):
+	"""Sum of sys.getsizeof over all objects reachable from roots through
+	containers, instance dicts and slots. Each object is counted once.
+
+	@param stopTypes: instances of these types are neither counted nor
+	descended into
+	@returns: tuple (bytes, dict type name -> number of objects)
+	"""
+	seen = set()
+	counts = {}
+	total = 0
+	stack = list(roots)
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen or isinstance(obj, _skipTypes) or isinstance(obj, stopTypes):
+			continue
+		seen.add(id(obj))
+		total += sys.getsizeof(obj)
+		typeName = type(obj).__name__
+		counts[typeName] = counts.get(typeName, 0) + 1
+
+		if isinstance(obj, dict):
+			stack.extend(obj.iterkeys())
+			stack.extend(obj.itervalues())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			stack.extend(obj)
+		if hasattr(obj, "__dict__") and not isinstance(obj, dict):
+			stack.append(obj.__dict__)
+		for cls in type(obj).__mro__:
+			for slot in getattr(cls, "__slots__", ()):
+				if hasattr(obj, slot):
+					stack.append(getattr(obj, slot))
+	return (total, counts)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument("rules_dir", help="directory with XML ruleset files")
+	parser.add_argument("--processes", type=int, default=1,
+		help="loader worker processes (load_processes)")
+	parser.add_argument("--types", action="store_true",
+		help="print number of objects per type")
+	args = parser.parse_args()
+
+	xmlFnames = sorted(glob.glob(os.path.join(args.rules_dir, "*.xml")))
+	loader = RulesetLoader(True, False, args.processes)
+	rssBefore = rssBytes()
+	trie = RuleTrie()
+	rulesets = loader.loadInto(xmlFnames, trie)
+	rssAfter = rssBytes()
+	loader.close()
+
+	(rulesetBytes, rulesetCounts) = deepSize(rulesets)
+	(indexBytes, indexCounts) = deepSize([trie.exactTargets, trie.wildcardTargets], (Ruleset,))
+	targets = sum(len(ruleset.targets) for ruleset in rulesets)
+	(treeBytes, treeCounts) = deepSize([trie.root], (Ruleset,))
+	nodes = treeCounts.get("DomainNode", 0)
+
+	print "rulesets: %d, targets: %d, tree nodes: %d" % (len(rulesets), targets, nodes)
+	print "rulesets: %d bytes, %.0f bytes per ruleset" % (
+		rulesetBytes, float(rulesetBytes) / max(1, len(rulesets)))
+	print "trie index: %d bytes, %.0f bytes per target" % (
+		indexBytes, float(indexBytes) / max(1, targets))
+	print "tree: %d bytes, %.0f bytes per node" % (treeBytes, float(treeBytes) / max(1, nodes))
+	print "RSS growth: %.1f MB, %.0f bytes per ruleset" % (
+		(rssAfter - rssBefore) / (1024.0 * 1024), float(rssAfter - rssBefore) / max(1, len(rulesets)))
+	if args.types:
+		for (what, counts) in (("rulesets", rulesetCounts), ("trie index", indexCounts),
+				("tree", treeCounts)):
+			print "%s objects:" % what
+			for (typeName, count) in sorted(counts.items(), key=lambda item: -item[1]):
+				print "  %-20s %d" % (typeName, count)
+
+if __name__ == "__main__":
+	main()
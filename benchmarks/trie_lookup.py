@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Measure rule trie lookups per second, flat index vs. tree walk.
+
+Usage (from repository root, with the package importable):
+
+    PYTHONPATH=src python benchmarks/trie_lookup.py \\
+        /path/to/https-everywhere/src/chrome/content/rules
+
+Queries are derived from the targets of the loaded rulesets: every target
+with wildcards filled in (left-most wildcards also with two labels), one
+subdomain below every target and one miss per target, in shuffled order.
+Before timing, results of RuleTrie.matchingRulesets (flat index) are checked
+against DomainNode.matchingRulesets (recursive tree walk) for every query.
+"""
+
+import argparse
+import glob
+import os
+import random
+import time
+
+from https_everywhere_checker.check_rules import RulesetLoader
+from https_everywhere_checker.rule_trie import RuleTrie
+
+def targetQueries(rulesets):
+	"""Return list of FQDNs to look up."""
+	queries = []
+	for ruleset in rulesets:
+		for target in ruleset.targets:
+			queries.append(target.replace("*", "x"))
+			if target.startswith("*."):
+				queries.append("a.b" + target[1:])
+			queries.append("sub." + target.replace("*", "x"))
+			queries.append("miss-" + target.replace("*", "x") + ".invalid")
+	return queries
+
+def lookupResult(lookup, fqdn):
+	"""Result of lookup comparable between implementations."""
+	try:
+		return frozenset(lookup(fqdn))
+	except Exception, e:
+		return type(e)
+
+def rate(lookup, queries, repeat):
+	"""Return lookups per second."""
+	start = time.time()
+	for i in range(repeat):
+		for fqdn in queries:
+			lookup(fqdn)
+	return len(queries) * repeat / (time.time() - start)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument("rules_dir", help="directory with XML ruleset files")
+	parser.add_argument("-r", "--repeat", type=int, default=3,
+		help="passes over all queries per implementation")
+	args = parser.parse_args()
+
+	xmlFnames = sorted(glob.glob(os.path.join(args.rules_dir, "*.xml")))
+	trie = RuleTrie()
+	rulesets = RulesetLoader(True, False).loadInto(xmlFnames, trie)
+	queries = targetQueries(rulesets)
+	random.Random(0).shuffle(queries)
+	root = trie.root
+
+	mismatches = 0
+	for fqdn in queries:
+		if lookupResult(trie.matchingRulesets, fqdn) != lookupResult(root.matchingRulesets, fqdn):
+			mismatches += 1
+			print "MISMATCH %s" % fqdn
+	print "rulesets: %d, queries: %d, mismatches: %d" % (len(rulesets), len(queries), mismatches)
+
+	indexRate = rate(trie.matchingRulesets, queries, args.repeat)
+	treeRate = rate(root.matchingRulesets, queries, args.repeat)
+	print "flat index: %.0f lookups/s" % indexRate
+	print "tree walk:  %.0f lookups/s" % treeRate
+	print "speedup:    %.1fx" % (indexRate / treeRate)
+
+if __name__ == "__main__":
+	main()
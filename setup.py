@@ -27,6 +27,9 @@ setup(
         "python-levenshtein>=0.10.2",
         "regex>=0.1.20120613",
     ],
+    extras_require={
+        "offline-verify": ["pyOpenSSL>=20.0"],
+    },
     license="GPL3",
     keywords='https https-everywhere http security',
     entry_points={
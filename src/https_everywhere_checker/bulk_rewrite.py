@@ -0,0 +1,195 @@
+import collections
+import json
+import logging
+import multiprocessing
+import sys
+import time
+
+from rules import compiledPatterns
+
+## Bulk URL rewriting
+#
+# Pushes URL lists of access-log size through the rules without fetching
+# anything. URLs are read one line at a time and handed out in batches, so
+# memory use doesn't depend on the length of the list. Within a batch, URLs
+# are grouped by host and the rule trie is asked for the rulesets of each
+# host once; only the rulesets' rules run per URL.
+#
+# With more than one process, batches are rewritten in a process pool
+# forked after the rule trie was built, so workers share the loaded
+# rulesets instead of parsing them again. At most two batches per worker are
+# in flight and results are written in input order.
+#
+# Output is JSON Lines, one object per input URL:
+#   {"url": ..., "rewritten": URL or null, "ruleset": file name or null}
+# or {"url": ..., "error": message} if the URL couldn't be rewritten.
+
+#RuleTrie used by rewriteBatch(), workers inherit it on fork
+_trie = None
+
+#batches in flight per worker process
+_pendingPerProcess = 2
+
+#log progress every this many URLs
+_progressInterval = 1000000
+
+def rewriteBatch(urls):
+	"""Rewrite URLs with the rules of _trie, rulesets are looked up once
+	per host.
+
+	@param urls: list of URL strings
+	@returns: tuple (JSON Lines text in order of urls, number of URLs,
+	number rewritten, number of errors)
+	"""
+	records = [None] * len(urls)
+	byHost = collections.defaultdict(list)
+	for (index, url) in enumerate(urls):
+		try:
+			#JSON output needs UTF-8
+			url.decode("utf-8")
+			byHost[_trie.urlHost(url)].append(index)
+		except UnicodeDecodeError:
+			records[index] = {"url": url.decode("latin-1"), "error": "URL is not UTF-8"}
+		except Exception, e:
+			#RuleTransformError, ValueError of urlparse on e.g. "http://[::1"
+			records[index] = {"url": url, "error": str(e)}
+
+	rewritten = 0
+	for (host, indexes) in byHost.iteritems():
+		try:
+			rulesets = _trie.matchingRulesets(host)
+		except Exception, e:
+			for index in indexes:
+				records[index] = {"url": urls[index], "error": "Host lookup failed: %s" % e}
+			continue
+		for index in indexes:
+			url = urls[index]
+			try:
+				ruleMatch = _trie.applyRulesets(url, rulesets)
+			except Exception, e:
+				records[index] = {"url": url, "error": str(e)}
+				continue
+			if ruleMatch.ruleset is None:
+				records[index] = {"url": url, "rewritten": None, "ruleset": None}
+			else:
+				records[index] = {"url": url, "rewritten": ruleMatch.url,
+					"ruleset": ruleMatch.ruleset.filename}
+				rewritten += 1
+
+	errors = sum(1 for record in records if "error" in record)
+	text = "".join(json.dumps(record) + "\n" for record in records)
+	return (text, len(urls), rewritten, errors)
+
+def _rewriteBatchWorker(urls):
+	"""rewriteBatch() for worker processes, compiledPatterns.countersSince()
+	of the batch is appended to the result for the parent's statistics.
+	"""
+	before = compiledPatterns.counters()
+	result = rewriteBatch(urls)
+	return result + (compiledPatterns.countersSince(before),)
+
+def readBatches(urlFile, batchSize):
+	"""Yield lists of at most batchSize URLs read line by line from
+	urlFile, blank lines are skipped.
+	"""
+	batch = []
+	for line in urlFile:
+		url = line.strip()
+		if not url:
+			continue
+		batch.append(url)
+		if len(batch) >= batchSize:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+def _poolResults(pool, batches, maxPending):
+	"""Like pool.imap(rewriteBatch, batches), but reads the next batch
+	only when fewer than maxPending are in flight. Regex compiles of the
+	workers are added to compiledPatterns.
+	"""
+	pending = collections.deque()
+	for batch in batches:
+		pending.append(pool.apply_async(_rewriteBatchWorker, (batch,)))
+		if len(pending) >= maxPending:
+			yield _workerResult(pending.popleft().get())
+	while pending:
+		yield _workerResult(pending.popleft().get())
+
+def _workerResult(result):
+	"""Return rewriteBatch() part of _rewriteBatchWorker() result, add its
+	regex compiles to compiledPatterns.
+	"""
+	compiledPatterns.addWorkerCounters(result[-1])
+	return result[:-1]
+
+def rewriteUrls(trie, urlFile, outFile, processes=1, batchSize=10000):
+	"""Rewrite all URLs from urlFile and write JSON Lines to outFile.
+
+	@param trie: RuleTrie with all rulesets loaded. Should be called
+	before any threads are started when processes > 1.
+	@param urlFile: file object with one URL per line
+	@param outFile: file object for JSON Lines output
+	@param processes: number of worker processes, 1 rewrites in this
+	process
+	@param batchSize: number of URLs in one batch
+	@returns: tuple (number of URLs, number rewritten, number of errors)
+	"""
+	global _trie
+	_trie = trie
+	pool = None
+	if processes > 1:
+		pool = multiprocessing.Pool(processes)
+
+	startTime = time.time()
+	total = rewritten = errors = 0
+	nextProgress = _progressInterval
+	batches = readBatches(urlFile, batchSize)
+	try:
+		if pool:
+			results = _poolResults(pool, batches, _pendingPerProcess * processes)
+		else:
+			results = (rewriteBatch(batch) for batch in batches)
+		for (text, count, batchRewritten, batchErrors) in results:
+			outFile.write(text)
+			total += count
+			rewritten += batchRewritten
+			errors += batchErrors
+			if total >= nextProgress:
+				logging.info("Rewrote %d URLs, %.0f URLs/s.", total,
+					total / max(time.time() - startTime, 1e-6))
+				nextProgress += _progressInterval
+		outFile.flush()
+	finally:
+		if pool:
+			pool.terminate()
+			pool.join()
+
+	elapsed = time.time() - startTime
+	logging.info("Bulk rewrite: %d URLs, %d rewritten, %d errors in %.2f seconds, %.0f URLs/s.",
+		total, rewritten, errors, elapsed, total / max(elapsed, 1e-6))
+	return (total, rewritten, errors)
+
+def rewriteFromConfig(config, trie, urlPath, outPath):
+	"""Run rewriteUrls() with options from [rewrite] section of config.
+
+	@param urlPath: file with URLs, "-" for stdin
+	@param outPath: JSON Lines output file, "-" for stdout
+	"""
+	processes = multiprocessing.cpu_count()
+	if config.has_option("rewrite", "processes"):
+		processes = config.getint("rewrite", "processes")
+	batchSize = 10000
+	if config.has_option("rewrite", "batch_size"):
+		batchSize = config.getint("rewrite", "batch_size")
+
+	urlFile = sys.stdin if urlPath == "-" else open(urlPath, "rb")
+	outFile = sys.stdout if outPath == "-" else open(outPath, "wb")
+	try:
+		return rewriteUrls(trie, urlFile, outFile, processes, batchSize)
+	finally:
+		if urlFile is not sys.stdin:
+			urlFile.close()
+		if outFile is not sys.stdout:
+			outFile.close()
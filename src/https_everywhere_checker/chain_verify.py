@@ -0,0 +1,175 @@
+import glob
+import hashlib
+import logging
+import os
+import re
+import threading
+
+try:
+	from OpenSSL import crypto
+	from cryptography import x509
+except ImportError:
+	crypto = None
+
+## Offline chain verification
+#
+# Checking a host against several trust stores with curl means one
+# handshake per platform. Instead, the chain the server presented is
+# captured once (curl CERTINFO) and verified here against the trust anchors
+# of every platform in CertificatePlatforms, held in memory as X509Stores.
+# Chain validity is cached per (chain fingerprint, CA path), so hosts behind
+# the same certificate (CDNs, shared hosting) are verified only once per
+# platform. The host name is checked against the leaf for every host.
+#
+# Needs pyOpenSSL (>= 20.0 for untrusted intermediates); without it the
+# callers fall back to verifying in curl against a single platform.
+
+_pemRe = re.compile(r"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----", re.S)
+
+def available():
+	"""True iff pyOpenSSL needed for offline verification is installed."""
+	return crypto is not None
+
+def certInfoChain(certInfo):
+	"""Extract PEM certificates from curl's INFO_CERTINFO.
+
+	@param certInfo: list (one item per certificate, leaf first) of lists
+	of (name, value) tuples
+	@returns: list of PEM strings, leaf first
+	"""
+	pems = []
+	for fields in certInfo:
+		for (name, value) in fields:
+			if name == "Cert":
+				pems.append(value)
+	return pems
+
+def hostnameMatches(host, cert):
+	"""Check host against DNS/IP subject alternative names of cert, or its
+	common name if there are none. Wildcards match one left-most label.
+
+	@param cert: OpenSSL.crypto.X509 leaf certificate
+	"""
+	host = host.lower().rstrip(".")
+	names = []
+	try:
+		san = cert.to_cryptography().extensions.get_extension_for_class(
+			x509.SubjectAlternativeName).value
+		names = [name.lower() for name in san.get_values_for_type(x509.DNSName)]
+		names.extend(str(ip) for ip in san.get_values_for_type(x509.IPAddress))
+	except x509.ExtensionNotFound:
+		commonName = cert.get_subject().commonName
+		if commonName:
+			names = [commonName.lower()]
+
+	for name in names:
+		if name == host:
+			return True
+		if name.startswith("*.") and "." in host:
+			if host.split(".", 1)[1] == name[2:]:
+				return True
+	return False
+
+class ChainVerifier(object):
+	"""Verifies captured certificate chains against CA platforms in
+	memory, caching results per (chain fingerprint, CA path).
+	"""
+
+	def __init__(self, certPlatforms):
+		"""
+		@param certPlatforms: CertificatePlatforms whose CA directories
+		are the trust stores
+		"""
+		self.certPlatforms = certPlatforms
+		self.stores = {} #CA path -> crypto.X509Store
+		self.results = {} #(fingerprint, CA path) -> error string or None
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def _store(self, caPath):
+		"""Return X509Store with all certificates from c_rehash'd
+		directory, must be called with lock held.
+		"""
+		store = self.stores.get(caPath)
+		if store is not None:
+			return store
+
+		store = crypto.X509Store()
+		loaded = set()
+		for fname in sorted(glob.glob(os.path.join(caPath, "*"))):
+			if not os.path.isfile(fname):
+				continue
+			with open(fname) as f:
+				pemData = f.read()
+			for pem in _pemRe.findall(pemData):
+				#hashed symlinks point to the same certificates
+				digest = hashlib.sha256(pem).digest()
+				if digest in loaded:
+					continue
+				loaded.add(digest)
+				try:
+					store.add_cert(crypto.load_certificate(crypto.FILETYPE_PEM, pem))
+				except crypto.Error, e:
+					logging.debug("Skipping unparseable certificate in %s: %s", fname, e)
+		logging.debug("Loaded %d trust anchors from %s", len(loaded), caPath)
+		self.stores[caPath] = store
+		return store
+
+	def verify(self, host, pems, caPath):
+		"""Verify chain presented by host against trust anchors in caPath.
+
+		@param pems: list of PEM certificates, leaf first
+		@returns: None if valid, otherwise error string
+		"""
+		if not pems:
+			return "Server presented no certificate"
+		fingerprint = hashlib.sha256("".join(pems)).hexdigest()
+		key = (fingerprint, caPath)
+
+		with self.lock:
+			if key in self.results:
+				self.hits += 1
+				error = self.results[key]
+			else:
+				self.misses += 1
+				error = self._verifyChain(pems, caPath)
+				self.results[key] = error
+
+		if error:
+			return error
+		leaf = crypto.load_certificate(crypto.FILETYPE_PEM, pems[0])
+		if not hostnameMatches(host, leaf):
+			return "Certificate does not match host name %s" % host
+		return None
+
+	def _verifyChain(self, pems, caPath):
+		"""Verify chain ignoring host name, must be called with lock held."""
+		try:
+			certs = [crypto.load_certificate(crypto.FILETYPE_PEM, pem) for pem in pems]
+		except crypto.Error, e:
+			return "Unparseable certificate in chain: %s" % e
+		context = crypto.X509StoreContext(self._store(caPath), certs[0], certs[1:])
+		try:
+			context.verify_certificate()
+		except crypto.X509StoreContextError, e:
+			#message is [errno, depth, reason string]
+			return "Certificate verification failed: %s" % e.args[0][2]
+		return None
+
+	def verifyAll(self, host, pems, platformPaths=None):
+		"""Verify chain against every platform.
+
+		@param platformPaths: dict platform name -> CA path, defaults to
+		all platforms of certPlatforms
+		@returns: dict platform name -> None if valid or error string
+		"""
+		if platformPaths is None:
+			platformPaths = self.certPlatforms.platformPaths
+		return dict((platform, self.verify(host, pems, caPath))
+			for (platform, caPath) in platformPaths.items())
+
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		return "%d chain verifications, %d served from cache" % (
+			self.misses, self.hits)
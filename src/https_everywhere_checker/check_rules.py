@@ -6,21 +6,34 @@ import argparse
 import json
 import glob
 import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
 import Queue
 import re
 import sys
 import threading
 import time
+import urlparse
 
 from ConfigParser import SafeConfigParser
+from multiprocessing.pool import ThreadPool
 
 from lxml import etree
 
+import bulk_rewrite
+import dns_cache
 import http_client
 import metrics
-from rules import Ruleset
+import multi_fetch
+import politeness
+import regex_preflight
+import response_cache
+import ruleset_cache
+import tls_scan
+from rules import Ruleset, compiledPatterns
+from ruleset_cache import ParsedRuleset
 from rule_trie import RuleTrie
 
 def convertLoglevel(levelString):
@@ -61,21 +74,128 @@ class ComparisonTask(object):
 		self.fetcherRewriting = fetcherRewriting
 		self.ruleset = ruleset
 		self.ruleFname = ruleset.filename
+		#URLs are scheduled one by one, results are put back together here
+		self.results = [None] * len(urls)
+		self.remaining = len(urls)
+		self.lock = threading.Lock()
+	
+	def recordResult(self, index, problem):
+		"""Record result of comparing URL at given index.
+		
+		@param problem: problem message or None on success
+		@returns: True iff this was the last outstanding URL of the task
+		"""
+		with self.lock:
+			self.results[index] = problem
+			self.remaining -= 1
+			return self.remaining == 0
+	
+	def problems(self):
+		"""Problems recorded via recordResult, in order of URLs."""
+		return [problem for problem in self.results if problem]
+	
+	def pairs(self):
+		"""Split task into UrlPair units of work."""
+		return [UrlPair(self, index, url) for (index, url) in enumerate(self.urls)]
+	
+class UrlPair(object):
+	"""Plain and rewritten URL of one test of a ComparisonTask together with
+	results of fetching them.
+	"""
+	
+	def __init__(self, task, index, plainUrl):
+		"""
+		@param task: ComparisonTask the URL belongs to
+		@param index: index of the URL in task.urls
+		@param plainUrl: URL to be rewritten by task's ruleset
+		"""
+		self.task = task
+		self.index = index
+		self.plainUrl = plainUrl
+		self.transformedUrl = None
+		self.regexError = None
+		#(httpResponseCode, htmlData) tuples or exceptions from fetchHtml
+		self.transformed = None
+		self.transformedError = None
+		self.plain = (None, None)
+		self.plainError = None
+		self.pending = None
+	
+	def reset(self):
+		"""Forget fetch results so the pair can be queued again."""
+		self.transformed = None
+		self.transformedError = None
+		self.plain = (None, None)
+		self.plainError = None
+	
+	def needsCompleteTrie(self):
+		"""True iff a redirect couldn't be followed because the rule trie
+		was still being built, the pair has to be fetched again.
+		"""
+		return isinstance(self.transformedError, http_client.TrieIncompleteError) or \
+			isinstance(self.plainError, http_client.TrieIncompleteError)
+	
+	def rewrite(self):
+		"""Apply ruleset of the task on plain URL.
+		
+		@returns: False if the ruleset failed to apply
+		"""
+		try:
+			self.transformedUrl = self.task.ruleset.apply(self.plainUrl)
+		except Exception, e:
+			self.regexError = e
+			return False
+		return True
+	
+	def startFetches(self, fetchPool):
+		"""Start fetching rewritten and plain URL concurrently.
+		
+		@param fetchPool: multiprocessing.pool.ThreadPool to fetch in
+		"""
+		logging.debug("Fetching transformed page %s", self.transformedUrl)
+		transformedAsync = fetchPool.apply_async(self.task.fetcherRewriting.fetchHtml,
+			(self.transformedUrl,))
+		logging.debug("Fetching plain page %s", self.plainUrl)
+		plainAsync = fetchPool.apply_async(self.task.fetcherPlain.fetchHtml,
+			(self.plainUrl,))
+		self.pending = (transformedAsync, plainAsync)
+	
+	def waitFetches(self):
+		"""Wait for fetches started by startFetches and record results."""
+		(transformedAsync, plainAsync) = self.pending
+		self.pending = None
+		try:
+			self.transformed = transformedAsync.get()
+		except Exception, e:
+			self.transformedError = e
+		try:
+			self.plain = plainAsync.get()
+		except Exception, e:
+			self.plainError = e
 	
 class UrlComparisonThread(threading.Thread):
-	"""Thread worker for comparing plain and rewritten URLs.
+	"""Thread worker for comparing plain and rewritten URLs. Takes one
+	UrlPair at a time, so URLs of big rulesets are spread over all threads.
+	Problems of a ruleset are reported once all of its URLs were compared.
 	"""
 	
-	def __init__(self, taskQueue, metric, thresholdDistance, autoDisable, resQueue):
+	def __init__(self, taskQueue, metric, thresholdDistance, autoDisable, resQueue, fetchPool=None,
+			deferredQueue=None):
 		"""
 		Comparison thread running HTTP/HTTPS scans.
 		
-		@param taskQueue: Queue.Queue filled with ComparisonTask objects
+		@param taskQueue: Queue.Queue filled with UrlPair objects
 		@param metric: metric.Metric instance
 		@param threshold: min distance that is reported as "too big"
 		@param resQueue: Result Queue, results are added there
+		@param fetchPool: multiprocessing.pool.ThreadPool in which plain
+		and rewritten URL of a pair are fetched concurrently
+		@param deferredQueue: Queue.Queue for pairs that have to be
+		fetched again once the rule trie is complete
 		"""
 		self.taskQueue = taskQueue
+		self.fetchPool = fetchPool
+		self.deferredQueue = deferredQueue
 		self.resQueue = resQueue
 		self.metric = metric
 		self.thresholdDistance = thresholdDistance
@@ -85,17 +205,36 @@ class UrlComparisonThread(threading.Thread):
 	def run(self):
 		while True:
 			try:
-				self.processTask(self.taskQueue.get())
+				self.processPair(self.taskQueue.get())
 				self.taskQueue.task_done()
 			except Exception, e:
 				logging.exception(e)
 
-	def processTask(self, task):
-		problems = []
-		for url in task.urls:
-			result = self.processUrl(url, task)
-			if result:
-				problems.append(result)
+	def processPair(self, pair):
+		if pair.rewrite():
+			logging.debug("=**= Start %s => %s ****", pair.plainUrl, pair.transformedUrl)
+			pair.startFetches(self.fetchPool)
+			pair.waitFetches()
+		self.finishPair(pair)
+
+	def finishPair(self, pair):
+		"""Compare fetched pair and record result in its task. Report
+		problems of the task if this was its last pair.
+		"""
+		task = pair.task
+		if pair.needsCompleteTrie():
+			logging.debug("Deferring %s until rule trie is complete", pair.plainUrl)
+			pair.reset()
+			self.deferredQueue.put(pair)
+			return
+		problem = self.compareUrlPair(pair)
+		if task.recordResult(pair.index, problem):
+			self.reportProblems(task, task.problems())
+
+	def reportProblems(self, task, problems):
+		"""Log problems found in a task's ruleset and disable it if
+		configured to do so.
+		"""
 		if problems:
 			for problem in problems:
 				logging.error("%s: %s" % (task.ruleFname, problem))
@@ -121,31 +260,33 @@ class UrlComparisonThread(threading.Thread):
 			res["https_url"] = https_url
 		self.resQueue.put(res)
 
-	def processUrl(self, plainUrl, task):
-		try:
-			transformedUrl = task.ruleset.apply(plainUrl)
-		except Exception, e:
+	def compareUrlPair(self, pair):
+		"""Compare fetched plain and rewritten page and queue the result.
+		
+		@param pair: UrlPair with fetch results filled in
+		@returns: problem message or None if there is no problem
+		"""
+		task = pair.task
+		plainUrl = pair.plainUrl
+		transformedUrl = pair.transformedUrl
+		ruleFname = task.ruleFname
+		
+		if pair.regexError is not None:
+			e = pair.regexError
 			self.queue_result("regex_error", str(e), task.ruleFname, plainUrl)
 			logging.error("%s: Regex Error %s" % (task.ruleFname, str(e)))
 			return
 
-		fetcherPlain = task.fetcherPlain
-		fetcherRewriting = task.fetcherRewriting
-		ruleFname = task.ruleFname
-		
 		try:
-			logging.debug("=**= Start %s => %s ****", plainUrl, transformedUrl)
-			logging.debug("Fetching transformed page %s", transformedUrl)
-			transformedRcode, transformedPage = fetcherRewriting.fetchHtml(transformedUrl)
-			logging.debug("Fetching plain page %s", plainUrl)
+			if pair.transformedError is not None:
+				raise pair.transformedError
+			transformedRcode, transformedPage = pair.transformed
 			# If we get an exception (e.g. connection refused,
 			# connection timeout) on the plain page, don't treat
 			# that as a failure.
-			plainRcode, plainPage = None, None
-			try:
-				plainRcode, plainPage = fetcherPlain.fetchHtml(plainUrl)
-			except Exception, e:
-				logging.debug("Non-fatal fetch error for plain page %s: %s" % (plainUrl, e))
+			if pair.plainError is not None:
+				logging.debug("Non-fatal fetch error for plain page %s: %s" % (plainUrl, pair.plainError))
+			plainRcode, plainPage = pair.plain
 
 			# Compare HTTP return codes - if original page returned 2xx,
 			# but the transformed didn't, consider it an error in ruleset
@@ -184,9 +325,95 @@ class UrlComparisonThread(threading.Thread):
 			logging.info("Finished comparing %s -> %s. Rulefile: %s.",
 				plainUrl, transformedUrl, ruleFname)
 
+class PairComparisonThread(UrlComparisonThread):
+	"""Thread worker comparing UrlPairs fetched by MultiComparisonFeeder.
+	A pair is marked done in task queue once it was compared.
+	"""
+	
+	def __init__(self, taskQueue, pairQueue, metric, thresholdDistance, autoDisable, resQueue,
+			deferredQueue=None):
+		"""
+		@param pairQueue: Queue.Queue filled with fetched UrlPair objects
+		@see UrlComparisonThread.__init__ for other parameters
+		"""
+		self.pairQueue = pairQueue
+		UrlComparisonThread.__init__(self, taskQueue, metric, thresholdDistance, autoDisable, resQueue,
+			deferredQueue=deferredQueue)
+	
+	def run(self):
+		while True:
+			try:
+				self.finishPair(self.pairQueue.get())
+				self.taskQueue.task_done()
+			except Exception, e:
+				logging.exception(e)
+
+class MultiComparisonFeeder(threading.Thread):
+	"""Takes UrlPairs from task queue and fetches them via
+	multi_fetch.MultiFetchEngine. Fetched pairs are put on pair queue for
+	PairComparisonThreads.
+	"""
+	
+	def __init__(self, taskQueue, pairQueue, engine):
+		"""
+		@param taskQueue: Queue.Queue filled with UrlPair objects
+		@param pairQueue: Queue.Queue where fetched UrlPairs are put
+		@param engine: running multi_fetch.MultiFetchEngine
+		"""
+		self.taskQueue = taskQueue
+		self.pairQueue = pairQueue
+		self.engine = engine
+		threading.Thread.__init__(self)
+	
+	def run(self):
+		while True:
+			try:
+				self.submitPair(self.taskQueue.get())
+			except Exception, e:
+				logging.exception(e)
+	
+	def submitPair(self, pair):
+		if not pair.rewrite():
+			self.pairQueue.put(pair)
+			return
+		
+		logging.debug("=**= Start %s => %s ****", pair.plainUrl, pair.transformedUrl)
+		self.fetchPair(pair)
+	
+	def fetchPair(self, pair):
+		"""Fetch rewritten and plain URL concurrently, pair is queued
+		for comparison once both are done.
+		"""
+		#callbacks are called from the engine thread only, no locking
+		remaining = [2]
+		
+		def fetched():
+			remaining[0] -= 1
+			if not remaining[0]:
+				self.pairQueue.put(pair)
+		
+		def transformedDone(result, error):
+			pair.transformed = result
+			pair.transformedError = error
+			fetched()
+		
+		def plainDone(result, error):
+			if error is not None:
+				pair.plainError = error
+			else:
+				pair.plain = result
+			fetched()
+		
+		logging.debug("Fetching transformed page %s", pair.transformedUrl)
+		self.engine.fetchHtmlAsync(pair.task.fetcherRewriting, pair.transformedUrl, transformedDone)
+		logging.debug("Fetching plain page %s", pair.plainUrl)
+		self.engine.fetchHtmlAsync(pair.task.fetcherPlain, pair.plainUrl, plainDone)
+
 def disableRuleset(ruleset, problems):
 	logging.info("Disabling ruleset %s", ruleset.filename)
-	contents = open(ruleset.filename).read()
+	contents = ruleset.contents
+	if contents is None:
+		contents = open(ruleset.filename).read()
 	# Don't bother to disable rulesets that are already disabled
 	if re.search("\bdefault_off=", contents):
 		return
@@ -214,13 +441,300 @@ Disabled by https-everywhere-checker because:
 # before the coverage tests were required, but also require coverage
 # improvements when updating the rules.
 skipdict = {}
-def skipFile(filename):
+def contentDigest(contents):
+	"""Binary SHA-256 of file contents, as used in skipdict."""
 	hasher = hashlib.new('sha256')
-	hasher.update(open(filename).read())
-	if hasher.digest() in skipdict:
-		return True
+	hasher.update(contents)
+	return hasher.digest()
+
+def parseRulesetFile(xmlFname, contents, digest, checkCoverage, regexBudget=0):
+	"""Parse ruleset file, run regex preflight and check its coverage.
+	Nothing is logged, so that it can run in a worker process.
+	
+	@param contents: contents of the file
+	@param digest: contentDigest() of contents
+	@param regexBudget: seconds each backtracking-prone pattern may take
+	on preflight probes, 0 to skip the preflight
+	@returns: tuple (ruleset_cache.ParsedRuleset, Ruleset); Ruleset is
+	None if the file is broken
+	"""
+	try:
+		ruleset = Ruleset(etree.fromstring(contents), xmlFname)
+		ruleset.compilePatterns()
+	except Exception, e:
+		return (ParsedRuleset(xmlFname, digest, error="%s" % e), None)
+	regexRisks = None
+	if regexBudget:
+		regexRisks = regex_preflight.checkRuleset(ruleset, regexBudget)
+	problems = None
+	if checkCoverage:
+		#coverage is checked by running the patterns on test URLs
+		if any(error for (pattern, error) in regexRisks or ()):
+			problems = []
+		else:
+			problems = ruleset.getCoverageProblems()
+	return (ParsedRuleset(xmlFname, digest, ruleset.describe(), problems=problems,
+		regexRisks=regexRisks, regexBudget=regexBudget), ruleset)
+
+def _parseRulesetWorker(args):
+	"""parseRulesetFile() for worker processes, only the picklable
+	ParsedRuleset is returned since Ruleset objects with compiled regexes
+	are expensive to pickle.
+	
+	@param args: tuple of parseRulesetFile() arguments
+	@returns: tuple (ParsedRuleset, compiledPatterns.countersSince() of
+	the parse)
+	"""
+	before = compiledPatterns.counters()
+	parsed = parseRulesetFile(*args)[0]
+	return (parsed, compiledPatterns.countersSince(before))
+
+class RulesetLoader(object):
+	"""Loads ruleset files, logs problems found in them. With more than one
+	process, files are parsed and their regexes validated in a process pool
+	and the parent only rebuilds Ruleset objects from descriptions.
+	Unchanged files are taken from the RulesetCache if there is one.
+	"""
+	
+	def __init__(self, includeDefaultOff, checkCoverage, processes=1, cache=None,
+			keepContents=False, regexBudget=0):
+		"""
+		@param includeDefaultOff: load rulesets with default_off too
+		@param checkCoverage: log coverage problems of loaded rulesets
+		@param processes: number of worker processes parsing ruleset
+		files, 1 to parse in this process. The pool is forked here, so
+		the loader should be created before other threads are started.
+		@param cache: ruleset_cache.RulesetCache or None
+		@param keepContents: keep file contents in Ruleset.contents for
+		rewriting the file in disableRuleset()
+		@param regexBudget: seconds each backtracking-prone pattern may
+		take on regex_preflight probes, 0 turns the preflight off
+		"""
+		self.includeDefaultOff = includeDefaultOff
+		self.checkCoverage = checkCoverage
+		self.cache = cache
+		self.keepContents = keepContents
+		self.regexBudget = regexBudget
+		self.coverageProblemsExist = False
+		#coverage problems of the last checked ruleset
+		self.problems = []
+		#number of backtracking-prone patterns found by preflight
+		self.regexRiskCount = 0
+		#(filename, message) of patterns over the time budget
+		self.regexErrors = []
+		self.pool = None
+		if processes > 1:
+			self.pool = multiprocessing.Pool(processes)
+	
+	def _accept(self, parsed, contents, ruleset=None):
+		"""Log outcome of parsing a file, apply default_off and record
+		coverage problems.
+		
+		@param parsed: ruleset_cache.ParsedRuleset
+		@param contents: contents of the file
+		@param ruleset: Ruleset parsed in this process, otherwise it's
+		rebuilt from parsed.description
+		@returns: Ruleset or None if the file is broken or skipped
+		"""
+		xmlFname = parsed.filename
+		if parsed.error is not None:
+			logging.error("Exception parsing %s: %s" % (xmlFname, parsed.error))
+			return None
+		if ruleset is None:
+			ruleset = Ruleset.fromDescription(parsed.description)
+		if ruleset.defaultOff and not self.includeDefaultOff:
+			logging.debug("Skipping rule '%s', reason: %s", ruleset.name, ruleset.defaultOff)
+			return None
+		# Rulesets with patterns over the time budget are never evaluated.
+		if parsed.regexRisks:
+			self.regexRiskCount += len(parsed.regexRisks)
+			broken = False
+			for (pattern, error) in parsed.regexRisks:
+				if error:
+					logging.error("%s: Regex Error %s" % (xmlFname, error))
+					self.regexErrors.append((xmlFname, error))
+					broken = True
+				else:
+					logging.debug("%s: Backtracking-prone pattern %s passed preflight",
+						xmlFname, pattern)
+			if broken:
+				return None
+		# Check whether ruleset coverage by tests was sufficient.
+		if self.checkCoverage:
+			logging.debug("Checking coverage for '%s'." % ruleset.name)
+			self.problems = parsed.problems
+			for problem in self.problems:
+				self.coverageProblemsExist = True
+				logging.error(problem)
+		if self.keepContents:
+			ruleset.contents = contents
+		return ruleset
+	
+	def _lookup(self, xmlFname):
+		"""Read file, check it against skiplist and cache. This is the
+		only time the file is read.
+		
+		@returns: tuple (contents, digest, skipped, ParsedRuleset or None
+		on miss)
+		"""
+		with open(xmlFname, "rb") as f:
+			contents = f.read()
+		digest = contentDigest(contents)
+		if digest in skipdict:
+			return (contents, digest, True, None)
+		parsed = None
+		if self.cache:
+			parsed = self.cache.lookup(xmlFname, digest, self.checkCoverage,
+				self.regexBudget)
+		return (contents, digest, False, parsed)
+	
+	def load(self, xmlFname):
+		"""Load ruleset file, parsing it in this process on cache miss.
+		
+		@returns: Ruleset or None if the file was skipped or is broken
+		"""
+		logging.debug("Parsing %s", xmlFname)
+		(contents, digest, skipped, parsed) = self._lookup(xmlFname)
+		if skipped:
+			logging.debug("Skipping rule file '%s', matches skiplist." % xmlFname)
+			return None
+		ruleset = None
+		if parsed is None:
+			(parsed, ruleset) = parseRulesetFile(xmlFname, contents, digest,
+				self.checkCoverage, self.regexBudget)
+			if self.cache:
+				self.cache.store(parsed)
+		return self._accept(parsed, contents, ruleset)
+	
+	def loadMany(self, xmlFnames):
+		"""Load ruleset files, cache misses are parsed in the process pool
+		if there is one. Problems are reported in order of files.
+		
+		@returns: list of loaded Rulesets
+		"""
+		if not self.pool:
+			rulesets = [self.load(xmlFname) for xmlFname in xmlFnames]
+			return [ruleset for ruleset in rulesets if ruleset is not None]
+		
+		looked = [self._lookup(xmlFname) for xmlFname in xmlFnames]
+		args = [(xmlFname, contents, digest, self.checkCoverage, self.regexBudget)
+			for (xmlFname, (contents, digest, skipped, parsed)) in zip(xmlFnames, looked)
+			if not skipped and parsed is None]
+		misses = self.pool.imap(_parseRulesetWorker, args, 8)
+		
+		rulesets = []
+		for (xmlFname, (contents, digest, skipped, parsed)) in zip(xmlFnames, looked):
+			logging.debug("Parsing %s", xmlFname)
+			if skipped:
+				logging.debug("Skipping rule file '%s', matches skiplist." % xmlFname)
+				continue
+			if parsed is None:
+				(parsed, counters) = misses.next()
+				compiledPatterns.addWorkerCounters(counters)
+				if self.cache:
+					self.cache.store(parsed)
+			ruleset = self._accept(parsed, contents)
+			if ruleset is not None:
+				rulesets.append(ruleset)
+		return rulesets
+	
+	def loadInto(self, xmlFnames, trie):
+		"""Parse ruleset files and add them to trie.
+		
+		@param trie: RuleTrie the loaded rulesets are added to
+		@returns: list of loaded Rulesets
+		"""
+		rulesets = self.loadMany(xmlFnames)
+		for ruleset in rulesets:
+			trie.addRuleset(ruleset)
+		return rulesets
+	
+	def close(self):
+		"""Stop worker processes and save the cache."""
+		if self.pool:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+		if self.cache:
+			self.cache.save()
+			logging.info("Ruleset cache: %s.", self.cache.statsString())
+		if self.regexRiskCount:
+			logging.info("Regex preflight: %d backtracking-prone patterns, %d over time budget.",
+				self.regexRiskCount, len(self.regexErrors))
+	
+	def queueRegexErrors(self, resQueue):
+		"""Put patterns over the time budget to resQueue as regex_error
+		results for json output.
+		"""
+		for (xmlFname, error) in self.regexErrors:
+			resQueue.put({"result": "regex_error", "details": error,
+				"fname": xmlFname, "url": ""})
+
+def rulesetPairs(ruleset, fetcherPlain, fetcherRewriting):
+	"""Return UrlPairs of all tests of ruleset that are not excluded."""
+	testUrls = []
+	for test in ruleset.tests:
+		if not ruleset.excludes(test.url):
+			testUrls.append(test.url)
+		else:
+			# TODO: We should fetch the non-rewritten exclusion URLs to make
+			# sure they still exist.
+			logging.debug("Skipping excluded URL %s", test.url)
+	task = ComparisonTask(testUrls, fetcherPlain, fetcherRewriting, ruleset)
+	return task.pairs()
+
+def collectHosts(rulesets, urls):
+	"""Return set of host names that will be fetched - non-wildcard
+	targets of rulesets, hosts of their test URLs and of given URLs.
+	"""
+	hosts = set()
+	testUrls = []
+	for ruleset in rulesets:
+		hosts.update(target for target in ruleset.targets if '*' not in target)
+		testUrls.extend(test.url for test in ruleset.tests)
+	for url in itertools.chain(urls, testUrls):
+		host = urlparse.urlparse(url).hostname
+		if host:
+			hosts.add(host)
+	#fetches look hosts up punycode-escaped, like HTTPFetcher.idnEncodedUrl
+	#does; names that can't be encoded fail there before any lookup
+	encoded = set()
+	for host in hosts:
+		try:
+			if not isinstance(host, unicode):
+				host = host.decode("utf-8")
+			encoded.add(host.encode("idna").lower())
+		except UnicodeError:
+			logging.debug("Not resolving invalid host name %r", host)
+	#IP literals are not resolved by curl either
+	return set(host for host in encoded if not dns_cache.isIPAddress(host))
+
+def resolveHosts(config, dnsCache, hosts, scheduler):
+	"""Resolve hosts in bulk into dnsCache using options in [dns] section.
+	Resolved addresses are fed to politeness scheduler if there is one.
+	"""
+	if config.has_option("dns", "nameserver"):
+		nameserver = dns_cache.parseNameserver(config.get("dns", "nameserver"))
 	else:
-		return False
+		nameserver = dns_cache.systemNameserver()
+	resolver = dns_cache.BulkResolver(nameserver)
+	if config.has_option("dns", "concurrency"):
+		resolver.concurrency = config.getint("dns", "concurrency")
+	if config.has_option("dns", "timeout"):
+		resolver.timeout = config.getfloat("dns", "timeout")
+	if config.has_option("dns", "retries"):
+		resolver.retries = config.getint("dns", "retries")
+	
+	startTime = time.time()
+	counts = resolver.resolveInto(dnsCache, hosts)
+	logging.info("Resolved %d hosts via %s:%d in %.2f seconds: %d ok, %d NXDOMAIN, %d failed.",
+		len(hosts), nameserver[0], nameserver[1], time.time() - startTime,
+		counts["ok"], counts["nxdomain"], counts["failed"])
+	
+	if scheduler:
+		for (host, entry) in dnsCache.items():
+			if entry.addresses:
+				scheduler.recordHostIP(host, entry.addresses[0])
 
 def json_output(resQueue, json_file, problems):
 	"""
@@ -254,6 +768,12 @@ def cli():
 	parser.add_argument('checker_config', help='an integer for the accumulator')
 	parser.add_argument('rule_files', nargs="*", default=[], help="Specific XML rule files")
 	parser.add_argument('--json_file', default=None, help='write results in json file')
+	parser.add_argument('--tls_scan', action='store_true',
+		help='only verify TLS handshake with every non-wildcard target against its platform CA set')
+	parser.add_argument('--rewrite_urls', default=None,
+		help='only rewrite URLs from this file ("-" for stdin) with the rules, writing JSON Lines')
+	parser.add_argument('--rewrite_output', default="-",
+		help='JSON Lines output of --rewrite_urls ("-" for stdout)')
 	args = parser.parse_args()
 
 	config = SafeConfigParser()
@@ -280,6 +800,9 @@ def cli():
 	if config.has_option("rulesets", "check_coverage"):
 		checkCoverage = config.getboolean("rulesets", "check_coverage")
 	certdir = config.get("certificates", "basedir")
+	caBundles = "auto"
+	if config.has_option("certificates", "bundle"):
+		caBundles = config.get("certificates", "bundle").lower()
 	if config.has_option("rulesets", "check_coverage"):
 		checkCoverage = config.getboolean("rulesets", "check_coverage")
 	if config.has_option("rulesets", "skiplist"):
@@ -318,32 +841,38 @@ def cli():
 		xmlFnames = args.rule_files
 	else:
 		xmlFnames = glob.glob(os.path.join(ruledir, "*.xml"))
-	trie = RuleTrie()
+	trieCacheSize = 10000
+	if config.has_option("rulesets", "transform_cache_size"):
+		trieCacheSize = config.getint("rulesets", "transform_cache_size")
+	trie = RuleTrie(trieCacheSize)
+	if config.has_option("rulesets", "combined_matcher"):
+		Ruleset.useCombinedMatcher = config.getboolean("rulesets", "combined_matcher")
+	loadProcesses = multiprocessing.cpu_count()
+	if config.has_option("rulesets", "load_processes"):
+		loadProcesses = config.getint("rulesets", "load_processes")
+	#no point in forking workers for a handful of files
+	loadProcesses = min(loadProcesses, len(xmlFnames) // 50 + 1)
+	regexBudget = 0.5
+	if config.has_option("rulesets", "regex_budget"):
+		regexBudget = config.getfloat("rulesets", "regex_budget")
+	loader = RulesetLoader(includeDefaultOff, checkCoverage, loadProcesses,
+		ruleset_cache.RulesetCache.fromConfig(config), autoDisable, regexBudget)
 	
-	rulesets = []
-	coverageProblemsExist = False
-	for xmlFname in xmlFnames:
-		logging.debug("Parsing %s", xmlFname)
-		if skipFile(xmlFname):
-			logging.debug("Skipping rule file '%s', matches skiplist." % xmlFname)
-			continue
-
-		try:
-			ruleset = Ruleset(etree.parse(file(xmlFname)).getroot(), xmlFname)
-		except Exception, e:
-			logging.error("Exception parsing %s: %s" % (xmlFname, e))
-		if ruleset.defaultOff and not includeDefaultOff:
-			logging.debug("Skipping rule '%s', reason: %s", ruleset.name, ruleset.defaultOff)
-			continue
-		# Check whether ruleset coverage by tests was sufficient.
-		if checkCoverage:
-			logging.debug("Checking coverage for '%s'." % ruleset.name)
-			problems = ruleset.getCoverageProblems()
-			for problem in problems:
-				coverageProblemsExist = True
-				logging.error(problem)
-		trie.addRuleset(ruleset)
-		rulesets.append(ruleset)
+	# Feed tests of rulesets to fetch threads while the rest is still being
+	# parsed. Needs the whole trie up front for dumping it and TLS scan.
+	pipeline = True
+	if config.has_option("rulesets", "pipeline"):
+		pipeline = config.getboolean("rulesets", "pipeline")
+	if dumpGraphvizTrie or args.tls_scan or args.rewrite_urls or not httpEnabled:
+		pipeline = False
+	
+	trieComplete = None
+	if pipeline:
+		trieComplete = threading.Event()
+		rulesets = []
+	else:
+		rulesets = loader.loadInto(xmlFnames, trie)
+		loader.close()
 	
 	# Trie is built now, dump it if it's set in config
 	if dumpGraphvizTrie:
@@ -356,60 +885,166 @@ def cli():
 				graph.dot(gvFd)
 		if exitAfterDump:
 			sys.exit(0)
+	
+	if args.rewrite_urls:
+		bulk_rewrite.rewriteFromConfig(config, trie, args.rewrite_urls, args.rewrite_output)
+		logging.info("Regex patterns: %s.", compiledPatterns.statsString())
+		return 1 if loader.coverageProblemsExist else 0
+	
 	fetchOptions = http_client.FetchOptions(config)
+	scheduler = politeness.PolitenessScheduler.fromOptions(fetchOptions)
+	dnsCache = None
+	if config.has_option("dns", "prefetch") and config.getboolean("dns", "prefetch"):
+		dnsCache = dns_cache.DNSCache()
+		if config.has_option("dns", "min_ttl"):
+			dnsCache.minTTL = config.getint("dns", "min_ttl")
+		if config.has_option("dns", "negative_ttl"):
+			dnsCache.negativeTTL = config.getint("dns", "negative_ttl")
+	responseCache = response_cache.ResponseCache.fromConfig(config)
 	fetcherMap = dict() #maps platform to fetcher
 	
 	platforms = http_client.CertificatePlatforms(os.path.join(certdir, "default"))
 	for platform in havePlatforms:
 		#adding "default" again won't break things
 		platforms.addPlatform(platform, os.path.join(certdir, platform))
-		fetcher = http_client.HTTPFetcher(platform, platforms, fetchOptions, trie)
+		fetcher = http_client.HTTPFetcher(platform, platforms, fetchOptions, trie, scheduler,
+			dnsCache, responseCache, trieComplete)
 		fetcherMap[platform] = fetcher
 	
+	#loading a bundle costs more than a few CAPATH lookups, it only pays off
+	#where libcurl caches the loaded store - in a CurlMulti shared by all
+	#transfers (see benchmarks/ca_store_handshake.py)
+	if caBundles == "auto":
+		useBundles = fetchOptions.engine == "multi" or args.tls_scan
+	else:
+		useBundles = caBundles in ("1", "yes", "true", "on")
+	if useBundles:
+		extraPaths = [fetchOptions.staticCAPath] if fetchOptions.staticCAPath else []
+		fetchOptions.caBundles = platforms.buildBundles(extraPaths)
+	
 	#fetches pages with unrewritten URLs
-	fetcherPlain = http_client.HTTPFetcher("default", platforms, fetchOptions)
+	fetcherPlain = http_client.HTTPFetcher("default", platforms, fetchOptions,
+		scheduler=scheduler, dnsCache=dnsCache, responseCache=responseCache)
 	
 	urlList = []
 	if config.has_option("http", "url_list"):
 		with file(config.get("http", "url_list")) as urlFile:
 			urlList = [line.rstrip() for line in urlFile.readlines()]
 			
-	if httpEnabled:
-		taskQueue = Queue.Queue(1000)
+	if args.tls_scan:
+		resQueue = Queue.Queue()
+		if dnsCache:
+			resolveHosts(config, dnsCache, collectHosts(rulesets, []), scheduler)
+		tls_scan.scanTargets(fetcherPlain, rulesets, resQueue)
+		if args.json_file:
+			loader.queueRegexErrors(resQueue)
+			json_output(resQueue, args.json_file, loader.problems)
+	elif httpEnabled:
+		if scheduler:
+			taskQueue = politeness.PoliteQueue(1000, scheduler, lambda pair: pair.plainUrl)
+		else:
+			taskQueue = Queue.Queue(1000)
 		resQueue = Queue.Queue()
 		startTime = time.time()
 		testedUrlPairCount = 0
 		config.getboolean("debug", "exit_after_dump")
+		
+		if dnsCache:
+			resolveHosts(config, dnsCache, collectHosts(rulesets, urlList), scheduler)
 
-		for i in range(threadCount):
-			t = UrlComparisonThread(taskQueue, metric, thresholdDistance, autoDisable, resQueue)
-			t.setDaemon(True)
-			t.start()
+		#pairs whose redirect needed the complete trie, fetched again after
+		deferredQueue = Queue.Queue()
+		engine = None
+		if fetchOptions.engine == "multi":
+			engine = multi_fetch.MultiFetchEngine(fetchOptions)
+			engine.start()
+			pairQueue = Queue.Queue()
+			feeder = MultiComparisonFeeder(taskQueue, pairQueue, engine)
+			feeder.setDaemon(True)
+			feeder.start()
+			
+			for i in range(threadCount):
+				t = PairComparisonThread(taskQueue, pairQueue, metric, thresholdDistance, autoDisable,
+					resQueue, deferredQueue)
+				t.setDaemon(True)
+				t.start()
+		else:
+			fetchPool = ThreadPool(fetchOptions.fetchThreads or 2*threadCount)
+			for i in range(threadCount):
+				t = UrlComparisonThread(taskQueue, metric, thresholdDistance, autoDisable, resQueue,
+					fetchPool, deferredQueue)
+				t.setDaemon(True)
+				t.start()
 
 		# set of main pages to test
 		mainPages = set(urlList)
 		# If list of URLs to test/scan was not defined, use the test URL extraction
 		# methods built into the Ruleset implementation.
-		if not urlList:
+		def queueRulesets(rulesets):
+			if urlList:
+				return 0
+			pairCount = 0
 			for ruleset in rulesets:
-				testUrls = []
-				for test in ruleset.tests:
-					if not ruleset.excludes(test.url):
-						testedUrlPairCount += 1
-						testUrls.append(test.url)
-					else:
-						# TODO: We should fetch the non-rewritten exclusion URLs to make
-						# sure they still exist.
-						logging.debug("Skipping excluded URL %s", test.url)
-				task = ComparisonTask(testUrls, fetcherPlain, fetcher, ruleset)
-				taskQueue.put(task)
+				for pair in rulesetPairs(ruleset, fetcherPlain, fetcher):
+					taskQueue.put(pair)
+					pairCount += 1
+			return pairCount
+		
+		if pipeline:
+			chunkSize = 100
+			for start in range(0, len(xmlFnames), chunkSize):
+				loaded = loader.loadInto(xmlFnames[start:start+chunkSize], trie)
+				if dnsCache:
+					resolveHosts(config, dnsCache, collectHosts(loaded, []), scheduler)
+				testedUrlPairCount += queueRulesets(loaded)
+			loader.close()
+			logging.debug("Rule trie complete, %d rulesets parsed in %.2f seconds",
+				len(xmlFnames), time.time() - startTime)
+			trieComplete.set()
+		else:
+			testedUrlPairCount += queueRulesets(rulesets)
 		taskQueue.join()
-		logging.info("Finished in %.2f seconds. Loaded rulesets: %d, URL pairs: %d.",
-			time.time() - startTime, len(xmlFnames), testedUrlPairCount)
+		
+		# Second pass over pairs that hit a redirect while the trie was
+		# incomplete. Nothing is deferred once the trie is complete.
+		deferredCount = 0
+		while not deferredQueue.empty():
+			pair = deferredQueue.get_nowait()
+			deferredCount += 1
+			taskQueue.put(pair)
+		if deferredCount:
+			logging.info("Fetching %d URL pairs again with complete rule trie.", deferredCount)
+			taskQueue.join()
+		if engine:
+			logging.info("Multi fetch engine: %s.", engine.statsString())
+		logging.info("Fetch statistics: %s.", http_client.fetchStats.statsString())
+		if http_client.getRedirectCache(fetchOptions):
+			logging.info("Redirect cache: %s.", http_client.redirectStats.statsString())
+		singleFlight = http_client.getSingleFlight(fetchOptions)
+		if singleFlight:
+			logging.info("Fetch deduplication: %s.", singleFlight.statsString())
+		if trie.cacheStatsString():
+			logging.info("Rule trie cache: %s.", trie.cacheStatsString())
+		if dnsCache:
+			logging.info("DNS cache: %s.", dnsCache.statsString())
+		if scheduler:
+			logging.info("Politeness scheduler: %s", scheduler.statsString())
+		workerPool = http_client.closeWorkerPool()
+		if workerPool:
+			logging.info("Fetch worker pool: %s.", workerPool.statsString())
+		cacheInfo = ""
+		if responseCache:
+			responseCache.close()
+			logging.info("Response cache: %s.", responseCache.statsString())
+			cacheInfo = ", response cache hit ratio: %.1f%%" % (100 * responseCache.hitRatio())
+		logging.info("Finished in %.2f seconds. Loaded rulesets: %d, URL pairs: %d%s.",
+			time.time() - startTime, len(xmlFnames), testedUrlPairCount, cacheInfo)
 		if args.json_file:
-			json_output(resQueue, args.json_file, problems)
+			loader.queueRegexErrors(resQueue)
+			json_output(resQueue, args.json_file, loader.problems)
+	logging.info("Regex patterns: %s.", compiledPatterns.statsString())
 	if checkCoverage:
-		if coverageProblemsExist:
+		if loader.coverageProblemsExist:
 			return 1 # exit with error code
 		else:
 			return 0 # exit with success
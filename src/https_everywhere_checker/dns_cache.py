@@ -0,0 +1,331 @@
+import collections
+import errno
+import logging
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+## Bulk DNS pre-resolution
+#
+# Before fetching starts, all hosts from ruleset targets and test URLs are
+# resolved at once by BulkResolver. It keeps many queries in flight over a
+# single UDP socket, so resolving tens of thousands of hosts takes seconds
+# instead of one connect_timeout per dead domain. Results are stored in
+# DNSCache with their TTLs:
+#
+#  - positive entries are handed to curl via CURLOPT_RESOLVE, so neither the
+#    first fetch, nor redirect hops or retries to the host resolve it again
+#  - NXDOMAIN entries make the fetch fail immediately
+#  - hosts that timed out or returned no A records are not cached, curl
+#    resolves them as usual
+#
+# The resolver talks plain DNS to the configured nameserver (first one from
+# /etc/resolv.conf by default), which can be a local stub for testing.
+
+DNS_TYPE_A = 1
+DNS_TYPE_SOA = 6
+DNS_RCODE_NXDOMAIN = 3
+
+class DNSError(ValueError):
+	"""Malformed DNS message."""
+	pass
+
+class DNSEntry(object):
+	"""Cached result of resolving one host name."""
+
+	def __init__(self, addresses, expires):
+		"""
+		@param addresses: list of IPv4 addresses as str, empty list for
+		NXDOMAIN
+		@param expires: time.time() value when the entry stops being valid
+		"""
+		self.addresses = addresses
+		self.expires = expires
+
+	def isNegative(self):
+		return not self.addresses
+
+class DNSCache(object):
+	"""Thread-safe cache of positive and negative DNS answers."""
+
+	def __init__(self, minTTL=60, negativeTTL=300):
+		"""
+		@param minTTL: positive answers are cached at least this long
+		@param negativeTTL: max caching time of NXDOMAIN answers
+		"""
+		self.minTTL = minTTL
+		self.negativeTTL = negativeTTL
+		self.entries = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.negativeHits = 0
+
+	def store(self, host, addresses, ttl):
+		"""Store answer for host.
+
+		@param addresses: list of IPv4 addresses, empty for NXDOMAIN
+		@param ttl: TTL from the answer in seconds
+		"""
+		if addresses:
+			ttl = max(ttl, self.minTTL)
+		else:
+			ttl = min(ttl, self.negativeTTL)
+		with self.lock:
+			self.entries[host.lower()] = DNSEntry(addresses, time.time() + ttl)
+
+	def lookup(self, host):
+		"""Return valid DNSEntry for host or None if not cached."""
+		host = host.lower()
+		with self.lock:
+			entry = self.entries.get(host)
+			if entry is None:
+				return None
+			if entry.expires < time.time():
+				del self.entries[host]
+				return None
+			if entry.isNegative():
+				self.negativeHits += 1
+			else:
+				self.hits += 1
+			return entry
+
+	def items(self):
+		"""List of (host, DNSEntry) tuples of valid entries."""
+		now = time.time()
+		with self.lock:
+			return [(host, entry) for (host, entry) in self.entries.items()
+				if entry.expires >= now]
+
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		return "%d cache hits, %d fetches failed fast on NXDOMAIN" % (
+			self.hits, self.negativeHits)
+
+def encodeQuery(queryId, name, qtype=DNS_TYPE_A):
+	"""Build DNS query message with recursion desired flag.
+
+	@param name: ASCII (IDNA-encoded) host name
+	"""
+	header = struct.pack("!HHHHHH", queryId, 0x0100, 1, 0, 0, 0)
+	labels = [label for label in name.rstrip(".").split(".") if label]
+	qname = "".join(chr(len(label)) + label for label in labels) + "\0"
+	return header + qname + struct.pack("!HH", qtype, 1)
+
+def _readName(message, offset):
+	"""Read possibly compressed domain name from message.
+
+	@returns: tuple (name, offset right after the name)
+	"""
+	labels = []
+	endOffset = None
+	jumps = 0
+	while True:
+		if offset >= len(message):
+			raise DNSError("Name runs past end of message")
+		length = ord(message[offset])
+		if length & 0xC0 == 0xC0:
+			if offset + 1 >= len(message):
+				raise DNSError("Truncated compression pointer")
+			if endOffset is None:
+				endOffset = offset + 2
+			jumps += 1
+			if jumps > 64:
+				raise DNSError("Compression pointer loop")
+			offset = ((length & 0x3F) << 8) | ord(message[offset + 1])
+			continue
+		offset += 1
+		if length == 0:
+			break
+		if offset + length > len(message):
+			raise DNSError("Label runs past end of message")
+		labels.append(message[offset:offset + length])
+		offset += length
+	if endOffset is None:
+		endOffset = offset
+	return (".".join(labels).lower(), endOffset)
+
+def decodeResponse(message):
+	"""Parse DNS response to A query.
+
+	@returns: tuple (queryId, qname, rcode, addresses, ttl) where ttl is the
+	lowest TTL of A records or negative caching TTL from SOA for NXDOMAIN
+	(None if unknown)
+	@throws DNSError: on malformed message
+	"""
+	if len(message) < 12:
+		raise DNSError("Message shorter than header")
+	(queryId, flags, qdCount, anCount, nsCount, arCount) = \
+		struct.unpack("!HHHHHH", message[:12])
+	rcode = flags & 0x000F
+	offset = 12
+
+	qname = None
+	for i in range(qdCount):
+		(name, offset) = _readName(message, offset)
+		if qname is None:
+			qname = name
+		offset += 4
+		if offset > len(message):
+			raise DNSError("Truncated question")
+
+	addresses = []
+	ttl = None
+	for i in range(anCount + nsCount):
+		(name, offset) = _readName(message, offset)
+		if offset + 10 > len(message):
+			raise DNSError("Truncated resource record")
+		(rtype, rclass, rttl, rdLength) = struct.unpack("!HHIH", message[offset:offset + 10])
+		offset += 10
+		rdata = message[offset:offset + rdLength]
+		if len(rdata) < rdLength:
+			raise DNSError("Truncated resource data")
+
+		if i < anCount and rtype == DNS_TYPE_A and rdLength == 4:
+			addresses.append(socket.inet_ntoa(rdata))
+			ttl = rttl if ttl is None else min(ttl, rttl)
+		elif i >= anCount and rtype == DNS_TYPE_SOA:
+			#negative caching TTL is min(SOA TTL, SOA minimum), RFC 2308
+			(mname, soaOffset) = _readName(message, offset)
+			(rname, soaOffset) = _readName(message, soaOffset)
+			if soaOffset + 20 > offset + rdLength:
+				raise DNSError("Truncated SOA record")
+			minimum = struct.unpack("!I", message[soaOffset + 16:soaOffset + 20])[0]
+			if not addresses:
+				ttl = min(rttl, minimum)
+		offset += rdLength
+
+	return (queryId, qname, rcode, addresses, ttl)
+
+def systemNameserver(resolvConf="/etc/resolv.conf"):
+	"""Return first nameserver from resolv.conf as (host, port) tuple."""
+	try:
+		with open(resolvConf) as f:
+			for line in f:
+				parts = line.split()
+				if len(parts) >= 2 and parts[0] == "nameserver" and ":" not in parts[1]:
+					return (parts[1], 53)
+	except IOError:
+		pass
+	return ("127.0.0.1", 53)
+
+def isIPAddress(host):
+	"""True iff host is an IPv4 or IPv6 address literal."""
+	for family in (socket.AF_INET, socket.AF_INET6):
+		try:
+			socket.inet_pton(family, host.strip("[]"))
+			return True
+		except (socket.error, ValueError):
+			pass
+	return False
+
+def parseNameserver(value):
+	"""Parse "host" or "host:port" string into (host, port) tuple."""
+	if ":" in value:
+		(host, port) = value.rsplit(":", 1)
+		return (host, int(port))
+	return (value, 53)
+
+class BulkResolver(object):
+	"""Resolves many host names concurrently over one UDP socket."""
+
+	def __init__(self, nameserver, concurrency=200, timeout=2.0, retries=2):
+		"""
+		@param nameserver: (host, port) tuple of recursive resolver
+		@param concurrency: max number of queries in flight
+		@param timeout: seconds to wait for an answer before resending
+		@param retries: number of resends before giving up on a host
+		"""
+		self.nameserver = nameserver
+		self.concurrency = concurrency
+		self.timeout = timeout
+		self.retries = retries
+
+	def resolveInto(self, cache, hosts):
+		"""Resolve hosts (A records) and store answers into cache.
+
+		@param cache: DNSCache instance
+		@param hosts: iterable of ASCII host names
+		@returns: collections.Counter with "ok", "nxdomain" and "failed"
+		counts
+		"""
+		counts = collections.Counter()
+		queue = collections.deque(sorted(set(host.lower() for host in hosts)))
+		pending = {} #query id -> [host, attempts, time sent]
+		nextId = random.randint(0, 0xFFFF)
+
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.setblocking(0)
+		try:
+			while queue or pending:
+				while queue and len(pending) < self.concurrency:
+					while nextId in pending:
+						nextId = (nextId + 1) & 0xFFFF
+					host = queue.popleft()
+					pending[nextId] = [host, 1, time.time()]
+					self._send(sock, nextId, host)
+					nextId = (nextId + 1) & 0xFFFF
+
+				(readable, _, _) = select.select([sock], [], [], 0.05)
+				if readable:
+					self._receive(sock, pending, cache, counts)
+
+				now = time.time()
+				for (queryId, item) in pending.items():
+					(host, attempts, sentAt) = item
+					if now - sentAt < self.timeout:
+						continue
+					if attempts > self.retries:
+						del pending[queryId]
+						counts["failed"] += 1
+						logging.debug("DNS query for %s timed out", host)
+					else:
+						item[1] += 1
+						item[2] = now
+						self._send(sock, queryId, host)
+		finally:
+			sock.close()
+
+		return counts
+
+	def _send(self, sock, queryId, host):
+		try:
+			sock.sendto(encodeQuery(queryId, host), self.nameserver)
+		except socket.error, e:
+			#will be retried after timeout
+			logging.debug("Sending DNS query for %s failed: %s", host, e)
+
+	def _receive(self, sock, pending, cache, counts):
+		"""Read all available answers from socket."""
+		while True:
+			try:
+				(message, sender) = sock.recvfrom(65535)
+			except socket.error, e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				#e.g. ICMP port unreachable, queries will time out
+				logging.debug("Receiving DNS answer failed: %s", e)
+				return
+
+			try:
+				(queryId, qname, rcode, addresses, ttl) = decodeResponse(message)
+			except DNSError, e:
+				logging.debug("Malformed DNS answer from %s: %s", sender, e)
+				continue
+
+			item = pending.get(queryId)
+			if item is None or item[0] != qname:
+				continue
+			del pending[queryId]
+
+			host = item[0]
+			if rcode == DNS_RCODE_NXDOMAIN:
+				cache.store(host, [], ttl if ttl is not None else cache.negativeTTL)
+				counts["nxdomain"] += 1
+			elif rcode == 0 and addresses:
+				cache.store(host, addresses, ttl)
+				counts["ok"] += 1
+			else:
+				counts["failed"] += 1
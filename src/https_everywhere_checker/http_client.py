@@ -1,6 +1,15 @@
 import os
 import sys
+import glob
+import atexit
+import shutil
+import hashlib
+import struct
+import collections
 import logging
+import resource
+import threading
+import time
 import pycurl
 import urlparse
 import cStringIO
@@ -41,6 +50,52 @@ class CertificatePlatforms(object):
 		exist, return default CA path.
 		"""
 		return self.platformPaths.get(platform) or self.defaultCAPath
+	
+	def buildBundles(self, extraPaths=()):
+		"""Write deduplicated certificates of each platform directory into
+		a single PEM bundle, so that TLS verification doesn't do hash
+		directory lookups and file opens on every handshake. Bundles live
+		in a temporary directory removed at exit.
+		
+		@param extraPaths: other CA directories to bundle (e.g. static
+		CA path)
+		@returns: dict CA path -> bundle file name
+		"""
+		bundleDir = tempfile.mkdtemp(prefix="hte-ca-")
+		atexit.register(shutil.rmtree, bundleDir, True)
+		
+		bundles = {}
+		caPaths = set(self.platformPaths.values()) | set(extraPaths)
+		for (index, caPath) in enumerate(sorted(caPaths)):
+			bundleName = os.path.join(bundleDir, "%d.pem" % index)
+			count = writeCABundle(caPath, bundleName)
+			logging.debug("Bundled %d certificates from %s", count, caPath)
+			bundles[caPath] = bundleName
+		return bundles
+
+_pemCertRe = regex.compile(r"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----", regex.S)
+
+def writeCABundle(caPath, bundleName):
+	"""Write all distinct PEM certificates found in files of c_rehash'd
+	directory caPath into file bundleName.
+	
+	@returns: number of certificates written
+	"""
+	seen = set()
+	with open(bundleName, "w") as bundle:
+		for fname in sorted(glob.glob(os.path.join(caPath, "*"))):
+			if not os.path.isfile(fname):
+				continue
+			with open(fname) as f:
+				pemData = f.read()
+			for pem in _pemCertRe.findall(pemData):
+				#hashed names are links/copies of the same certificates
+				digest = hashlib.sha256("".join(pem.split())).digest()
+				if digest in seen:
+					continue
+				seen.add(digest)
+				bundle.write(pem + "\n")
+	return len(seen)
 
 class FetchOptions(object):
 	"""HTTP fetcher options like timeouts."""
@@ -57,7 +112,26 @@ class FetchOptions(object):
 		self.curlVerbose = False
 		self.sslVersion = pycurl.SSLVERSION_DEFAULT
 		self.useSubprocess = True
+		self.workerCount = 2 * config.getint("http", "threads")
+		self.workerMaxFetches = 1000
+		self.workerMaxRSS = 256
 		self.staticCAPath = None
+		self.engine = "easy"
+		self.maxTransfers = 1000
+		self.connectionPool = True
+		self.maxIdleHandles = 256
+		self.fetchThreads = None
+		self.maxPerHost = 0
+		self.maxPerIP = 0
+		self.hostRate = 0
+		self.ipRate = 0
+		self.singleFlight = True
+		self.dedupWindow = 60
+		self.redirectCache = True
+		self.temporaryRedirectTTL = 60
+		self.offlineVerify = False
+		#CA path -> single-file bundle, see CertificatePlatforms.buildBundles
+		self.caBundles = {}
 		# The default list of cipher suites that ships with Firefox 35.0.1
 		self.cipherList = "RC4-MD5:RC4-SHA:DES-CBC3-SHA:AES128-SHA:AES256-SHA:DHE-DSS-AES128-SHA:DHE-RSA-AES128-SHA:DHE-RSA-AES256-SHA:ECDHE-RSA-RC4-SHA:ECDHE-RSA-AES128-SHA:ECDHE-RSA-AES256-SHA:ECDHE-ECDSA-RC4-SHA:ECDHE-ECDSA-AES128-SHA:ECDHE-ECDSA-AES256-SHA:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES128-GCM-SHA256"
 
@@ -67,6 +141,12 @@ class FetchOptions(object):
 			self.curlVerbose = config.getboolean("http", "curl_verbose")
 		if config.has_option("http", "fetch_in_subprocess"):
 			self.useSubprocess = config.getboolean("http", "fetch_in_subprocess")
+		if config.has_option("http", "fetch_workers"):
+			self.workerCount = config.getint("http", "fetch_workers")
+		if config.has_option("http", "fetch_worker_max_fetches"):
+			self.workerMaxFetches = config.getint("http", "fetch_worker_max_fetches")
+		if config.has_option("http", "fetch_worker_max_rss"):
+			self.workerMaxRSS = config.getint("http", "fetch_worker_max_rss")
 		if config.has_option("http", "cipherList"):
 			self.cipherList = config.get("http", "cipherList")
 		if config.has_option("http", "ssl_version"):
@@ -77,21 +157,53 @@ class FetchOptions(object):
 				raise ValueError("SSL version '%s' specified in config is unsupported." % versionStr)
 		if config.has_option("http", "static_ca_path"):
 			self.staticCAPath = config.get("http", "static_ca_path")
+		if config.has_option("http", "engine"):
+			self.engine = config.get("http", "engine")
+			if self.engine not in ("easy", "multi"):
+				raise ValueError("Fetch engine '%s' specified in config is unknown." % self.engine)
+		if config.has_option("http", "max_transfers"):
+			self.maxTransfers = config.getint("http", "max_transfers")
+		if config.has_option("http", "connection_pool"):
+			self.connectionPool = config.getboolean("http", "connection_pool")
+		if config.has_option("http", "max_idle_handles"):
+			self.maxIdleHandles = config.getint("http", "max_idle_handles")
+		if config.has_option("http", "fetch_threads"):
+			self.fetchThreads = config.getint("http", "fetch_threads")
+		if config.has_option("http", "max_per_host"):
+			self.maxPerHost = config.getint("http", "max_per_host")
+		if config.has_option("http", "max_per_ip"):
+			self.maxPerIP = config.getint("http", "max_per_ip")
+		if config.has_option("http", "host_rate"):
+			self.hostRate = config.getfloat("http", "host_rate")
+		if config.has_option("http", "ip_rate"):
+			self.ipRate = config.getfloat("http", "ip_rate")
+		if config.has_option("http", "single_flight"):
+			self.singleFlight = config.getboolean("http", "single_flight")
+		if config.has_option("http", "dedup_window"):
+			self.dedupWindow = config.getint("http", "dedup_window")
+		if config.has_option("http", "redirect_cache"):
+			self.redirectCache = config.getboolean("http", "redirect_cache")
+		if config.has_option("http", "temporary_redirect_ttl"):
+			self.temporaryRedirectTTL = config.getint("http", "temporary_redirect_ttl")
+		if config.has_option("http", "offline_verify"):
+			self.offlineVerify = config.getboolean("http", "offline_verify")
 	
 class FetcherInArgs(object):
 	"""Container for parameters necessary to be passed to CURL fetcher when
 	invoked in subprocess to workaround openssl/gnutls+curl threading bugs.
 	"""
 	
-	def __init__(self, url, options, platformPath):
+	def __init__(self, url, options, platformPath, resolve=None):
 		"""
 		@param url: IDNA-encoded URL
 		@param options: FetchOptions instance
 		@param platformPath: directory with platform certificates
+		@param resolve: list of CURLOPT_RESOLVE entries or None
 		"""
 		self.url = url
 		self.options = options
 		self.platformPath = platformPath
+		self.resolve = resolve
 	
 	def check(self):
 		"""Throw HTTPFetcherError unless attributes are set and sane."""
@@ -108,23 +220,37 @@ class FetcherOutArgs(object):
 	"""
 	
 	def __init__(self, httpCode=None, data=None, headerStr=None,
-		     errorStr=None, shortError=None):
+		     errorStr=None, shortError=None, handleReused=False,
+		     connectionReused=False, primaryIP=None):
 		"""
 		@param httpCode: return HTTP code as int
 		@param data: data fetched from URL as str
 		@param headerStr: HTTP headers as str
 		@param errorStr: formatted backtrace from exception as str
 		@param shortError: short one-line error description
+		@param handleReused: True if PyCURL handle came from CurlHandlePool
+		@param connectionReused: True if no new connection was opened
+		@param primaryIP: IP address of the server as str
 		"""
 		self.httpCode = httpCode
 		self.data = data
 		self.headerStr = headerStr
 		self.errorStr = errorStr
 		self.shortError = shortError
+		self.handleReused = handleReused
+		self.connectionReused = connectionReused
+		self.primaryIP = primaryIP
 	
 class HTTPFetcherError(RuntimeError):
 	pass
 
+class TrieIncompleteError(HTTPFetcherError):
+	"""Redirect can't be rewritten yet because rulesets are still being
+	loaded into the rule trie. The fetch should be repeated once the trie
+	is complete.
+	"""
+	pass
+
 class ErrorSanitizer():
 	""" Sanitize errors thrown by sub-tools and libraries
 	"""
@@ -164,13 +290,567 @@ class ErrorSanitizer():
 
 		return "Fetcher subprocess error: %s\n%s" % (shortError, errorStr)
 
+class CurlHandlePool(object):
+	"""Pool of idle PyCURL handles so that kept-alive connections and TLS
+	sessions are reused by later fetches from the same server.
+	
+	Handles are keyed by (scheme, host, port, CA path), so a handle only
+	ever talks to one server name and verifies against one platform. TLS
+	sessions are shared through CurlShare only among handles with the same
+	SNI name and CA path. That avoids the CURL+NSS bug of resuming a
+	session for another name on the same IP (see README) as well as
+	resuming a session that was verified against another platform.
+	"""
+	
+	def __init__(self, maxIdle):
+		"""
+		@param maxIdle: max number of idle handles kept, least recently
+		used keys are evicted first
+		"""
+		self.maxIdle = maxIdle
+		self.idle = collections.OrderedDict() #key -> list of handles
+		self.idleCount = 0
+		self.shares = {} #(host, CA path) -> pycurl.CurlShare
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	
+	@staticmethod
+	def handleKey(url, platformPath):
+		"""Return pool key for IDNA-encoded URL fetched with CA path."""
+		parsed = urlparse.urlparse(url)
+		port = parsed.port or {"http": 80, "https": 443}.get(parsed.scheme)
+		return (parsed.scheme, parsed.hostname or "", port, platformPath)
+	
+	def checkout(self, url, platformPath):
+		"""Take idle handle for URL or create a new one.
+		
+		@returns: tuple (key, handle, reused)
+		"""
+		key = self.handleKey(url, platformPath)
+		with self.lock:
+			handles = self.idle.get(key)
+			if handles:
+				c = handles.pop()
+				if not handles:
+					del self.idle[key]
+				self.idleCount -= 1
+				self.hits += 1
+				return (key, c, True)
+			
+			self.misses += 1
+			shareKey = (key[1], platformPath)
+			share = self.shares.get(shareKey)
+			if share is None:
+				share = pycurl.CurlShare()
+				share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+				self.shares[shareKey] = share
+		
+		c = pycurl.Curl()
+		c.setopt(pycurl.SHARE, share)
+		return (key, c, False)
+	
+	def checkin(self, key, c):
+		"""Return handle to the pool after successful fetch. Reset
+		options, but kept-alive connections and sessions survive.
+		"""
+		c.reset()
+		evicted = []
+		with self.lock:
+			handles = self.idle.pop(key, [])
+			handles.append(c)
+			self.idle[key] = handles #move to most recently used
+			self.idleCount += 1
+			while self.idleCount > self.maxIdle:
+				(oldKey, oldHandles) = self.idle.popitem(last=False)
+				evicted.extend(oldHandles)
+				self.idleCount -= len(oldHandles)
+		
+		for handle in evicted:
+			handle.close()
+
+_handlePool = None
+_handlePoolLock = threading.Lock()
+
+def getHandlePool(options):
+	"""Return the process-wide CurlHandlePool or None if connection
+	pooling is turned off.
+	
+	@param options: FetchOptions instance
+	"""
+	global _handlePool
+	if not options.connectionPool:
+		return None
+	with _handlePoolLock:
+		if _handlePool is None:
+			_handlePool = CurlHandlePool(options.maxIdleHandles)
+		return _handlePool
+
+class FetchStats(object):
+	"""Counters of successful fetches, collected in the main process
+	regardless of where the fetch was performed.
+	"""
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.fetches = 0
+		self.handleHits = 0
+		self.connectionsReused = 0
+	
+	def recordFetch(self, fetched):
+		"""Count one FetcherOutArgs result."""
+		with self.lock:
+			self.fetches += 1
+			if fetched.handleReused:
+				self.handleHits += 1
+			if fetched.connectionReused:
+				self.connectionsReused += 1
+	
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		return "%d fetches, %d handle pool hits, %d misses, %d connections reused" % (
+			self.fetches, self.handleHits, self.fetches - self.handleHits,
+			self.connectionsReused)
+
+fetchStats = FetchStats()
+
+def setsCookie(fetched):
+	"""True iff response in FetcherOutArgs has Set-Cookie header."""
+	return "\nset-cookie:" in (fetched.headerStr or "").lower()
+
+class Flight(object):
+	"""One network fetch shared by all requests for the same URL."""
+	
+	def __init__(self, key):
+		self.key = key
+		self.event = threading.Event()
+		self.waiters = []
+		self.fetched = None
+		self.excInfo = None
+		self.finished = None
+	
+	def done(self):
+		return self.finished is not None
+	
+	def outcome(self):
+		"""Return fetched result or re-raise the fetch's exception."""
+		if self.excInfo:
+			raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+		return self.fetched
+
+class SingleFlight(object):
+	"""Table of in-flight and recently finished fetches keyed by (URL, CA
+	path). The same plain URL is often tested by several rulesets and
+	reached by several redirect chains; concurrent or closely following
+	requests for it share one network fetch instead of repeating it.
+	"""
+	
+	def __init__(self, window):
+		"""
+		@param window: seconds a finished fetch's result is handed to
+		later requests
+		"""
+		self.window = window
+		self.flights = {}
+		self.finishedOrder = collections.deque() #flights by finish time
+		self.lock = threading.Lock()
+		self.fetches = 0
+		self.saved = 0
+	
+	def _expire(self, now):
+		"""Forget flights finished more than window ago, must be called
+		with lock held.
+		"""
+		while self.finishedOrder and self.finishedOrder[0].finished + self.window < now:
+			flight = self.finishedOrder.popleft()
+			if self.flights.get(flight.key) is flight:
+				del self.flights[flight.key]
+	
+	def claim(self, url, platformPath):
+		"""Join fetch of URL or become its leader.
+		
+		@returns: tuple (flight, leader); if leader is True the caller
+		must fetch and call finish(), otherwise it waits for the flight
+		(or uses it right away if it's done)
+		"""
+		key = (url, platformPath)
+		with self.lock:
+			self._expire(time.time())
+			flight = self.flights.get(key)
+			if flight is not None:
+				self.saved += 1
+				return (flight, False)
+			flight = Flight(key)
+			self.flights[key] = flight
+			self.fetches += 1
+			return (flight, True)
+	
+	def finish(self, flight, fetched=None, excInfo=None):
+		"""Publish outcome of leader's fetch and notify waiters. Waiter
+		callbacks are called from the finishing thread.
+		"""
+		with self.lock:
+			flight.fetched = fetched
+			flight.excInfo = excInfo
+			flight.finished = time.time()
+			#later requests fetch again after failures, which are often
+			#transient, and cookies, which change what the next fetch returns
+			if excInfo or (fetched and setsCookie(fetched)):
+				if self.flights.get(flight.key) is flight:
+					del self.flights[flight.key]
+			else:
+				self.finishedOrder.append(flight)
+			waiters, flight.waiters = flight.waiters, []
+		flight.event.set()
+		for waiter in waiters:
+			waiter(flight)
+	
+	def addWaiter(self, flight, waiter):
+		"""Call waiter(flight) when flight finishes, right away if it
+		has finished already.
+		"""
+		with self.lock:
+			if not flight.done():
+				flight.waiters.append(waiter)
+				return
+		waiter(flight)
+	
+	def fetch(self, url, platformPath, fetchFunc):
+		"""Blocking single-flight fetch.
+		
+		@param fetchFunc: called without arguments by the leader to do the
+		network fetch
+		@returns: FetcherOutArgs of the shared fetch
+		@throws: whatever fetchFunc threw
+		"""
+		(flight, leader) = self.claim(url, platformPath)
+		if not leader:
+			flight.event.wait()
+			return flight.outcome()
+		
+		try:
+			fetched = fetchFunc()
+		except:
+			self.finish(flight, excInfo=sys.exc_info())
+			raise
+		self.finish(flight, fetched)
+		return fetched
+	
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		return "%d distinct fetches, %d duplicate fetches saved" % (
+			self.fetches, self.saved)
+
+_singleFlight = None
+_singleFlightLock = threading.Lock()
+
+def getSingleFlight(options):
+	"""Return the process-wide SingleFlight table or None if fetch
+	deduplication is turned off.
+	
+	@param options: FetchOptions instance
+	"""
+	global _singleFlight
+	if not options.singleFlight:
+		return None
+	with _singleFlightLock:
+		if _singleFlight is None:
+			_singleFlight = SingleFlight(options.dedupWindow)
+		return _singleFlight
+
+class RedirectChain(object):
+	"""URLs visited while following redirects of one fetch, for cycle
+	detection.
+	
+	A URL seen again is a loop unless some response since its previous
+	visit set a cookie - some sites (e.g. forums.aws.amazon.com) redirect
+	back to the original URL once the cookie is set.
+	"""
+	
+	def __init__(self, url):
+		"""
+		@param url: URL the chain starts with, for error messages
+		"""
+		self.origUrl = url
+		self.seen = {} #URL -> index of hop that fetched it
+		self.hops = 0
+		self.lastCookieHop = -1
+	
+	def visit(self, url):
+		"""Record that url is the next hop.
+		
+		@throws HTTPFetcherError: if url was visited already and it would
+		redirect the same way again
+		"""
+		previous = self.seen.get(url)
+		if previous is not None and previous > self.lastCookieHop:
+			redirectStats.recordLoop()
+			raise HTTPFetcherError("Redirect loop while fetching '%s', '%s' seen twice" %
+				(self.origUrl, url))
+		self.seen[url] = self.hops
+		self.hops += 1
+	
+	def fetched(self, fetched):
+		"""Record response of the last visited hop."""
+		if setsCookie(fetched):
+			self.lastCookieHop = self.hops - 1
+
+class RedirectCache(object):
+	"""Run-wide cache of redirect hops, so that chains like http://x/ ->
+	https://x/ -> https://www.x/ are fetched once and known hops are
+	followed without refetching them.
+	
+	Permanent redirects (301, 308) are kept for the whole run, temporary
+	ones (302, 303, 307) for a short TTL. Hops that set cookies are not
+	cached since skipping them would change what the next hop returns.
+	Entries are keyed by (URL, CA path), a hop learned with one platform's
+	certificates says nothing about whether another platform accepts them.
+	"""
+	
+	permanentCodes = (301, 308)
+	
+	def __init__(self, temporaryTTL):
+		"""
+		@param temporaryTTL: seconds to keep 302/303/307 hops
+		"""
+		self.temporaryTTL = temporaryTTL
+		self.hops = {} #(url, CA path) -> (location, expires)
+		self.lock = threading.Lock()
+	
+	def record(self, url, platformPath, fetched, location):
+		"""Store redirect of url to absolute location."""
+		if setsCookie(fetched):
+			return
+		if fetched.httpCode in self.permanentCodes:
+			expires = None
+		elif self.temporaryTTL > 0:
+			expires = time.time() + self.temporaryTTL
+		else:
+			return
+		with self.lock:
+			self.hops[(url, platformPath)] = (location, expires)
+	
+	def lookup(self, url, platformPath):
+		"""Return cached absolute location url redirects to or None."""
+		key = (url, platformPath)
+		with self.lock:
+			hop = self.hops.get(key)
+			if hop is None:
+				return None
+			(location, expires) = hop
+			if expires is not None and expires < time.time():
+				del self.hops[key]
+				return None
+		redirectStats.recordHit()
+		return location
+
+class RedirectStats(object):
+	"""Counters of redirect cache hits and detected redirect loops."""
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.loops = 0
+	
+	def recordHit(self):
+		with self.lock:
+			self.hits += 1
+	
+	def recordLoop(self):
+		with self.lock:
+			self.loops += 1
+	
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		return "%d hops followed from cache, %d loops detected" % (self.hits, self.loops)
+
+redirectStats = RedirectStats()
+
+_redirectCache = None
+_redirectCacheLock = threading.Lock()
+
+def getRedirectCache(options):
+	"""Return the process-wide RedirectCache or None if redirect caching
+	is turned off.
+	
+	@param options: FetchOptions instance
+	"""
+	global _redirectCache
+	if not options.redirectCache:
+		return None
+	with _redirectCacheLock:
+		if _redirectCache is None:
+			_redirectCache = RedirectCache(options.temporaryRedirectTTL)
+		return _redirectCache
+
+class FetchWorker(object):
+	"""Long-lived fetcher subprocess. Keeps the process-level separation
+	that works around openssl/gnutls+curl threading bugs, but serves many
+	fetches over framed pickles on its stdin/stdout.
+	"""
+	
+	def __init__(self):
+		# Workaround for cPickle seeing module name as __main__ if we
+		# just directly executed this script.
+		# TODO: check PYTHONPATH etc if not in the same dir as script
+		# TODO: we should set the main process to be session leader
+		trampoline = 'from https_everywhere_checker import http_client; http_client.subprocessFetchLoop()'
+		
+		# Spawn subprocess, call this module as "main" program. I tried
+		# also using python's multiprocessing module, but for some
+		# reason it was a hog on CPU and RAM (maybe due to the queues?)
+		# Also, logging module didn't play along nicely.
+		#
+		# stderr is inherited, piping it without reading would
+		# eventually block a long-lived worker. Pipes of other workers
+		# must not be inherited, a worker holding another one's stdin
+		# keeps it from seeing EOF in close().
+		args = [sys.executable, '-c', trampoline]
+		self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE, close_fds=True)
+		self.fetchCount = 0
+	
+	def fetch(self, inArgs):
+		"""Send FetcherInArgs to worker and wait for the result.
+		
+		@returns: tuple (FetcherOutArgs, retire) where retire is True
+		if the worker exits after this fetch
+		@throws: HTTPFetcherError if the worker died
+		"""
+		try:
+			_writeFrame(self.process.stdin, cPickle.dumps(inArgs, cPickle.HIGHEST_PROTOCOL))
+			frame = _readFrame(self.process.stdout)
+		except (IOError, OSError), e:
+			logging.debug("Fetcher worker pipe error: %s", e)
+			frame = None
+		
+		if frame is None:
+			exitCode = self.close()
+			raise HTTPFetcherError("Subprocess failed with exit code %s" % exitCode)
+		
+		self.fetchCount += 1
+		(unpickled, retire) = cPickle.loads(frame)
+		if not isinstance(unpickled, FetcherOutArgs):
+			self.close()
+			raise HTTPFetcherError("Unexpected datatype received from subprocess: %s" % \
+				type(unpickled))
+		
+		return (unpickled, retire)
+	
+	def close(self):
+		"""Close pipes to worker, which makes it exit, and reap it.
+		
+		@returns: exit code of the worker process
+		"""
+		for fd in (self.process.stdin, self.process.stdout):
+			try:
+				fd.close()
+			except (IOError, OSError):
+				pass
+		return self.process.wait()
+
+class FetchWorkerPool(object):
+	"""Pool of FetchWorker processes shared by all fetcher threads.
+	Workers that retire (fetch count or RSS limit) or crash are replaced by
+	freshly spawned ones on demand.
+	"""
+	
+	def __init__(self, size):
+		"""
+		@param size: max number of concurrently running workers
+		"""
+		self.size = size
+		self.idleWorkers = []
+		self.lock = threading.Lock()
+		self.slots = threading.Semaphore(size)
+		self.fetches = 0
+		self.spawned = 0
+		self.recycled = 0
+		self.crashed = 0
+	
+	def _checkout(self):
+		"""Return idle worker or spawn a new one."""
+		with self.lock:
+			if self.idleWorkers:
+				return self.idleWorkers.pop()
+			self.spawned += 1
+		return FetchWorker()
+	
+	def fetch(self, inArgs):
+		"""Fetch in one of the workers.
+		
+		@param inArgs: FetcherInArgs instance
+		@returns: FetcherOutArgs from worker
+		@throws: HTTPFetcherError if the worker crashed during fetch
+		"""
+		with self.slots:
+			worker = self._checkout()
+			try:
+				(outArgs, retire) = worker.fetch(inArgs)
+			except HTTPFetcherError:
+				with self.lock:
+					self.crashed += 1
+				raise
+			except:
+				worker.close()
+				raise
+			
+			with self.lock:
+				self.fetches += 1
+				if retire:
+					self.recycled += 1
+				else:
+					self.idleWorkers.append(worker)
+			if retire:
+				worker.close()
+			
+			return outArgs
+	
+	def close(self):
+		"""Terminate all idle workers."""
+		with self.lock:
+			workers, self.idleWorkers = self.idleWorkers, []
+		for worker in workers:
+			worker.close()
+	
+	def statsString(self):
+		"""Return one-line summary of pool activity for logging."""
+		return "%d fetches, %d workers spawned, %d recycled, %d crashed" % (
+			self.fetches, self.spawned, self.recycled, self.crashed)
+
+_workerPool = None
+_workerPoolLock = threading.Lock()
+
+def getWorkerPool(options):
+	"""Return the process-wide FetchWorkerPool, creating it on first use.
+	
+	@param options: FetchOptions instance, workerCount is the pool size
+	"""
+	global _workerPool
+	with _workerPoolLock:
+		if _workerPool is None:
+			_workerPool = FetchWorkerPool(options.workerCount)
+		return _workerPool
+
+def closeWorkerPool():
+	"""Shut down the worker pool if it was ever started.
+	
+	@returns: the closed FetchWorkerPool or None
+	"""
+	with _workerPoolLock:
+		pool = _workerPool
+	if pool is not None:
+		pool.close()
+	return pool
+
 class HTTPFetcher(object):
 	"""Fetches HTTP(S) pages via PyCURL. CA certificates can be configured.
 	"""
 	
 	_headerRe = regex.compile(r"(?P<name>\S+?): (?P<value>.*?)\r\n")
 	
-	def __init__(self, platform, certPlatforms, fetchOptions, ruleTrie=None):
+	def __init__(self, platform, certPlatforms, fetchOptions, ruleTrie=None, scheduler=None,
+			dnsCache=None, responseCache=None, trieComplete=None):
 		"""Create fetcher that validates certificates using selected
 		platform.
 		
@@ -179,11 +859,23 @@ class HTTPFetcher(object):
 		for known platforms
 		@param ruleTrie: rules.RuleTrie to apply on URLs for following.
 		Set to None if redirects should not be rewritten
+		@param scheduler: politeness.PolitenessScheduler limiting fetches
+		per host/IP, None for no limits
+		@param dnsCache: dns_cache.DNSCache with pre-resolved hosts or None
+		@param responseCache: response_cache.ResponseCache to serve
+		responses from and store them to, None to always fetch
+		@param trieComplete: threading.Event set once all rulesets are in
+		ruleTrie; until then redirects raise TrieIncompleteError instead
+		of being rewritten. None if the trie is complete from the start.
 		"""
 		self.platformPath = certPlatforms.getCAPath(platform)
 		self.certPlatforms = certPlatforms
 		self.options = fetchOptions
 		self.ruleTrie = ruleTrie
+		self.scheduler = scheduler
+		self.dnsCache = dnsCache
+		self.responseCache = responseCache
+		self.trieComplete = trieComplete
 	
 	def idnEncodedUrl(self, url):
 		"""Encodes URL so that IDN domains are punycode-escaped. Has no
@@ -230,110 +922,144 @@ class HTTPFetcher(object):
 		
 		return newUrl
 		
+	def curlResolve(self, url):
+		"""Return CURLOPT_RESOLVE entries pinning host of URL to the
+		addresses in DNS cache, None if the host is not cached.
+		
+		@param url: IDNA-encoded URL
+		@throws HTTPFetcherError: if the host is cached as NXDOMAIN
+		"""
+		if not self.dnsCache:
+			return None
+		parsed = urlparse.urlparse(url)
+		if not parsed.hostname:
+			return None
+		entry = self.dnsCache.lookup(parsed.hostname)
+		if entry is None:
+			return None
+		if entry.isNegative():
+			raise HTTPFetcherError("Could not resolve host: %s (cached NXDOMAIN)" % parsed.hostname)
+		port = parsed.port or {"http": 80, "https": 443}.get(parsed.scheme)
+		return ["%s:%d:%s" % (parsed.hostname, port, ",".join(entry.addresses))]
+	
 	@staticmethod
-	def _doFetch(url, options, platformPath):
+	def _doFetch(url, options, platformPath, resolve=None):
 		"""
-		Fetch data from URL. If options.useSubprocess is True, spawn
-		subprocess for fetching.
+		Fetch data from URL. If options.useSubprocess is True, the fetch
+		is handed to a worker process from the fetcher worker pool.
+		Successful fetches are counted in fetchStats.
 		
 		@see HTTPFetcher.staticFetch() for parameter description
 		
 		@throws: anything staticFetch() throws
-		@throws: HTTPFetcherError in case of problem in subprocess invocation
-		@throws: cPickle.UnpicklingError when we get garbage from subprocess
+		@throws: HTTPFetcherError in case of problem with worker process
+		@throws: cPickle.UnpicklingError when we get garbage from worker
 		"""
 		if not options.useSubprocess:
-			return HTTPFetcher.staticFetch(url, options, platformPath)
+			fetched = HTTPFetcher.staticFetch(url, options, platformPath, resolve)
+			fetchStats.recordFetch(fetched)
+			return fetched
 		
-		inArgs = FetcherInArgs(url, options, platformPath)
-		
-		# Workaround for cPickle seeing module name as __main__ if we
-		# just directly executed this script.
-		# TODO: check PYTHONPATH etc if not in the same dir as script
-		# TODO: we should set the main process to be session leader
-		trampoline = 'from https_everywhere_checker import http_client; http_client.subprocessFetch()'
-		
-		# Spawn subprocess, call this module as "main" program. I tried
-		# also using python's multiprocessing module, but for some
-		# reason it was a hog on CPU and RAM (maybe due to the queues?)
-		# Also, logging module didn't play along nicely.
-		args = [sys.executable, '-c', trampoline]
-		#logging.debug("Spawning subprocess with args %s", args)
-		p = subprocess.Popen(args, stdin=subprocess.PIPE,
-			stdout=subprocess.PIPE,	stderr=subprocess.PIPE)
-		
-		# Hopefully we shouldn't deadlock here: first all data is written
-		# to subprocess's stdin, it will unpickle them first. Then we
-		# wait for resulting pickled data from stdout. In case of trouble,
-		# try using big bufsize or bufsize=-1 in Popen invocation.
-		#
-		# Doc page for subprocess says "don't use communicate() with big
-		# or unlimited data", but doesn't say what is the alternative
-		(outData, errData) = p.communicate(cPickle.dumps(inArgs))
-		exitCode = p.wait()
-		
-		if exitCode != 0:
-			raise HTTPFetcherError("Subprocess failed with exit code %d" % exitCode)
-			
-		#logging.debug("Subprocess finished OK")
-		unpickled = cPickle.loads(outData)
-		if not isinstance(unpickled, FetcherOutArgs):
-			raise HTTPFetcherError("Unexpected datatype received from subprocess: %s" % \
-				type(unpickled))
+		inArgs = FetcherInArgs(url, options, platformPath, resolve)
+		unpickled = getWorkerPool(options).fetch(inArgs)
 		if unpickled.errorStr: #chained exception tracebacks are bit ugly/long
 			assert unpickled.shortError is not None
 			raise HTTPFetcherError(ErrorSanitizer().fetcher(unpickled.shortError, unpickled.errorStr))
 			
+		fetchStats.recordFetch(unpickled)
 		return unpickled
 		
 	@staticmethod
-	def staticFetch(url, options, platformPath):
+	def configureCurl(c, url, options, platformPath, writeFunc, headerFunc, resolve=None):
+		"""Set options of PyCURL handle for fetching given URL.
+		
+		@param c: pycurl.Curl handle
+		@param url: IDNA-encoded URL
+		@param options: FetchOptions instance
+		@param platformPath: directory with platform certificates
+		@param writeFunc: callable receiving body data
+		@param headerFunc: callable receiving header data
+		@param resolve: list of CURLOPT_RESOLVE entries or None
+		"""
+		c.setopt(c.URL, url)
+		c.setopt(c.WRITEFUNCTION, writeFunc)
+		c.setopt(c.HEADERFUNCTION, headerFunc)
+		c.setopt(c.CONNECTTIMEOUT, options.connectTimeout)
+		c.setopt(c.COOKIEJAR, COOKIE_FILE_NAME)
+		c.setopt(c.COOKIEFILE, COOKIE_FILE_NAME)
+		c.setopt(c.TIMEOUT, options.readTimeout)
+		# Validation should not be disabled except for debugging
+		#c.setopt(c.SSL_VERIFYPEER, 0)
+		#c.setopt(c.SSL_VERIFYHOST, 0)
+		caBundle = options.caBundles.get(platformPath)
+		if caBundle:
+			c.setopt(c.CAINFO, caBundle)
+			#trust only the bundle, not curl's default CA directory
+			c.unsetopt(c.CAPATH)
+		else:
+			c.setopt(c.CAPATH, platformPath)
+		if options.userAgent:
+			c.setopt(c.USERAGENT, options.userAgent)
+		c.setopt(c.SSLVERSION, options.sslVersion)
+		c.setopt(c.VERBOSE, options.curlVerbose)
+		c.setopt(c.SSL_CIPHER_LIST, options.cipherList)
+		if resolve:
+			c.setopt(c.RESOLVE, resolve)
+	
+	@staticmethod
+	def staticFetch(url, options, platformPath, resolve=None):
 		"""Construct a PyCURL object and fetch given URL.
 		
 		@param url: IDNA-encoded URL
 		@param options: FetchOptions instance
 		@param platformPath: directory with platform certificates
+		@param resolve: list of CURLOPT_RESOLVE entries or None
 		@returns: FetcherOutArgs instance with fetched URL data
 		
 		@throws: anything PyCURL can throw (SSL error, timeout, etc.)
 		"""
+		pool = getHandlePool(options)
+		if pool:
+			(key, c, handleReused) = pool.checkout(url, platformPath)
+		else:
+			c = pycurl.Curl()
+			handleReused = False
+		
 		try:
 			buf = cStringIO.StringIO()
 			headerBuf = cStringIO.StringIO()
 			
-			c = pycurl.Curl()
-			c.setopt(c.URL, url)
-			c.setopt(c.WRITEFUNCTION, buf.write)
-			c.setopt(c.HEADERFUNCTION, headerBuf.write)
-			c.setopt(c.CONNECTTIMEOUT, options.connectTimeout)
-			c.setopt(c.COOKIEJAR, COOKIE_FILE_NAME)
-			c.setopt(c.COOKIEFILE, COOKIE_FILE_NAME)
-			c.setopt(c.TIMEOUT, options.readTimeout)
-			# Validation should not be disabled except for debugging
-			#c.setopt(c.SSL_VERIFYPEER, 0)
-			#c.setopt(c.SSL_VERIFYHOST, 0)
-			c.setopt(c.CAPATH, platformPath)
-			if options.userAgent:
-				c.setopt(c.USERAGENT, options.userAgent)
-			c.setopt(c.SSLVERSION, options.sslVersion)
-			c.setopt(c.VERBOSE, options.curlVerbose)
-			c.setopt(c.SSL_CIPHER_LIST, options.cipherList)
+			HTTPFetcher.configureCurl(c, url, options, platformPath,
+				buf.write, headerBuf.write, resolve)
 			c.perform()
 			
 			bufValue = buf.getvalue()
 			headerStr = headerBuf.getvalue()
 			httpCode = c.getinfo(pycurl.HTTP_CODE)
+			connectionReused = c.getinfo(pycurl.NUM_CONNECTS) == 0
+			primaryIP = c.getinfo(pycurl.PRIMARY_IP)
+		except:
+			#don't keep handles with possibly broken connections around
+			c.close()
+			raise
 		finally:
 			buf.close()
 			headerBuf.close()
+		
+		if pool:
+			pool.checkin(key, c)
+		else:
 			c.close()
 			
-		fetched = FetcherOutArgs(httpCode, bufValue, headerStr)
+		fetched = FetcherOutArgs(httpCode, bufValue, headerStr,
+			handleReused=handleReused, connectionReused=connectionReused,
+			primaryIP=primaryIP)
 		return fetched
 	
 	def fetchHtml(self, url):
 		"""Fetch HTML from given http/https URL. Return codes 301, 302,
-		303, 307 are followed, URLs rewritten using HTTPS Everywhere rules.
+		303, 307, 308 are followed, URLs rewritten using HTTPS Everywhere
+		rules.
 		
 		@param url: string URL of http(s) resource
 		@returns: tuple (httpResponseCode, htmlData)
@@ -347,8 +1073,8 @@ class HTTPFetcher(object):
 		#that platform's certs for the next fetch.
 		newUrlPlatformPath = self.platformPath
 		
-		#set of URLs seen in redirects for cycle detection
-		seenUrls = set()
+		#URLs seen in redirects for cycle detection
+		chain = RedirectChain(url)
 		
 		options = self.options
 		
@@ -356,84 +1082,228 @@ class HTTPFetcher(object):
 		#limit redirect depth
 		for depth in range(options.redirectDepth):
 			newUrl = self.idnEncodedUrl(newUrl)
-			seenUrls.add(newUrl)
+			chain.visit(newUrl)
 			
 			#override platform path detected from ruleset files
 			if options.staticCAPath:
 				newUrlPlatformPath = options.staticCAPath
-				
-			fetched = HTTPFetcher._doFetch(newUrl, options, newUrlPlatformPath)
 			
-			httpCode = fetched.httpCode
-			bufValue = fetched.data
-			headerStr = fetched.headerStr
-			
-			#shitty HTTP header parsing
-			if httpCode == 0:
-				raise HTTPFetcherError("Pycurl fetch failed for '%s'" % newUrl)
-			elif httpCode in (301, 302, 303, 307):
-				# Parse out the headers and extract location, case-insensitively.
-				# If there are multiple location headers, pick the last one.
-				headers = dict()
-				for k, v in self._headerRe.findall(headerStr):
-					headers[k.lower()] = v
-				location = headers.get('location')
-				if not location:
-					raise HTTPFetcherError("Redirect for '%s' missing Location" % newUrl)
-				
-				location = self.absolutizeUrl(newUrl, location)
-				logging.debug("Following redirect %s => %s", newUrl, location)
+			redirect = self.cachedRedirect(newUrl, newUrlPlatformPath)
+			if redirect is None:
+				fetched = None
+				if self.responseCache:
+					fetched = self.responseCache.lookup(newUrl, newUrlPlatformPath, options)
+				if fetched is None:
+					fetched = self.fetchNetwork(newUrl, newUrlPlatformPath)
+				chain.fetched(fetched)
 				
-				if self.ruleTrie:
-					ruleMatch = self.ruleTrie.transformUrl(location)
-					newUrl = ruleMatch.url
-					
-					#Platform for cert validation might have changed.
-					#Record CA path for the platform or reset if not known.
-					#Not really sure fallback to first CA platform is always
-					#correct, but it's expected that the platforms would be
-					#same as the originating site.
-					if ruleMatch.ruleset:
-						newUrlPlatformPath = self.certPlatforms.getCAPath(ruleMatch.ruleset.platform)
-					else:
-						newUrlPlatformPath = self.platformPath
-						
-					if newUrl != location:
-						logging.debug("Redirect rewritten: %s => %s", location, newUrl)
-				else:
-					newUrl = location
+				redirect = self.followRedirect(newUrl, newUrlPlatformPath, fetched)
+				if redirect is None:
+					return (fetched.httpCode, fetched.data)
 			
-				continue #fetch redirected location
-				
-			return (httpCode, bufValue)
+			newUrl, newUrlPlatformPath = redirect
 			
 		raise HTTPFetcherError("Too many redirects while fetching '%s'" % url)
+	
+	def fetchNetwork(self, url, platformPath):
+		"""Fetch single URL without following redirects, observing the
+		politeness scheduler. Result is stored in response cache.
+		Concurrent fetches of the same URL are merged into one.
+		
+		@param url: IDNA-encoded URL
+		@param platformPath: directory with platform certificates
+		@returns: FetcherOutArgs instance
+		
+		@throws: anything _doFetch() throws
+		"""
+		singleFlight = getSingleFlight(self.options)
+		if singleFlight:
+			return singleFlight.fetch(url, platformPath,
+				lambda: self._fetchNetwork(url, platformPath))
+		return self._fetchNetwork(url, platformPath)
+	
+	def _fetchNetwork(self, url, platformPath):
+		"""Fetch part of fetchNetwork() done only once per single flight."""
+		resolve = self.curlResolve(url)
+		slot = None
+		if self.scheduler:
+			slot = self.scheduler.acquire(url)
+		try:
+			fetched = HTTPFetcher._doFetch(url, self.options, platformPath, resolve)
+		finally:
+			if slot:
+				self.scheduler.release(slot)
+		if self.scheduler:
+			self.scheduler.recordIP(url, fetched.primaryIP)
+		if self.responseCache:
+			self.responseCache.store(url, platformPath, self.options, fetched)
+		return fetched
+	
+	def followRedirect(self, url, platformPath, fetched):
+		"""Process result of one fetch in a redirect chain. Return codes
+		301, 302, 303, 307, 308 are followed, location is rewritten using
+		HTTPS Everywhere rules if we have a rule trie. The hop is stored
+		in the redirect cache.
+		
+		@param url: IDNA-encoded URL that was fetched
+		@param platformPath: directory with certificates used for url
+		@param fetched: FetcherOutArgs with result of fetching url
+		@returns: None if fetched is the final response, otherwise tuple
+		(newUrl, newPlatformPath) describing next hop
+		
+		@throws HTTPFetcherError: on failed fetch/redirection
+		"""
+		httpCode = fetched.httpCode
+		headerStr = fetched.headerStr
+		
+		#shitty HTTP header parsing
+		if httpCode == 0:
+			raise HTTPFetcherError("Pycurl fetch failed for '%s'" % url)
+		elif httpCode in (301, 302, 303, 307, 308):
+			# Parse out the headers and extract location, case-insensitively.
+			# If there are multiple location headers, pick the last one.
+			headers = dict()
+			for k, v in self._headerRe.findall(headerStr):
+				headers[k.lower()] = v
+			location = headers.get('location')
+			if not location:
+				raise HTTPFetcherError("Redirect for '%s' missing Location" % url)
+			
+			location = self.absolutizeUrl(url, location)
+			logging.debug("Following redirect %s => %s", url, location)
+			
+			redirectCache = getRedirectCache(self.options)
+			if redirectCache:
+				redirectCache.record(url, platformPath, fetched, location)
+			
+			return self.rewriteRedirect(location, platformPath) #fetch redirected location
+			
+		return None
+	
+	def cachedRedirect(self, url, platformPath):
+		"""Look up hop in the redirect cache.
+		
+		@param url: IDNA-encoded URL to be fetched
+		@param platformPath: directory with certificates used for url
+		@returns: None if the hop is not cached, otherwise tuple (newUrl,
+		newPlatformPath) like followRedirect()
+		"""
+		redirectCache = getRedirectCache(self.options)
+		if not redirectCache:
+			return None
+		location = redirectCache.lookup(url, platformPath)
+		if location is None:
+			return None
+		logging.debug("Following cached redirect %s => %s", url, location)
+		return self.rewriteRedirect(location, platformPath)
+	
+	def rewriteRedirect(self, location, platformPath):
+		"""Rewrite redirect location using rule trie if we have one.
+		
+		@param location: absolute URL from Location header
+		@param platformPath: directory with certificates of the redirecting
+		hop
+		@returns: tuple (newUrl, newPlatformPath)
+		
+		@throws TrieIncompleteError: if the rule trie is still being built
+		"""
+		if not self.ruleTrie:
+			return (location, platformPath)
+		if self.trieComplete is not None and not self.trieComplete.is_set():
+			raise TrieIncompleteError("Rule trie incomplete, can't rewrite redirect to '%s'" % location)
+		
+		ruleMatch = self.ruleTrie.transformUrl(location)
+		newUrl = ruleMatch.url
+		
+		#Platform for cert validation might have changed.
+		#Record CA path for the platform or reset if not known.
+		#Not really sure fallback to first CA platform is always
+		#correct, but it's expected that the platforms would be
+		#same as the originating site.
+		if ruleMatch.ruleset:
+			newUrlPlatformPath = self.certPlatforms.getCAPath(ruleMatch.ruleset.platform)
+		else:
+			newUrlPlatformPath = self.platformPath
+			
+		if newUrl != location:
+			logging.debug("Redirect rewritten: %s => %s", location, newUrl)
+		
+		return (newUrl, newUrlPlatformPath)
+
 
+def _writeFrame(fd, data):
+	"""Write one length-prefixed frame to file object fd."""
+	fd.write(struct.pack("!I", len(data)))
+	fd.write(data)
+	fd.flush()
 
-def subprocessFetch():
+def _readFrame(fd):
+	"""Read one length-prefixed frame from file object fd. Returns None on
+	EOF, e.g. when the other side of the pipe died.
 	"""
-	Used for invocation in fetcher subprocess. Reads cPickled FetcherInArgs
-	from stdin and write FetcherOutArgs to stdout. Implementation of the
-	subprocess URL fetch.
+	header = fd.read(4)
+	if len(header) < 4:
+		return None
+	(length,) = struct.unpack("!I", header)
+	data = fd.read(length)
+	if len(data) < length:
+		return None
+	return data
+
+def subprocessFetchLoop():
+	"""
+	Used for invocation in fetcher worker process. Reads framed cPickled
+	FetcherInArgs from stdin and writes framed (FetcherOutArgs, retire)
+	tuples to stdout until stdin is closed. Worker retires itself (sets
+	retire flag and exits after the reply) after serving
+	options.workerMaxFetches fetches or when its RSS grows above
+	options.workerMaxRSS megabytes.
 	"""
-	outArgs = None
-	
-	try:
-		inArgs = cPickle.load(sys.stdin)
-		inArgs.check()
-		outArgs = HTTPFetcher.staticFetch(inArgs.url, inArgs.options, inArgs.platformPath)
-	except BaseException,e: #this will trap KeyboardInterrupt as well
-		errorStr = traceback.format_exc()
-		shortError = str(e)
-		outArgs = FetcherOutArgs(errorStr=errorStr, shortError=shortError)
-
-	if outArgs is None:
-		shortError = "Subprocess logic error - no output args"
-		errorStr = traceback.format_exception_only(HTTPFetcherError,
-			HTTPFetcherError(shortError))
-		outArgs = FetcherOutArgs(errorStr=errorStr, shortError=shortError)
-	
-	try:
-		cPickle.dump(outArgs, sys.stdout)
-	except:
-		cPickle.dump(None, sys.stdout) #catch-all case
+	#keep the pipe to parent for frames only, anything printed by libraries
+	#ends up on stderr
+	out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+	os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+	fetchCount = 0
+	
+	while True:
+		frame = _readFrame(sys.stdin)
+		if frame is None:
+			break
+		
+		outArgs = None
+		retire = False
+		attempted = False
+		try:
+			inArgs = cPickle.loads(frame)
+			inArgs.check()
+			#failed fetches count too, a worker that keeps failing is recycled
+			fetchCount += 1
+			attempted = True
+			outArgs = HTTPFetcher.staticFetch(inArgs.url, inArgs.options,
+				inArgs.platformPath, inArgs.resolve)
+		except BaseException,e: #this will trap KeyboardInterrupt as well
+			errorStr = traceback.format_exc()
+			shortError = str(e)
+			outArgs = FetcherOutArgs(errorStr=errorStr, shortError=shortError)
+		
+		if attempted:
+			#ru_maxrss is in kilobytes on Linux
+			rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+			retire = fetchCount >= inArgs.options.workerMaxFetches or \
+				rss >= inArgs.options.workerMaxRSS
+		
+		if outArgs is None:
+			shortError = "Subprocess logic error - no output args"
+			errorStr = traceback.format_exception_only(HTTPFetcherError,
+				HTTPFetcherError(shortError))
+			outArgs = FetcherOutArgs(errorStr=errorStr, shortError=shortError)
+		
+		try:
+			data = cPickle.dumps((outArgs, retire), cPickle.HIGHEST_PROTOCOL)
+		except:
+			data = cPickle.dumps((None, True)) #catch-all case
+			retire = True
+		_writeFrame(out, data)
+		
+		if retire:
+			break
@@ -0,0 +1,384 @@
+import collections
+import cStringIO
+import logging
+import sys
+import threading
+import time
+import Queue
+
+import pycurl
+
+from http_client import HTTPFetcher, HTTPFetcherError, FetcherOutArgs, \
+	CurlHandlePool, RedirectChain, fetchStats, getSingleFlight
+
+## Event-driven fetch engine
+#
+# Instead of one blocking pycurl.Curl.perform() per thread, a single thread
+# drives all transfers through one pycurl.CurlMulti. Each submitted fetch is
+# a MultiTransfer that walks its redirect chain hop by hop (using
+# HTTPFetcher.followRedirect, so redirects are rewritten by the rule trie the
+# same way as in HTTPFetcher.fetchHtml). Time spent waiting on slow TLS
+# handshakes and timeouts then overlaps for thousands of transfers.
+#
+# All curl calls and completion callbacks run in the engine thread, so the
+# threading bugs of openssl/gnutls+curl don't apply and callbacks have to be
+# short (hand off heavy work to other threads).
+
+class MultiTransfer(object):
+	"""State of one fetchHtml-like request driven by MultiFetchEngine."""
+
+	def __init__(self, fetcher, url, callback):
+		"""
+		@param fetcher: HTTPFetcher whose platform and rule trie are used
+		@param url: string URL of http(s) resource
+		@param callback: called as callback(result, error) when done
+		"""
+		self.fetcher = fetcher
+		self.origUrl = url
+		self.url = url
+		#While going through 301/302 redirects we might encounter URL
+		#that was rewritten using different platform and need to use
+		#that platform's certs for the next fetch.
+		self.platformPath = fetcher.platformPath
+		self.depth = 0
+		#URLs seen in redirects for cycle detection
+		self.chain = RedirectChain(url)
+		self.callback = callback
+		self.buf = None
+		self.headerBuf = None
+		#politeness scheduler slot while a hop is in flight, limiter that
+		#deferred the hop and since when
+		self.slot = None
+		self.blocker = None
+		self.waitStart = None
+		#single flight led by this transfer's current hop
+		self.flight = None
+
+class MultiFetchEngine(threading.Thread):
+	"""Fetches many URLs concurrently over one pycurl.CurlMulti."""
+
+	#max time to wait in select() before looking at newly submitted
+	#transfers, in seconds
+	selectTimeout = 0.05
+
+	def __init__(self, options):
+		"""
+		@param options: FetchOptions instance; maxTransfers limits the
+		number of transfers in flight
+		"""
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self.options = options
+		self.multi = pycurl.CurlMulti()
+		self.submitted = Queue.Queue()
+		self.waiting = collections.deque()
+		#transfers refused by politeness scheduler, retried every round
+		self.deferred = []
+		#transfers whose hop was fetched by another transfer, as
+		#(transfer, flight) tuples; appended from any thread
+		self.resumed = []
+		self.resumedLock = threading.Lock()
+		self.singleFlight = getSingleFlight(options)
+		#multi handle keeps its own connection cache, the pool keeps
+		#TLS sessions partitioned per SNI name
+		self.handlePool = None
+		if options.connectionPool:
+			self.handlePool = CurlHandlePool(options.maxIdleHandles)
+		self.active = 0
+		self.transfers = 0
+		self.hops = 0
+		self.peakActive = 0
+
+	def fetchHtmlAsync(self, fetcher, url, callback):
+		"""Start fetching URL, following redirects like
+		HTTPFetcher.fetchHtml. Can be called from any thread.
+
+		@param fetcher: HTTPFetcher to take platform and rule trie from
+		@param url: string URL of http(s) resource
+		@param callback: called from engine thread as
+		callback(result, error); result is tuple (httpResponseCode,
+		htmlData) if error is None, otherwise error is the exception
+		HTTPFetcher.fetchHtml would have raised
+		"""
+		self.submitted.put(MultiTransfer(fetcher, url, callback))
+
+	def fetchHtml(self, fetcher, url):
+		"""Blocking variant of fetchHtmlAsync, must not be called from
+		the engine thread.
+
+		@returns: tuple (httpResponseCode, htmlData)
+		"""
+		done = threading.Event()
+		outcome = []
+
+		def callback(result, error):
+			outcome.append((result, error))
+			done.set()
+
+		self.fetchHtmlAsync(fetcher, url, callback)
+		done.wait()
+
+		(result, error) = outcome[0]
+		if error is not None:
+			raise error
+		return result
+
+	def _finish(self, transfer, result, error):
+		"""Report outcome of transfer to its callback."""
+		try:
+			transfer.callback(result, error)
+		except Exception, e:
+			logging.exception(e)
+
+	def _startHop(self, transfer):
+		"""Add curl handle fetching transfer's current URL."""
+		options = self.options
+		if transfer.depth >= options.redirectDepth:
+			self._finish(transfer, None, HTTPFetcherError(
+				"Too many redirects while fetching '%s'" % transfer.origUrl))
+			return
+
+		#deferred hops were visited and looked up in caches already
+		firstAttempt = transfer.chain.hops == transfer.depth
+		try:
+			transfer.url = transfer.fetcher.idnEncodedUrl(transfer.url)
+			if firstAttempt:
+				transfer.chain.visit(transfer.url)
+			resolve = transfer.fetcher.curlResolve(transfer.url)
+		except Exception, e:
+			self._finish(transfer, None, e)
+			return
+
+		#override platform path detected from ruleset files
+		if options.staticCAPath:
+			transfer.platformPath = options.staticCAPath
+
+		if firstAttempt:
+			try:
+				redirect = transfer.fetcher.cachedRedirect(transfer.url, transfer.platformPath)
+			except Exception, e:
+				self._finish(transfer, None, e)
+				return
+			if redirect is not None:
+				self._nextHop(transfer, redirect)
+				return
+
+		responseCache = transfer.fetcher.responseCache
+		if responseCache and firstAttempt:
+			fetched = responseCache.lookup(transfer.url, transfer.platformPath, options)
+			if fetched is not None:
+				self._hopFetched(transfer, fetched)
+				return
+
+		if self.singleFlight and transfer.flight is None:
+			(flight, leader) = self.singleFlight.claim(transfer.url, transfer.platformPath)
+			if not leader:
+				self.singleFlight.addWaiter(flight,
+					lambda flight: self._resume(transfer, flight))
+				return
+			transfer.flight = flight
+
+		scheduler = transfer.fetcher.scheduler
+		if scheduler:
+			(slot, blocker, kind) = scheduler.tryAcquire(transfer.url)
+			if slot is None:
+				if transfer.blocker is None:
+					transfer.blocker = (blocker, kind)
+					transfer.waitStart = time.time()
+				self.deferred.append(transfer)
+				return
+			if transfer.blocker:
+				(blocker, kind) = transfer.blocker
+				scheduler.addWait(blocker, kind, time.time() - transfer.waitStart)
+				transfer.blocker = None
+			transfer.slot = slot
+
+		c = None
+		try:
+			if self.handlePool:
+				(key, c, handleReused) = self.handlePool.checkout(transfer.url, transfer.platformPath)
+			else:
+				(key, c, handleReused) = (None, pycurl.Curl(), False)
+			c.poolKey = key
+			c.handleReused = handleReused
+			transfer.buf = cStringIO.StringIO()
+			transfer.headerBuf = cStringIO.StringIO()
+			#setopt fails e.g. on unicode URLs that aren't ASCII
+			HTTPFetcher.configureCurl(c, transfer.url, options, transfer.platformPath,
+				transfer.buf.write, transfer.headerBuf.write, resolve)
+			c.transfer = transfer
+			self.multi.add_handle(c)
+		except Exception:
+			self._abortHop(transfer, c, sys.exc_info())
+			return
+
+		self.active += 1
+		self.hops += 1
+		self.peakActive = max(self.peakActive, self.active)
+
+	def _abortHop(self, transfer, c, excInfo):
+		"""Fail transfer whose curl handle couldn't be set up, release what
+		_startHop acquired for it.
+
+		@param c: curl handle or None if there is none yet
+		@param excInfo: sys.exc_info() of the failure
+		"""
+		if c is not None:
+			c.transfer = None
+			c.close()
+		if transfer.slot:
+			transfer.fetcher.scheduler.release(transfer.slot)
+			transfer.slot = None
+		if transfer.flight:
+			flight, transfer.flight = transfer.flight, None
+			self.singleFlight.finish(flight, excInfo=excInfo)
+		self._finish(transfer, None, excInfo[1])
+
+	def _hopDone(self, c, errno=None, errmsg=None):
+		"""Handle finished curl handle - either follow redirect or
+		complete the transfer.
+		"""
+		transfer = c.transfer
+		self.multi.remove_handle(c)
+		self.active -= 1
+		scheduler = transfer.fetcher.scheduler
+		if transfer.slot:
+			scheduler.release(transfer.slot)
+			transfer.slot = None
+
+		fetched = None
+		if errno is None:
+			fetched = FetcherOutArgs(c.getinfo(pycurl.HTTP_CODE),
+				transfer.buf.getvalue(), transfer.headerBuf.getvalue(),
+				handleReused=c.handleReused,
+				connectionReused=c.getinfo(pycurl.NUM_CONNECTS) == 0,
+				primaryIP=c.getinfo(pycurl.PRIMARY_IP))
+		transfer.buf.close()
+		transfer.headerBuf.close()
+		c.transfer = None
+
+		if fetched is None or not self.handlePool:
+			#don't keep handles with possibly broken connections around
+			c.close()
+		else:
+			self.handlePool.checkin(c.poolKey, c)
+
+		error = None
+		if fetched is None:
+			error = pycurl.error(errno, errmsg)
+		if transfer.flight:
+			flight, transfer.flight = transfer.flight, None
+			if error:
+				self.singleFlight.finish(flight, excInfo=(pycurl.error, error, None))
+			else:
+				self.singleFlight.finish(flight, fetched)
+		if error:
+			self._finish(transfer, None, error)
+			return
+
+		fetchStats.recordFetch(fetched)
+		if scheduler:
+			scheduler.recordIP(transfer.url, fetched.primaryIP)
+		if transfer.fetcher.responseCache:
+			transfer.fetcher.responseCache.store(transfer.url, transfer.platformPath,
+				self.options, fetched)
+		self._hopFetched(transfer, fetched)
+
+	def _hopFetched(self, transfer, fetched):
+		"""Follow redirect of fetched hop or complete the transfer."""
+		transfer.chain.fetched(fetched)
+		try:
+			redirect = transfer.fetcher.followRedirect(transfer.url,
+				transfer.platformPath, fetched)
+		except Exception, e:
+			self._finish(transfer, None, e)
+			return
+
+		if redirect is None:
+			self._finish(transfer, (fetched.httpCode, fetched.data), None)
+			return
+
+		self._nextHop(transfer, redirect)
+
+	def _nextHop(self, transfer, redirect):
+		"""Continue transfer with redirect target.
+
+		@param redirect: tuple (newUrl, newPlatformPath)
+		"""
+		transfer.url, transfer.platformPath = redirect
+		transfer.depth += 1
+		self._startHop(transfer)
+
+	def _resume(self, transfer, flight):
+		"""Queue transfer whose hop was fetched by another transfer to
+		continue in engine thread.
+		"""
+		with self.resumedLock:
+			self.resumed.append((transfer, flight))
+		#wake up engine if it's idle
+		self.submitted.put(None)
+
+	def _admit(self):
+		"""Move submitted transfers to curl while under the limit."""
+		#block if there is nothing to do
+		if not self.active and not self.waiting and not self.deferred:
+			self.waiting.append(self.submitted.get())
+
+		try:
+			while True:
+				self.waiting.append(self.submitted.get_nowait())
+		except Queue.Empty:
+			pass
+		#drop wake-ups from _resume()
+		if None in self.waiting:
+			self.waiting = collections.deque(t for t in self.waiting if t is not None)
+
+		with self.resumedLock:
+			resumed, self.resumed = self.resumed, []
+		for (transfer, flight) in resumed:
+			try:
+				fetched = flight.outcome()
+			except Exception, e:
+				self._finish(transfer, None, e)
+				continue
+			self._hopFetched(transfer, fetched)
+
+		deferred, self.deferred = self.deferred, []
+		for transfer in deferred:
+			self._startHop(transfer)
+
+		while self.waiting and \
+				self.active + len(self.deferred) < self.options.maxTransfers:
+			self.transfers += 1
+			self._startHop(self.waiting.popleft())
+
+	def run(self):
+		while True:
+			try:
+				self._admit()
+
+				while True:
+					ret, numHandles = self.multi.perform()
+					if ret != pycurl.E_CALL_MULTI_PERFORM:
+						break
+
+				while True:
+					numQueued, okList, errList = self.multi.info_read()
+					for c in okList:
+						self._hopDone(c)
+					for c, errno, errmsg in errList:
+						self._hopDone(c, errno, errmsg)
+					if numQueued == 0:
+						break
+
+				if self.active:
+					self.multi.select(self.selectTimeout)
+				elif self.deferred:
+					time.sleep(self.selectTimeout)
+			except Exception, e:
+				logging.exception(e)
+
+	def statsString(self):
+		"""Return one-line summary of engine activity for logging."""
+		return "%d transfers, %d requests, peak %d in flight" % (
+			self.transfers, self.hops, self.peakActive)
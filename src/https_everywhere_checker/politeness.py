@@ -0,0 +1,241 @@
+import itertools
+import threading
+import time
+import urlparse
+import Queue
+
+## Per-host politeness
+#
+# Fetching many URLs of one CDN or shared host at once gets us throttled
+# (429s, connection resets) and those show up as false "fetch-error"s. The
+# PolitenessScheduler enforces concurrency caps and request rates per host
+# name and per IP address for every fetch, including redirect hops. IP
+# addresses are learned from finished fetches (or fed from a DNS cache), so
+# the per-IP limits don't cost extra lookups.
+#
+# PoliteQueue is put between the task producer and comparison threads. It
+# hands out work whose host has spare capacity first, so threads don't sit
+# blocked on one busy host while other hosts' work is waiting.
+
+class Limiter(object):
+	"""Concurrency cap and token bucket rate limit of one host or IP."""
+
+	def __init__(self, name, maxActive, rate):
+		"""
+		@param name: host name or IP address, for reporting
+		@param maxActive: max concurrent fetches, 0 means unlimited
+		@param rate: max fetches per second, 0 means unlimited
+		"""
+		self.name = name
+		self.maxActive = maxActive
+		self.rate = rate
+		self.burst = max(1.0, rate)
+		self.tokens = self.burst
+		self.stamp = time.time()
+		self.active = 0
+		self.capWait = 0.0
+		self.rateWait = 0.0
+
+	def atCap(self):
+		"""True iff another concurrent fetch is not allowed now."""
+		return self.maxActive and self.active >= self.maxActive
+
+	def rateDelay(self, now):
+		"""Seconds until a token is available, 0 if available now."""
+		if not self.rate:
+			return 0
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+
+	def take(self):
+		"""Start a fetch, caller checked atCap() and rateDelay()."""
+		self.active += 1
+		if self.rate:
+			self.tokens -= 1
+
+	def addWait(self, kind, seconds):
+		"""Account time spent waiting on this limiter.
+
+		@param kind: "cap" or "rate"
+		"""
+		if kind == "cap":
+			self.capWait += seconds
+		else:
+			self.rateWait += seconds
+
+	def totalWait(self):
+		return self.capWait + self.rateWait
+
+class PolitenessScheduler(object):
+	"""Limits fetches per host name and per IP address."""
+
+	def __init__(self, maxPerHost, maxPerIP, hostRate, ipRate):
+		"""
+		@param maxPerHost: max concurrent fetches per host, 0 = unlimited
+		@param maxPerIP: max concurrent fetches per IP, 0 = unlimited
+		@param hostRate: max fetches per second per host, 0 = unlimited
+		@param ipRate: max fetches per second per IP, 0 = unlimited
+		"""
+		self.maxPerHost = maxPerHost
+		self.maxPerIP = maxPerIP
+		self.hostRate = hostRate
+		self.ipRate = ipRate
+		self.cond = threading.Condition()
+		self.hostLimiters = {}
+		self.ipLimiters = {}
+		self.hostIPs = {}
+
+	@staticmethod
+	def fromOptions(options):
+		"""Create scheduler from FetchOptions, None if no limit is set."""
+		limits = (options.maxPerHost, options.maxPerIP, options.hostRate, options.ipRate)
+		if not any(limits):
+			return None
+		return PolitenessScheduler(*limits)
+
+	@staticmethod
+	def hostname(url):
+		return (urlparse.urlparse(url).hostname or "").lower()
+
+	def recordIP(self, url, ip):
+		"""Remember IP address that host of URL resolved to."""
+		self.recordHostIP(self.hostname(url), ip)
+
+	def recordHostIP(self, host, ip):
+		"""Remember IP address that host resolved to."""
+		if ip:
+			with self.cond:
+				self.hostIPs[host.lower()] = ip
+
+	def _limiters(self, host):
+		"""Limiters that apply to host, must be called with lock held."""
+		hostLimiter = self.hostLimiters.get(host)
+		if hostLimiter is None:
+			hostLimiter = Limiter(host, self.maxPerHost, self.hostRate)
+			self.hostLimiters[host] = hostLimiter
+		limiters = [hostLimiter]
+
+		ip = self.hostIPs.get(host)
+		if ip:
+			ipLimiter = self.ipLimiters.get(ip)
+			if ipLimiter is None:
+				ipLimiter = Limiter(ip, self.maxPerIP, self.ipRate)
+				self.ipLimiters[ip] = ipLimiter
+			limiters.append(ipLimiter)
+
+		return limiters
+
+	def _tryTake(self, limiters, now):
+		"""Take slot in all limiters if possible.
+
+		@returns: tuple (blockingLimiter, kind, delay); blockingLimiter is
+		None if the slot was taken. Delay is None when waiting on a cap.
+		"""
+		for limiter in limiters:
+			if limiter.atCap():
+				return (limiter, "cap", None)
+		for limiter in limiters:
+			delay = limiter.rateDelay(now)
+			if delay > 0:
+				return (limiter, "rate", delay)
+		for limiter in limiters:
+			limiter.take()
+		return (None, None, 0)
+
+	def acquire(self, url):
+		"""Block until fetch of URL is allowed.
+
+		@returns: slot to be passed to release()
+		"""
+		host = self.hostname(url)
+		with self.cond:
+			while True:
+				limiters = self._limiters(host)
+				start = time.time()
+				(blocker, kind, delay) = self._tryTake(limiters, start)
+				if blocker is None:
+					return limiters
+				self.cond.wait(delay)
+				blocker.addWait(kind, time.time() - start)
+
+	def tryAcquire(self, url):
+		"""Non-blocking variant of acquire.
+
+		@returns: tuple (slot, blocker, kind); slot is None if the fetch
+		is not allowed now, blocker is the Limiter that refused it and kind
+		is "cap" or "rate"
+		"""
+		host = self.hostname(url)
+		with self.cond:
+			limiters = self._limiters(host)
+			(blocker, kind, delay) = self._tryTake(limiters, time.time())
+			if blocker is None:
+				return (limiters, None, None)
+			return (None, blocker, kind)
+
+	def addWait(self, blocker, kind, seconds):
+		"""Account wait time of a fetch refused by tryAcquire."""
+		with self.cond:
+			blocker.addWait(kind, seconds)
+
+	def release(self, slot):
+		"""Finish fetch started by acquire() or tryAcquire()."""
+		with self.cond:
+			for limiter in slot:
+				limiter.active -= 1
+			self.cond.notify_all()
+
+	def admissible(self, url):
+		"""Cheap check whether fetch of URL would start without waiting
+		on the host limiter. Nothing is reserved.
+		"""
+		host = self.hostname(url)
+		with self.cond:
+			limiter = self.hostLimiters.get(host)
+			if limiter is None:
+				return True
+			return not limiter.atCap() and limiter.rateDelay(time.time()) == 0
+
+	def statsString(self, top=10):
+		"""Return summary of time spent waiting on limiters for logging."""
+		with self.cond:
+			limiters = [("host", l) for l in self.hostLimiters.values()] + \
+				[("IP", l) for l in self.ipLimiters.values()]
+			hostWait = sum(l.totalWait() for l in self.hostLimiters.values())
+			ipWait = sum(l.totalWait() for l in self.ipLimiters.values())
+			busiest = sorted((item for item in limiters if item[1].totalWait() > 0),
+				key=lambda item: item[1].totalWait(), reverse=True)[:top]
+
+		lines = ["waited %.2f s on host limits, %.2f s on IP limits" % (hostWait, ipWait)]
+		for (what, limiter) in busiest:
+			lines.append("  %s %s: %.2f s on concurrency, %.2f s on rate" % (
+				what, limiter.name, limiter.capWait, limiter.rateWait))
+		return "\n".join(lines)
+
+class PoliteQueue(Queue.Queue):
+	"""Task queue that prefers items whose host has spare capacity in the
+	PolitenessScheduler, so that workers stay busy with other hosts' work.
+	"""
+
+	def __init__(self, maxsize, scheduler, urlFunc, lookahead=100):
+		"""
+		@param scheduler: PolitenessScheduler instance
+		@param urlFunc: returns URL of a queued item
+		@param lookahead: max number of queued items examined per get()
+		"""
+		Queue.Queue.__init__(self, maxsize)
+		self.scheduler = scheduler
+		self.urlFunc = urlFunc
+		self.lookahead = lookahead
+
+	def _get(self):
+		items = itertools.islice(self.queue, self.lookahead)
+		for (index, item) in enumerate(items):
+			if self.scheduler.admissible(self.urlFunc(item)):
+				del self.queue[index]
+				return item
+		#everything is busy, fetch will wait in scheduler
+		return self.queue.popleft()
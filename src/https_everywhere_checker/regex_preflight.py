@@ -0,0 +1,177 @@
+import signal
+import threading
+
+import regex
+
+from rules import compiledPatterns, literalPrefixes
+
+## Regex preflight
+#
+# Rule and exclusion patterns are third-party input for the backtracking
+# regex module. One pattern like (a|aa)+$ matched against a URL of the
+# wrong shape keeps a thread busy for minutes, and with it the whole run.
+# The regex module can't be interrupted from another thread and its own
+# timeout argument doesn't work on Python 2, so patterns are vetted once at
+# load time, in the (main thread of the) process parsing the ruleset:
+#
+# 1. backtrackingRisk() flags groups repeated by an unbounded quantifier
+#    that themselves contain an unbounded quantifier or alternatives - the
+#    shapes behind exponential backtracking.
+# 2. Flagged patterns are searched in probe strings made of the pattern's
+#    literal prefixes and long runs of characters it may repeat, under a
+#    SIGALRM timer. Patterns that don't finish within the budget are
+#    reported as regex errors and their ruleset is not loaded, so no
+#    worker ever evaluates them.
+
+#length of the repeated part of probe strings
+_probeLength = 40
+
+#characters repeated in probes besides literal ones of the pattern
+_probeUnits = ("a", "0", ".", "-", "/", "_", "a.", "a-", "a/", "0.")
+
+class BudgetExceeded(Exception):
+	"""Raised by the SIGALRM handler when a probe runs out of time."""
+	pass
+
+def _raiseBudgetExceeded(signum, frame):
+	raise BudgetExceeded()
+
+def _quantifierAt(pattern, i):
+	"""Return (unbounded, index after quantifier) for quantifier at index
+	i, None if there is none. Lazy and possessive suffixes are skipped.
+	"""
+	c = pattern[i:i+1]
+	if c in ("*", "+"):
+		unbounded = True
+		i += 1
+	elif c == "?":
+		unbounded = False
+		i += 1
+	elif c == "{":
+		m = regex.match(r"\{(\d*)(,(\d*))?\}", pattern[i:])
+		if m is None:
+			return None
+		unbounded = bool(m.group(2)) and not m.group(3)
+		i += m.end()
+	else:
+		return None
+	if pattern[i:i+1] in ("?", "+"):
+		i += 1
+	return (unbounded, i)
+
+def backtrackingRisk(pattern):
+	"""Look for a group repeated by *, + or {n,} that contains an unbounded
+	quantifier or alternatives, like (\\w+\\.?)+ or (a|aa)*.
+
+	@returns: the repeated group as a string or None if there is none
+	"""
+	#per open group: [start index, contains unbounded quantifier, contains |]
+	stack = [[0, False, False]]
+	i = 0
+	while i < len(pattern):
+		c = pattern[i]
+		if c == "\\":
+			i += 2
+			quantified = True
+		elif c == "[":
+			#skip character set, leading ] (after ^) is a member
+			i += 1
+			if pattern[i:i+1] == "^":
+				i += 1
+			if pattern[i:i+1] == "]":
+				i += 1
+			while i < len(pattern) and pattern[i] != "]":
+				i += 2 if pattern[i] == "\\" else 1
+			i += 1
+			quantified = True
+		elif c == "(":
+			stack.append([i, False, False])
+			i += 1
+			continue
+		elif c == ")" and len(stack) > 1:
+			(start, innerUnbounded, innerAlternation) = stack.pop()
+			i += 1
+			quantifier = _quantifierAt(pattern, i)
+			if quantifier and quantifier[0] and (innerUnbounded or innerAlternation):
+				return pattern[start:quantifier[1]]
+			if innerUnbounded or (quantifier and quantifier[0]):
+				stack[-1][1] = True
+			if quantifier:
+				i = quantifier[1]
+			continue
+		elif c == "|":
+			stack[-1][2] = True
+			i += 1
+			continue
+		else:
+			i += 1
+			quantified = True
+		if quantified:
+			quantifier = _quantifierAt(pattern, i)
+			if quantifier:
+				if quantifier[0]:
+					stack[-1][1] = True
+				i = quantifier[1]
+	return None
+
+def probeStrings(pattern):
+	"""Return strings likely to make a backtracking-prone pattern explore
+	many paths: a literal prefix of the pattern followed by a long run of
+	one unit and optionally a character that makes the match fail.
+	"""
+	prefixes = sorted(literalPrefixes(pattern))[:3]
+	units = list(_probeUnits)
+	for c in pattern:
+		if c.isalnum() and c not in units and len(units) < len(_probeUnits) + 10:
+			units.append(c)
+	probes = []
+	for prefix in prefixes:
+		for unit in units:
+			run = unit * (_probeLength // len(unit))
+			probes.append(prefix + run + "!")
+			probes.append(prefix + run)
+	return probes
+
+def probePattern(pattern, group, budget):
+	"""Search probe strings with a backtracking-prone pattern within time
+	budget. Only works in the main thread, elsewhere nothing is probed.
+
+	@param group: backtrackingRisk() of the pattern, for the message
+	@param budget: seconds all probes of the pattern may take together
+	@returns: error message or None if the pattern finished in time
+	"""
+	if not isinstance(threading.current_thread(), threading._MainThread):
+		return None
+	compiled = compiledPatterns.get(pattern)
+	previous = signal.signal(signal.SIGALRM, _raiseBudgetExceeded)
+	#restart system calls of other threads if the timer fires
+	signal.siginterrupt(signal.SIGALRM, False)
+	try:
+		signal.setitimer(signal.ITIMER_REAL, budget)
+		try:
+			for probe in probeStrings(pattern):
+				compiled.search(probe)
+		finally:
+			signal.setitimer(signal.ITIMER_REAL, 0)
+	except BudgetExceeded:
+		return "Pattern %s exceeded time budget of %.2f s, backtracking in %s" % (
+			pattern, budget, group)
+	finally:
+		signal.signal(signal.SIGALRM, previous)
+	return None
+
+def checkRuleset(ruleset, budget):
+	"""Probe all backtracking-prone rule and exclusion patterns of ruleset.
+
+	@param budget: seconds the probes of each pattern may take
+	@returns: list of tuples (pattern, error message or None if it
+	finished in time)
+	"""
+	patterns = [rule.fromPattern for rule in ruleset.rules] + \
+		[exclusion.exclusionPattern for exclusion in ruleset.exclusions]
+	risks = []
+	for pattern in patterns:
+		group = backtrackingRisk(pattern)
+		if group is not None:
+			risks.append((pattern, probePattern(pattern, group, budget)))
+	return risks
@@ -0,0 +1,274 @@
+import collections
+import cPickle
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from http_client import FetcherOutArgs, setsCookie
+
+## Persistent response cache
+#
+# Rulesets are often tuned by rerunning the checker many times a day against
+# the same sites. ResponseCache stores fetched responses on disk so repeated
+# runs don't download every page again.
+#
+# Entries are keyed by URL, CA platform path and the fetch options that
+# change what a server returns (user agent, SSL version, cipher list). Every
+# hop of a redirect chain is cached separately, so redirects are still
+# rewritten by the current rule trie. Bodies are stored by their SHA-256, so
+# identical pages (error pages, parked domains) are kept only once:
+#
+#   <directory>/index.pickle        - OrderedDict key -> CacheEntry, LRU order
+#   <directory>/objects/ab/abcd...  - response bodies
+#
+# Only responses with status codes 2xx-4xx are stored, so a temporary
+# server outage is not replayed for the whole TTL.
+#
+# The index is written on close(). Bodies left over from a run that didn't
+# close the cache are removed when it's opened next time.
+
+class CacheEntry(object):
+	"""Cached response of one fetch."""
+
+	def __init__(self, bodyHash, size, httpCode, headerStr, expires):
+		"""
+		@param bodyHash: hex SHA-256 of the body
+		@param size: body length in bytes
+		@param httpCode: HTTP status code
+		@param headerStr: raw response headers
+		@param expires: time.time() value when the entry stops being valid
+		"""
+		self.bodyHash = bodyHash
+		self.size = size
+		self.httpCode = httpCode
+		self.headerStr = headerStr
+		self.expires = expires
+
+class ResponseCache(object):
+	"""On-disk content-addressed cache of HTTP responses with per-entry
+	TTL and LRU eviction by total body size.
+	"""
+
+	indexName = "index.pickle"
+
+	def __init__(self, directory, ttl=86400, maxSize=1024*1024*1024, bypass=False):
+		"""
+		@param directory: cache directory, created if it does not exist
+		@param ttl: seconds a stored response stays valid
+		@param maxSize: max total size of stored bodies in bytes
+		@param bypass: if True, lookups always miss but fresh responses
+		are still stored
+		"""
+		self.directory = directory
+		self.ttl = ttl
+		self.maxSize = maxSize
+		self.bypass = bypass
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		self.index = collections.OrderedDict()
+		#body hash -> number of index entries referring to it
+		self.refs = collections.Counter()
+		self.totalSize = 0
+
+		objectDir = os.path.join(directory, "objects")
+		if not os.path.isdir(objectDir):
+			os.makedirs(objectDir)
+		self._loadIndex()
+		self._removeOrphans()
+
+	@staticmethod
+	def fromConfig(config):
+		"""Create cache from [cache] section of config, None if the
+		section has no directory set.
+
+		@param config: ConfigParser object
+		"""
+		if not config.has_option("cache", "directory"):
+			return None
+		cache = ResponseCache(config.get("cache", "directory"))
+		if config.has_option("cache", "ttl"):
+			cache.ttl = config.getint("cache", "ttl")
+		if config.has_option("cache", "max_size"):
+			cache.maxSize = config.getint("cache", "max_size") * 1024 * 1024
+		if config.has_option("cache", "bypass"):
+			cache.bypass = config.getboolean("cache", "bypass")
+		return cache
+
+	@staticmethod
+	def cacheKey(url, platformPath, options):
+		"""Return key of response to URL fetched with given CA platform
+		and FetchOptions.
+		"""
+		keyStr = repr((url, platformPath, options.userAgent,
+			options.sslVersion, options.cipherList))
+		return hashlib.sha256(keyStr).hexdigest()
+
+	def bodyPath(self, bodyHash):
+		return os.path.join(self.directory, "objects", bodyHash[:2], bodyHash)
+
+	def _loadIndex(self):
+		"""Read index from disk, dropping expired entries and entries whose
+		body is missing.
+		"""
+		indexPath = os.path.join(self.directory, self.indexName)
+		try:
+			with open(indexPath, "rb") as f:
+				index = cPickle.load(f)
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				logging.warn("Could not read response cache index: %s", e)
+			return
+		except Exception, e:
+			logging.warn("Response cache index is corrupt, starting empty: %s", e)
+			return
+
+		now = time.time()
+		for (key, entry) in index.iteritems():
+			if entry.expires < now or not os.path.exists(self.bodyPath(entry.bodyHash)):
+				continue
+			self._addEntry(key, entry)
+
+	def _removeOrphans(self):
+		"""Delete body files not referenced from the index."""
+		objectDir = os.path.join(self.directory, "objects")
+		for (dirpath, dirnames, filenames) in os.walk(objectDir):
+			for fname in filenames:
+				if fname not in self.refs:
+					self._unlink(os.path.join(dirpath, fname))
+
+	def _unlink(self, path):
+		try:
+			os.unlink(path)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				logging.warn("Could not remove cached body %s: %s", path, e)
+
+	def _addEntry(self, key, entry):
+		"""Insert entry as most recently used, must be called with lock
+		held (or from constructor).
+		"""
+		if self.refs[entry.bodyHash] == 0:
+			self.totalSize += entry.size
+		self.refs[entry.bodyHash] += 1
+		self.index[key] = entry
+
+	def _removeEntry(self, key):
+		"""Remove entry and its body if nothing else refers to it, must be
+		called with lock held.
+		"""
+		self._releaseBody(self.index.pop(key))
+
+	def _releaseBody(self, entry):
+		"""Drop reference of removed entry to its body."""
+		self.refs[entry.bodyHash] -= 1
+		if self.refs[entry.bodyHash] == 0:
+			del self.refs[entry.bodyHash]
+			self.totalSize -= entry.size
+			self._unlink(self.bodyPath(entry.bodyHash))
+
+	def lookup(self, url, platformPath, options):
+		"""Return cached response for URL.
+
+		@returns: FetcherOutArgs instance or None on miss
+		"""
+		key = self.cacheKey(url, platformPath, options)
+		with self.lock:
+			entry = self.index.get(key)
+			if self.bypass or entry is None:
+				self.misses += 1
+				return None
+			if entry.expires < time.time():
+				self._removeEntry(key)
+				self.misses += 1
+				return None
+			#mark as most recently used
+			del self.index[key]
+			self.index[key] = entry
+			try:
+				with open(self.bodyPath(entry.bodyHash), "rb") as f:
+					data = f.read()
+			except IOError, e:
+				logging.warn("Could not read cached body of %s: %s", url, e)
+				self._removeEntry(key)
+				self.misses += 1
+				return None
+			self.hits += 1
+
+		return FetcherOutArgs(entry.httpCode, data, entry.headerStr)
+
+	def store(self, url, platformPath, options, fetched):
+		"""Store successfully fetched response to URL. Server errors are
+		not stored, they are often transient.
+
+		@param fetched: FetcherOutArgs instance
+		"""
+		if not 200 <= fetched.httpCode < 500:
+			return
+		#replaying it would not set the cookie the next hop expects
+		if setsCookie(fetched):
+			return
+		bodyHash = hashlib.sha256(fetched.data).hexdigest()
+		entry = CacheEntry(bodyHash, len(fetched.data), fetched.httpCode,
+			fetched.headerStr, time.time() + self.ttl)
+		if entry.size > self.maxSize:
+			return
+		key = self.cacheKey(url, platformPath, options)
+
+		with self.lock:
+			if self.refs[bodyHash] == 0 and not self._writeBody(bodyHash, fetched.data):
+				return
+			oldEntry = self.index.pop(key, None)
+			self._addEntry(key, entry)
+			#after adding the new entry, so a shared body is not deleted
+			if oldEntry is not None:
+				self._releaseBody(oldEntry)
+
+			while self.totalSize > self.maxSize:
+				self._removeEntry(next(iter(self.index)))
+				self.evictions += 1
+
+	def _writeBody(self, bodyHash, data):
+		"""Write body file atomically, returns False on error."""
+		path = self.bodyPath(bodyHash)
+		dirname = os.path.dirname(path)
+		try:
+			if not os.path.isdir(dirname):
+				os.makedirs(dirname)
+			(fd, tmpPath) = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+			with os.fdopen(fd, "wb") as f:
+				f.write(data)
+			os.rename(tmpPath, path)
+		except (IOError, OSError), e:
+			logging.warn("Could not write cached body %s: %s", path, e)
+			return False
+		return True
+
+	def close(self):
+		"""Write index to disk."""
+		indexPath = os.path.join(self.directory, self.indexName)
+		with self.lock:
+			try:
+				(fd, tmpPath) = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+				with os.fdopen(fd, "wb") as f:
+					cPickle.dump(self.index, f, cPickle.HIGHEST_PROTOCOL)
+				os.rename(tmpPath, indexPath)
+			except (IOError, OSError), e:
+				logging.error("Could not write response cache index: %s", e)
+
+	def hitRatio(self):
+		"""Fraction of lookups served from cache."""
+		lookups = self.hits + self.misses
+		return float(self.hits) / lookups if lookups else 0.0
+
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		return "%d hits, %d misses, %d evictions, %d entries, %.1f MB stored" % (
+			self.hits, self.misses, self.evictions, len(self.index),
+			self.totalSize / (1024.0 * 1024))
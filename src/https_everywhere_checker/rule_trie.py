@@ -1,3 +1,5 @@
+import collections
+import threading
 import urlparse
 import os.path
 from gvgen import GvGen
@@ -42,6 +44,17 @@ from gvgen import GvGen
 # of N parts is O(N) if there are no * in the tree. Otherwise in theory
 # it could be O(2^N), but the HTTPS Everywhere rules require only one *, so we
 # still get O(N).
+#
+# Lookups don't walk the tree though. RuleTrie keeps a flat index of the same
+# targets: wildcard-free targets in a dict keyed by the FQDN, targets with
+# wildcards grouped by (label count, wildcard positions) in dicts keyed by
+# the reversed label tuple with "*" at those positions. A lookup encodes the
+# FQDN once and does one dict lookup per group, of which there are only a
+# handful. A target of k labels matches FQDN of n labels iff every label
+# matches (equal or "*") and either k == n, or k < n and the target's
+# left-most label is a "*" at depth >= 3 - exactly the matches of the tree
+# walk in DomainNode.matchingRulesets. The DomainNode tree is built from the
+# index on demand, for graphviz dumps and pretty printing.
 
 class RuleTransformError(ValueError):
 	"""Thrown when invalid scheme like file:/// is attempted to be
@@ -52,21 +65,43 @@ class RuleTransformError(ValueError):
 class DomainNode(object):
 	"""Node of suffix trie for searching of applicable rulesets."""
 	
+	__slots__ = ("subDomain", "rulesets", "children", "depth")
+	
 	def __init__(self, subDomain, rulesets, depth):
 		"""Create instance for part of FQDN.
-		@param subDomain: part of FQDN between "dots"
-		@param rulesets: rules.Ruleset list that applies for this node in tree
+		@param subDomain: part of FQDN between "dots", interned since
+		labels like "www" and "com" repeat all over the tree
+		@param rulesets: tuple of rules.Ruleset that apply for this node
+		in tree
 		"""
-		self.subDomain = subDomain
+		self.subDomain = intern(subDomain)
 		self.rulesets = rulesets
-		self.children = {} #map of subdomain to instance of DomainNode
-		self.gvNode = None #node for graphing with graphviz
+		#map of subdomain to instance of DomainNode, None for leaves
+		self.children = None
 		self.depth = depth #depth in tree, root is at depth 0
 	
 	def addChild(self, subNode):
 		"""Add DomainNode for more-specific subdomains of this one."""
+		if self.children is None:
+			self.children = {}
 		self.children[subNode.subDomain] = subNode
 	
+	def getChild(self, subDomain):
+		"""Return child DomainNode for subdomain or None."""
+		if self.children is None:
+			return None
+		return self.children.get(subDomain)
+	
+	def childNodes(self):
+		"""Return list of child DomainNodes."""
+		if self.children is None:
+			return []
+		return self.children.values()
+	
+	def addRuleset(self, ruleset):
+		"""Add ruleset applying to this node."""
+		self.rulesets += (ruleset,)
+	
 	def matchingRulesets(self, domain):
 		"""Find matching rulesets for domain in this subtree.
 		@param domain: domain to search for in this node's subtrees;
@@ -106,8 +141,8 @@ class DomainNode(object):
 		else:
 			subLevelDomain, childDomain = parts
 		
-		wildcardChild = self.children.get("*")
-		ruleChild = self.children.get(childDomain)
+		wildcardChild = self.getChild("*")
+		ruleChild = self.getChild(childDomain)
 		
 		#we need to consider direct matches as well as wildcard matches so
 		#that match for things like "bla.google.*" work
@@ -122,41 +157,54 @@ class DomainNode(object):
 		"""Pretty print for debugging"""
 		print " "*offset,
 		print unicode(self)
-		for child in self.children.values():
+		for child in self.childNodes():
 			child.prettyPrint(offset+3)
 	
-	def makeSubdomainEdge(self, graph, parent, child):
+	def gvNode(self, graph, gvNodes):
+		"""Return node of graph for this DomainNode, created if not yet
+		existing.
+		
+		@param graph: gvgen.GvGen object
+		@param gvNodes: dict DomainNode -> graph node, kept for the time
+		of generating the graph only
+		"""
+		gvNode = gvNodes.get(self)
+		if gvNode is None:
+			# the "or" part so that root has some name
+			gvNode = graph.newItem(self.subDomain or "<root>")
+			graph.propertyAppend(gvNode, "shape", "octagon")
+			gvNodes[self] = gvNode
+		return gvNode
+	
+	def makeSubdomainEdge(self, graph, parent, child, gvNodes):
 		"""Make edge in graph of parent domain to child subdomain.
 		GvGen nodes are created if not yet existing.
 		
 		@param graph: gvgen.GvGen object
 		@param parent: parent DomainNode
 		@param child: child DomainNode
+		@param gvNodes: see gvNode()
 		"""
-		if not child.gvNode:
-			child.gvNode = graph.newItem(child.subDomain)
-			graph.propertyAppend(child.gvNode, "shape", "octagon")
-		if not parent.gvNode:
-			# the "or" part so that root has some name
-			parent.gvNode = graph.newItem(parent.subDomain or "<root>")
-			graph.propertyAppend(parent.gvNode, "shape", "octagon")
-			
-		graph.newLink(parent.gvNode, child.gvNode)
+		childGvNode = child.gvNode(graph, gvNodes)
+		graph.newLink(parent.gvNode(graph, gvNodes), childGvNode)
 	
-	def generateGraphizGraph(self, graph):
+	def generateGraphizGraph(self, graph, gvNodes=None):
 		"""Return tree as a GvGen object that can be output to dot file.
 		
 		@param graph: gvgen.GvGen object
+		@param gvNodes: see gvNode()
 		"""
-		for child in self.children.values():
-			self.makeSubdomainEdge(graph, self, child)
-			child.generateGraphizGraph(graph)
+		if gvNodes is None:
+			gvNodes = {}
+		for child in self.childNodes():
+			self.makeSubdomainEdge(graph, self, child, gvNodes)
+			child.generateGraphizGraph(graph, gvNodes)
 			
 		for ruleset in self.rulesets:
 			rulesetGvNode = graph.newItem(os.path.basename(ruleset.filename))
 			graph.propertyAppend(rulesetGvNode, "shape", "rectangle")
 			graph.propertyAppend(rulesetGvNode, "color", "green")
-			graph.newLink(self.gvNode, rulesetGvNode)
+			graph.newLink(self.gvNode(graph, gvNodes), rulesetGvNode)
 	
 	def __str__(self):
 		return "<DomainNode for '%s', rulesets: %s>" % (self.subDomain, self.rulesets)
@@ -165,6 +213,50 @@ class DomainNode(object):
 		return "<DomainNode for '%s>" % (self.subDomain,)
 
 
+class LRUCache(object):
+	"""Bounded thread-safe mapping that evicts least recently used
+	entries, with hit/miss counters.
+	"""
+	
+	def __init__(self, maxSize):
+		"""
+		@param maxSize: max number of entries
+		"""
+		self.maxSize = maxSize
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key, default=None):
+		"""Return value for key and mark it most recently used."""
+		with self.lock:
+			try:
+				value = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			self.entries[key] = value
+			self.hits += 1
+			return value
+	
+	def put(self, key, value):
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = value
+			if len(self.entries) > self.maxSize:
+				self.entries.popitem(last=False)
+	
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+	
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		lookups = self.hits + self.misses
+		return "%d hits, %d misses (%.1f%%), %d entries" % (self.hits, self.misses,
+			100.0 * self.hits / lookups if lookups else 0.0, len(self.entries))
+
 class RuleMatch(object):
 	"""Result of a rule match, contains transformed url and ruleset that
 	matched (might be None if no match was found).
@@ -180,41 +272,130 @@ class RuleMatch(object):
 		self.ruleset = ruleset
 	
 class RuleTrie(object):
-	"""Suffix trie for rulesets."""
+	"""Suffix trie for rulesets, looked up through a flat index."""
 	
-	def __init__(self):
-		self.root = DomainNode("", [], 0)
+	def __init__(self, cacheSize=0):
+		"""
+		@param cacheSize: number of FQDN -> rulesets and URL -> RuleMatch
+		results kept in LRU caches each, 0 to turn caching off. Cached
+		results are dropped whenever a ruleset is added.
+		"""
+		#wildcard-free target -> tuple of rulesets
+		self.exactTargets = {}
+		#(label count, wildcard positions) -> dict reversed label tuple of
+		#target -> tuple of rulesets; positions index the reversed tuple
+		self.wildcardTargets = {}
+		self._root = None
+		self.hostCache = None
+		self.urlCache = None
+		if cacheSize > 0:
+			self.hostCache = LRUCache(cacheSize)
+			self.urlCache = LRUCache(cacheSize)
+	
+	@property
+	def root(self):
+		"""Root DomainNode of the tree, built from the index when needed."""
+		if self._root is None:
+			root = DomainNode("", (), 0)
+			for (target, rulesets) in self.exactTargets.iteritems():
+				self._addToTree(root, target.split("."), rulesets)
+			for targets in self.wildcardTargets.itervalues():
+				for (labels, rulesets) in targets.iteritems():
+					self._addToTree(root, reversed(labels), rulesets)
+			self._root = root
+		return self._root
+	
+	@staticmethod
+	def _addToTree(root, parts, rulesets):
+		"""Add nodes for target given as list of labels to the tree, the
+		rulesets are stored in the leaf.
+		"""
+		#enumerate parts so we know when we hit leaf where
+		#rulesets are to be stored
+		parts = list(enumerate(parts))
+		node = root
+		depth = 0
+		
+		for (idx, part) in reversed(parts):
+			depth += 1
+			partNode = node.getChild(part)
+			
+			#create node if not existing already and stuff
+			#the rulesets in leaf
+			if not partNode:
+				partNode = DomainNode(part, (), depth)
+				node.addChild(partNode)
+			if idx == 0:
+				for ruleset in rulesets:
+					partNode.addRuleset(ruleset)
+			
+			node = partNode
 	
 	def matchingRulesets(self, fqdn):
 		"""Return rulesets applicable for FQDN. Wildcards not allowed.
+		
+		@return: set of applicable rulesets, must not be modified
 		"""
-		return self.root.matchingRulesets(fqdn)
+		if self.hostCache is None:
+			return self._matchingRulesets(fqdn)
+		applicable = self.hostCache.get(fqdn)
+		if applicable is None:
+			applicable = self._matchingRulesets(fqdn)
+			self.hostCache.put(fqdn, applicable)
+		return applicable
+	
+	def _matchingRulesets(self, fqdn):
+		"""Look up FQDN in the index, see matchingRulesets()."""
+		if fqdn == "":
+			return set()
+		#make sure domain is in ASCII - either "plain old domain" or
+		#punycode-encoded IDN domain
+		if not isinstance(fqdn, unicode):
+			fqdn = fqdn.decode("utf-8")
+		fqdn = fqdn.encode("idna")
+		
+		applicable = set(self.exactTargets.get(fqdn, ()))
+		if not self.wildcardTargets:
+			return applicable
+		
+		labels = fqdn.split(".")
+		labels.reverse()
+		count = len(labels)
+		for ((targetCount, positions), targets) in self.wildcardTargets.iteritems():
+			if targetCount == count:
+				key = labels[:]
+			elif 3 <= targetCount < count and positions[-1] == targetCount - 1:
+				#left-most "*" of target covers the remaining labels
+				key = labels[:targetCount]
+			else:
+				continue
+			for position in positions:
+				key[position] = "*"
+			rulesets = targets.get(tuple(key))
+			if rulesets:
+				applicable.update(rulesets)
+		return applicable
 	
 	def addRuleset(self, ruleset):
 		"""Creates structure for given ruleset in the trie.
 		@param ruleset: rules.Ruleset instance
 		"""
+		self._root = None
+		if self.hostCache is not None:
+			self.hostCache.clear()
+			self.urlCache.clear()
 		for target in ruleset.targets:
-			node = self.root
-			#enumerate parts so we know when we hit leaf where
-			#rulesets are to be stored
-			parts = list(enumerate(target.split(".")))
-			depth = 0
-			
-			for (idx, part) in reversed(parts):
-				depth += 1
-				partNode = node.children.get(part)
-				
-				#create node if not existing already and stuff
-				#the rulesets in leaf
-				if not partNode:
-					partNode = DomainNode(part, [], depth)
-					node.addChild(partNode)
-				if idx == 0:
-					#there should be only one ruleset, but...
-					partNode.rulesets.append(ruleset)
-				
-				node = partNode
+			labels = target.split(".")
+			labels.reverse()
+			positions = tuple(idx for (idx, label) in enumerate(labels) if label == "*")
+			if not positions:
+				#there should be only one ruleset, but...
+				target = intern(target)
+				self.exactTargets[target] = self.exactTargets.get(target, ()) + (ruleset,)
+				continue
+			labels = tuple(intern(label) for label in labels)
+			targets = self.wildcardTargets.setdefault((len(labels), positions), {})
+			targets[labels] = targets.get(labels, ()) + (ruleset,)
 	
 	def acceptedScheme(self, url):
 		"""Returns True iff the scheme in URL is accepted (http, https).
@@ -228,22 +409,51 @@ class RuleTrie(object):
 		as the matching ruleset.
 		
 		@returns: RuleMatch with tranformed URL and ruleset that applied
+		@throws: RuleTransformError if scheme is wrong (e.g. file:///)
+		"""
+		if self.urlCache is None:
+			return self._transformUrl(url)
+		ruleMatch = self.urlCache.get(url)
+		if ruleMatch is None:
+			ruleMatch = self._transformUrl(url)
+			self.urlCache.put(url, ruleMatch)
+		return ruleMatch
+	
+	def _transformUrl(self, url):
+		"""Rewrite URL without the URL cache, see transformUrl()."""
+		return self.applyRulesets(url, self.matchingRulesets(self.urlHost(url)))
+	
+	def urlHost(self, url):
+		"""Return host part of URL that rulesets are looked up by.
+		
 		@throws: RuleTransformError if scheme is wrong (e.g. file:///)
 		"""
 		parsed = urlparse.urlparse(url)
 		if parsed.scheme not in ("http", "https"):
 			raise RuleTransformError("Unknown scheme '%s' in '%s'" % \
 				(parsed.scheme, url))
-			
-		fqdn = parsed.netloc.lower()
-		matching = self.matchingRulesets(fqdn)
+		return parsed.netloc.lower()
+	
+	def applyRulesets(self, url, rulesets):
+		"""Apply first of rulesets that rewrites URL.
 		
-		for ruleset in matching:
+		@param rulesets: matchingRulesets() of urlHost() of the URL
+		@returns: RuleMatch, its ruleset is None if none rewrote the URL
+		"""
+		for ruleset in rulesets:
 			newUrl = ruleset.apply(url)
 			if newUrl != url:
 				return RuleMatch(newUrl, ruleset)
 		return RuleMatch(url, None)
 	
+	def cacheStatsString(self):
+		"""Return one-line summary of the LRU caches for logging, None if
+		caching is off.
+		"""
+		if self.hostCache is None:
+			return None
+		return "hosts %s; URLs %s" % (self.hostCache.statsString(), self.urlCache.statsString())
+	
 	def generateGraphizGraph(self):
 		"""Return graphviz graph of this trie.
 		
@@ -1,34 +1,330 @@
+import threading
+import time
+
 import regex
 
+## Memory layout
+#
+# The full corpus is tens of thousands of rulesets held for the whole run
+# (and in every loader worker), so the model classes use __slots__ instead
+# of per-instance dicts, keep collections in tuples and intern repeating
+# strings - platform names, targets and their labels in the rule trie.
+#
+# Rules and exclusions compile their pattern on first use, through the
+# PatternTable shared by the process, so a pattern repeated across
+# rulesets (catch-alls like ^http: in particular) is compiled and held once.
+
+#interning table for unicode strings, intern() only takes str in Python 2
+_unicodeInterned = {}
+
+def internString(s):
+	"""Return canonical instance of string s."""
+	if isinstance(s, str):
+		return intern(s)
+	return _unicodeInterned.setdefault(s, s)
+
+class PatternTable(object):
+	"""Compiled regexes by pattern, shared by all rules and exclusions.
+	Thread-safe, patterns are compiled outside of the lock.
+	"""
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.compiled = {}
+		#patterns compiled and time it took
+		self.compiles = 0
+		self.compileTime = 0.0
+		#lookups of already compiled patterns
+		self.shared = 0
+		#part of the counters above reported by worker processes
+		self.workerCompiles = 0
+	
+	def get(self, pattern):
+		"""Return compiled pattern, compiling it on first request.
+		
+		@throws regex.error: if the pattern is invalid
+		"""
+		with self.lock:
+			compiled = self.compiled.get(pattern)
+			if compiled is not None:
+				self.shared += 1
+				return compiled
+		start = time.time()
+		compiled = regex.compile(pattern)
+		elapsed = time.time() - start
+		with self.lock:
+			self.compiles += 1
+			self.compileTime += elapsed
+			return self.compiled.setdefault(pattern, compiled)
+	
+	def counters(self):
+		"""Return tuple (compiles, compileTime, shared)."""
+		with self.lock:
+			return (self.compiles, self.compileTime, self.shared)
+	
+	def countersSince(self, before):
+		"""Return work done since counters() returned before, for passing
+		it from a worker process to addWorkerCounters() of the parent.
+		"""
+		return tuple(now - then for (now, then) in zip(self.counters(), before))
+	
+	def addWorkerCounters(self, counters):
+		"""Add work of a worker process to the statistics.
+		
+		@param counters: countersSince() output of the worker
+		"""
+		(compiles, compileTime, shared) = counters
+		with self.lock:
+			self.compiles += compiles
+			self.compileTime += compileTime
+			self.shared += shared
+			self.workerCompiles += compiles
+	
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		stats = "%d patterns compiled in %.2f seconds, %d duplicates shared" % (
+			self.compiles, self.compileTime, self.shared)
+		if self.workerCompiles:
+			stats += " (%d compiled in worker processes)" % self.workerCompiles
+		return stats
+
+#PatternTable of this process
+compiledPatterns = PatternTable()
+
+#constructs that change meaning when a pattern becomes a branch of a bigger
+#pattern: backreferences, named groups, conditionals and inline flags (which
+#apply to the whole pattern). Only (?:, (?=, (?!, (?<= and (?<! are allowed.
+_uncombinableRe = regex.compile(r"\\[1-9]|\\g<|\(\?(?![:=!]|<[=!])")
+
+def _hasTopLevelAlternation(pattern):
+	"""True iff pattern contains | outside of groups and character sets."""
+	depth = 0
+	inSet = False
+	i = 0
+	while i < len(pattern):
+		c = pattern[i]
+		if c == "\\":
+			i += 2
+			continue
+		if inSet:
+			if c == "]":
+				inSet = False
+		elif c == "[":
+			inSet = True
+			#leading ] (after optional ^) is a literal member of the set
+			if pattern[i+1:i+2] == "^":
+				i += 1
+			if pattern[i+1:i+2] == "]":
+				i += 1
+		elif c == "(":
+			depth += 1
+		elif c == ")":
+			depth -= 1
+		elif c == "|" and depth == 0:
+			return True
+		i += 1
+	return False
+
+#inline flags like (?i) or (?i:...) may change what a literal matches
+_inlineFlagsRe = regex.compile(r"\(\?[a-zA-Z-]+[:)]")
+
+#quantifiers that make the preceding literal or group optional or repeated
+_quantifiers = ("?", "*", "+", "{")
+
+#most prefixes returned by literalPrefixes(), optional groups double them
+_maxPrefixes = 16
+
+def _literalAt(pattern, i):
+	"""Return (literal character, index after it) if pattern has a literal
+	character at index i, None otherwise.
+	"""
+	c = pattern[i]
+	if c == "\\":
+		escaped = pattern[i+1:i+2]
+		if not escaped or escaped.isalnum():
+			return None
+		return (escaped, i + 2)
+	if c in ".[]^$*+?{|()":
+		return None
+	return (c, i + 1)
+
+def _literalAlternatives(pattern, i):
+	"""Parse group starting at index i, made only of literal alternatives
+	like (www\\.|) or (?:de|en)\\.
+
+	@returns: (list of alternatives, index after the group) or None if the
+	group contains anything else
+	"""
+	i += 1
+	if pattern.startswith("?:", i):
+		i += 2
+	alternatives = [""]
+	while i < len(pattern):
+		c = pattern[i]
+		if c == ")":
+			return (alternatives, i + 1)
+		if c == "|":
+			alternatives.append("")
+			i += 1
+			continue
+		literal = _literalAt(pattern, i)
+		if literal is None or pattern[literal[1]:literal[1]+1] in _quantifiers:
+			return None
+		alternatives[-1] += literal[0]
+		i = literal[1]
+	return None
+
+def literalPrefixes(pattern):
+	"""Return tuple of strings such that every string pattern matches
+	starts with one of them, so strings starting with none of them can
+	skip the regex.
+	
+	Prefixes are collected from literal characters and groups of literal
+	alternatives, optionally followed by ?, of patterns anchored with ^.
+	Patterns that are not anchored, contain | outside of groups or use
+	inline flags give ("",), which every string starts with.
+	"""
+	anything = ("",)
+	if not pattern.startswith("^") or _hasTopLevelAlternation(pattern) or \
+			_inlineFlagsRe.search(pattern):
+		return anything
+	
+	prefixes = [""]
+	i = 1
+	while i < len(pattern):
+		if pattern[i] == "(":
+			group = _literalAlternatives(pattern, i)
+			if group is None:
+				break
+			(alternatives, end) = group
+			if pattern[end:end+1] == "?":
+				alternatives.append("")
+				end += 1
+				if pattern[end:end+1] in ("?", "+"):
+					end += 1
+			elif pattern[end:end+1] in _quantifiers:
+				break
+			if len(prefixes) * len(alternatives) > _maxPrefixes:
+				break
+			prefixes = [prefix + alternative for prefix in prefixes
+				for alternative in alternatives]
+			i = end
+			continue
+		literal = _literalAt(pattern, i)
+		if literal is None or pattern[literal[1]:literal[1]+1] in _quantifiers:
+			break
+		prefixes = [prefix + literal[0] for prefix in prefixes]
+		i = literal[1]
+	
+	try:
+		#str prefixes, startswith() of a non-ASCII str URL would try to
+		#decode it with unicode ones
+		return tuple(set(intern(str(prefix)) for prefix in prefixes))
+	except UnicodeError:
+		return anything
+
+class CombinedMatcher(object):
+	"""Single regex telling which of several patterns is the first one, in
+	order of the patterns, that search() would find in a string.
+	
+	Every pattern becomes a branch of one alternation matched at the start
+	of the string and ending with an empty group tagging the branch.
+	Patterns anchored with ^ are used as they are, others are wrapped in a
+	lookahead that searches the whole string. Branches are tried in order,
+	so the tag of the first searchable pattern is reported.
+	"""
+	
+	__slots__ = ("combinedRe",)
+	
+	def __init__(self, patterns):
+		"""
+		@param patterns: list of regex patterns
+		@throws ValueError: if the patterns can't be combined
+		"""
+		branches = []
+		for (index, pattern) in enumerate(patterns):
+			if _uncombinableRe.search(pattern):
+				raise ValueError("Pattern can't be combined: %s" % pattern)
+			if pattern.startswith("^") and not _hasTopLevelAlternation(pattern):
+				branch = "(?:%s)" % pattern
+			else:
+				branch = "(?=[\\s\\S]*?(?:%s))" % pattern
+			branches.append("%s(?P<m%d>)" % (branch, index))
+		try:
+			self.combinedRe = regex.compile("|".join(branches))
+		except Exception, e:
+			raise ValueError("Patterns can't be combined: %s" % e)
+	
+	def firstMatch(self, s):
+		"""Return index of first pattern found in s, None if none is."""
+		m = self.combinedRe.match(s)
+		if m is None:
+			return None
+		return int(m.lastgroup[1:])
+
 class Rule(object):
 	"""Represents one from->to rule element."""
 	
+	__slots__ = ("fromPattern", "toPattern", "_fromRe", "_prefixes", "tests")
+	
 	def __init__(self, ruleElem):
 		"""Convert one <rule> element.
 		@param: etree <rule>Element
 		"""
 		attrs = ruleElem.attrib
-		self.fromPattern = attrs["from"]
+		self.fromPattern = internString(attrs["from"])
 		#Switch $1, $2... JS capture patterns to Python \g<1>, \g<2>...
 		#The \g<1> named capture is used instead of \1 because it would
 		#break for rules whose domain begins with a digit.
-		self.toPattern = regex.sub(r"\$(\d)", r"\\g<\1>", attrs["to"])
-		self.fromRe = regex.compile(self.fromPattern)
-		# Test cases that this rule applies to.
-		self.tests = []
+		self.toPattern = internString(regex.sub(r"\$(\d)", r"\\g<\1>", attrs["to"]))
+		#compiled on first use, see Ruleset.compilePatterns()
+		self._fromRe = None
+		self._prefixes = None
+		# Test cases that this rule applies to, filled by coverage check.
+		self.tests = ()
+	
+	@staticmethod
+	def fromPatterns(fromPattern, toPattern):
+		"""Create rule from patterns of an already validated rule, see
+		Ruleset.describe(). The regex is compiled on first use.
+		
+		@param toPattern: replacement in Python \\g<1> syntax
+		"""
+		rule = Rule.__new__(Rule)
+		rule.fromPattern = internString(fromPattern)
+		rule.toPattern = internString(toPattern)
+		rule._fromRe = None
+		rule._prefixes = None
+		rule.tests = ()
+		return rule
+	
+	@property
+	def fromRe(self):
+		if self._fromRe is None:
+			self._fromRe = compiledPatterns.get(self.fromPattern)
+		return self._fromRe
+	
+	@property
+	def prefixes(self):
+		"""literalPrefixes() of the from pattern."""
+		if self._prefixes is None:
+			self._prefixes = literalPrefixes(self.fromPattern)
+		return self._prefixes
 	
 	def apply(self, url):
 		"""Apply rule to URL string and return result."""
+		if not url.startswith(self.prefixes):
+			return url
 		return self.fromRe.sub(self.toPattern, url)
 
 	def matches(self, url):
 		"""Returns true iff this rule matches given url
 		@param url: URL to check as string
 		"""
-		return self.fromRe.search(url) is not None
+		return url.startswith(self.prefixes) and self.fromRe.search(url) is not None
 	
 	def __repr__(self):
-		return "<Rule from '%s' to '%s'>" % (self.fromRe.pattern, self.toPattern)
+		return "<Rule from '%s' to '%s'>" % (self.fromPattern, self.toPattern)
 	
 	def __str__(self):
 		return self.__repr__()
@@ -46,20 +342,49 @@ class Rule(object):
 class Exclusion(object):
 	"""Exclusion rule for <exclusion pattern=""> element"""
 	
+	__slots__ = ("exclusionPattern", "_exclusionRe", "_prefixes", "tests")
+	
 	def __init__(self, exclusionElem):
 		"""Create instance from <exclusion> element
 		@param exclusionElem: <exclusion> element from lxml tree
 		"""
-		self.exclusionPattern = exclusionElem.attrib["pattern"]
-		self.exclusionRe = regex.compile(self.exclusionPattern)
-		# Test cases that this exclusion applies to.
-		self.tests = []
+		self.exclusionPattern = internString(exclusionElem.attrib["pattern"])
+		#compiled on first use, see Ruleset.compilePatterns()
+		self._exclusionRe = None
+		self._prefixes = None
+		# Test cases that this exclusion applies to, filled by coverage check.
+		self.tests = ()
+	
+	@staticmethod
+	def fromPattern(exclusionPattern):
+		"""Create exclusion from pattern of an already validated exclusion,
+		see Ruleset.describe(). The regex is compiled on first use.
+		"""
+		exclusion = Exclusion.__new__(Exclusion)
+		exclusion.exclusionPattern = internString(exclusionPattern)
+		exclusion._exclusionRe = None
+		exclusion._prefixes = None
+		exclusion.tests = ()
+		return exclusion
+	
+	@property
+	def exclusionRe(self):
+		if self._exclusionRe is None:
+			self._exclusionRe = compiledPatterns.get(self.exclusionPattern)
+		return self._exclusionRe
+	
+	@property
+	def prefixes(self):
+		"""literalPrefixes() of the exclusion pattern."""
+		if self._prefixes is None:
+			self._prefixes = literalPrefixes(self.exclusionPattern)
+		return self._prefixes
 	
 	def matches(self, url):
 		"""Returns true iff this exclusion rule matches given url
 		@param url: URL to check as string
 		"""
-		return self.exclusionRe.search(url) is not None
+		return url.startswith(self.prefixes) and self.exclusionRe.search(url) is not None
 
 	def __repr__(self):
 		return "<Exclusion pattern '%s'>" % (self.exclusionPattern)
@@ -68,6 +393,8 @@ class Exclusion(object):
 class Test(object):
 	"""A test case from a <test url=""> element"""
 	
+	__slots__ = ("url",)
+	
 	def __init__(self, url):
 		"""Create instance from <test> element
 		@param exclusionElem: <test> element from lxml tree
@@ -77,17 +404,27 @@ class Test(object):
 class Ruleset(object):
 	"""Represents one XML ruleset file."""
 	
+	__slots__ = ("name", "platform", "defaultOff", "rules", "targets", "exclusions",
+		"filename", "tests", "contents", "_matcher", "_prefixes")
+	
+	#find the first matching exclusion or rule with one CombinedMatcher
+	#per ruleset instead of searching the patterns one by one
+	useCombinedMatcher = True
+	
 	#extracts value of first attribute in list as a string
 	_strAttr = lambda attrList: unicode(attrList[0])
 	
+	#like _strAttr for values shared by many rulesets
+	_internedAttr = lambda attrList: internString(unicode(attrList[0]))
+	
 	#extract attribute value and decode to ASCII with IDN punycode encoding
-	_idnAttrs = lambda attrList: tuple(unicode(attr).encode("idna") for attr in attrList)
+	_idnAttrs = lambda attrList: tuple(intern(unicode(attr).encode("idna")) for attr in attrList)
 	
 	#convert each etree Element of list into Rule
-	_rulesConvert = lambda elemList: [Rule(elem) for elem in elemList]
+	_rulesConvert = lambda elemList: tuple(Rule(elem) for elem in elemList)
 	
 	#convert each etree Element of list into Exclusion
-	_exclusionConvert = lambda elemList: [Exclusion(elem) for elem in elemList]
+	_exclusionConvert = lambda elemList: tuple(Exclusion(elem) for elem in elemList)
 
 	_testConvert = lambda elemList: [Test(elem.attrib["url"]) for elem in elemList]
 	
@@ -96,8 +433,8 @@ class Ruleset(object):
 	#(attribute name in this class, XPath expression, conversion function into value)
 	_attrConvert = [
 		("name",	"@name", 		_strAttr),
-		("platform",	"@platform", 		_strAttr),
-		("defaultOff",	"@default_off", 	_strAttr),
+		("platform",	"@platform", 		_internedAttr),
+		("defaultOff",	"@default_off", 	_internedAttr),
 		("targets",	"target/@host",		_idnAttrs),
 		("rules",	"rule", 		_rulesConvert),
 		("exclusions",	"exclusion", 		_exclusionConvert),
@@ -117,11 +454,17 @@ class Ruleset(object):
 		self.name = None
 		self.platform = "default"
 		self.defaultOff = None
-		self.rules = []
-		self.targets = []
-		self.exclusions = []
+		self.rules = ()
+		self.targets = ()
+		self.exclusions = ()
 		self.filename = filename
 		self.tests = []
+		#raw XML the ruleset was parsed from, kept by the loader only if
+		#the file may be rewritten
+		self.contents = None
+		#CombinedMatcher, False if not usable, None until first used
+		self._matcher = None
+		self._prefixes = None
 		
 		for (attrName, xpath, conversion) in self._attrConvert:
 			elems = root.xpath(xpath)
@@ -129,9 +472,100 @@ class Ruleset(object):
 				setattr(self, attrName, conversion(elems))
 			
 		self._addTests()
+		self.tests = tuple(self.tests)
+	
+	def compilePatterns(self):
+		"""Compile regexes of all rules and exclusions now instead of on
+		first use, to validate them.
+		
+		@throws regex.error: if a pattern is invalid
+		"""
+		for rule in self.rules:
+			rule.fromRe
+		for exclusion in self.exclusions:
+			exclusion.exclusionRe
+	
+	def describe(self):
+		"""Return picklable description of this ruleset made of plain
+		strings, tuples and lists, which fromDescription() turns back into
+		a Ruleset without XPath queries or regex compilation.
+		"""
+		return (self.name, self.platform, self.defaultOff, self.filename,
+			tuple(self.targets),
+			[(rule.fromPattern, rule.toPattern) for rule in self.rules],
+			[exclusion.exclusionPattern for exclusion in self.exclusions],
+			[test.url for test in self.tests])
+	
+	@staticmethod
+	def fromDescription(description):
+		"""Rebuild ruleset from describe() output. Regexes of the rules
+		and exclusions are compiled lazily on first use.
+		"""
+		(name, platform, defaultOff, filename, targets, rules, exclusions,
+			testUrls) = description
+		ruleset = Ruleset.__new__(Ruleset)
+		ruleset.name = name
+		ruleset.platform = internString(platform)
+		ruleset.defaultOff = defaultOff and internString(defaultOff)
+		ruleset.filename = filename
+		ruleset.contents = None
+		ruleset._matcher = None
+		ruleset._prefixes = None
+		ruleset.targets = tuple(intern(target) for target in targets)
+		ruleset.rules = tuple(Rule.fromPatterns(fromPattern, toPattern)
+			for (fromPattern, toPattern) in rules)
+		ruleset.exclusions = tuple(Exclusion.fromPattern(pattern) for pattern in exclusions)
+		#tests for targets were already added by the described ruleset
+		ruleset.tests = tuple(Test(url) for url in testUrls)
+		return ruleset
+	
+	def combinedMatcher(self):
+		"""Return CombinedMatcher with exclusion patterns followed by rule
+		patterns, None if it's turned off or the patterns can't be combined.
+		
+		Whether a rule with a broken replacement raises an exception in
+		apply() depends on the URL even if the rule doesn't match, so with
+		such a rule the patterns are not combined either.
+		"""
+		matcher = self._matcher
+		if matcher is None:
+			matcher = False
+			if self.useCombinedMatcher and len(self.exclusions) + len(self.rules) > 1:
+				patterns = [exclusion.exclusionPattern for exclusion in self.exclusions] + \
+					[rule.fromPattern for rule in self.rules]
+				try:
+					for rule in self.rules:
+						#every group participates in this match
+						groups = regex.match("()" * rule.fromRe.groups, "")
+						groups.expand(rule.toPattern)
+					matcher = CombinedMatcher(patterns)
+				except Exception:
+					pass
+			self._matcher = matcher
+		return matcher or None
+	
+	@property
+	def prefixes(self):
+		"""Literal prefixes of all exclusion and rule patterns, URLs
+		starting with none of them are neither excluded nor rewritten.
+		"""
+		if self._prefixes is None:
+			prefixes = set()
+			for applies in self.exclusions + self.rules:
+				prefixes.update(applies.prefixes)
+			if "" in prefixes:
+				prefixes = ("",)
+			self._prefixes = tuple(prefixes)
+		return self._prefixes
 	
 	def excludes(self, url):
 		"""Returns True iff one of exclusion patterns matches the url."""
+		if not url.startswith(self.prefixes):
+			return False
+		matcher = self.combinedMatcher()
+		if matcher:
+			index = matcher.firstMatch(url)
+			return index is not None and index < len(self.exclusions)
 		return any((exclusion.matches(url) for exclusion in self.exclusions))
 	
 	def apply(self, url):
@@ -140,10 +574,21 @@ class Ruleset(object):
 		
 		@param url: string URL
 		"""
-		if self.excludes(url):
+		if not url.startswith(self.prefixes):
 			return url
 		
-		for rule in self.rules:
+		rules = self.rules
+		matcher = self.combinedMatcher()
+		if matcher:
+			index = matcher.firstMatch(url)
+			if index is None or index < len(self.exclusions):
+				return url
+			#rules before the first matching one would not rewrite
+			rules = rules[index - len(self.exclusions):]
+		elif self.excludes(url):
+			return url
+		
+		for rule in rules:
 			try:
 				newUrl = rule.apply(url)
 				if url != newUrl:
@@ -176,7 +621,7 @@ class Ruleset(object):
 		for test in self.tests:
 			applies = self.whatApplies(test.url)
 			if applies:
-				applies.tests.append(test)
+				applies.tests += (test,)
 			else:
 				problems.append("%s: No rule or exclusion applies to test URL %s" % (
 					self.filename, test.url))
@@ -207,6 +652,16 @@ class Ruleset(object):
 		return problems
 
 	def whatApplies(self, url):
+		if not url.startswith(self.prefixes):
+			return None
+		matcher = self.combinedMatcher()
+		if matcher:
+			index = matcher.firstMatch(url)
+			if index is None:
+				return None
+			if index < len(self.exclusions):
+				return self.exclusions[index]
+			return self.rules[index - len(self.exclusions)]
 		for exclusion in self.exclusions:
 			if exclusion.matches(url):
 				return exclusion
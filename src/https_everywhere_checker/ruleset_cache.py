@@ -0,0 +1,143 @@
+import cPickle
+import errno
+import logging
+import os
+import tempfile
+import threading
+
+## Parsed ruleset cache
+#
+# Parsing XML and validating the regexes of 20k rulesets takes much longer
+# than any coverage-only run needs to. RulesetCache keeps the outcome of
+# parsing each file - Ruleset.describe() output or the parse error, coverage
+# problems and regex preflight results - in one pickle file, keyed by the
+# SHA-256 of the file contents (the same digest the skiplist uses) and its
+# name, which appears in reported problems. Unchanged files are then rebuilt
+# from the description without touching lxml or compiling regexes.
+#
+# All entries are written back except older versions of files looked up in
+# the run, so runs over a subset of the files (e.g. rule files given on the
+# command line) keep the cache of the others and entries of edited files
+# don't accumulate. The cache is dropped whenever FORMAT is bumped, which
+# must happen when parsing, coverage checks or the preflight change.
+
+class ParsedRuleset(object):
+	"""Outcome of parsing one ruleset file. It doesn't depend on options
+	selecting which rulesets are used, so it can be cached.
+	"""
+
+	def __init__(self, filename, digest, description=None, error=None, problems=None,
+			regexRisks=None, regexBudget=0):
+		"""
+		@param filename: ruleset file name
+		@param digest: binary SHA-256 of file contents
+		@param description: Ruleset.describe() output, None on error
+		@param error: message of exception raised while parsing
+		@param problems: list of coverage problems, None if coverage was
+		not checked
+		@param regexRisks: regex_preflight.checkRuleset() output, None if
+		the preflight didn't run
+		@param regexBudget: time budget of the preflight probes, 0 if the
+		preflight didn't run
+		"""
+		self.filename = filename
+		self.digest = digest
+		self.description = description
+		self.error = error
+		self.problems = problems
+		self.regexRisks = regexRisks
+		self.regexBudget = regexBudget
+
+class RulesetCache(object):
+	"""Single-file cache of ParsedRuleset objects."""
+
+	FORMAT = 3
+
+	def __init__(self, path):
+		"""
+		@param path: cache file, created on save() if it does not exist
+		"""
+		self.path = path
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.entries = {}
+		#file name -> digest of files looked up or stored in this run,
+		#entries of these files with other digests are not saved
+		self.current = {}
+		self._load()
+
+	@staticmethod
+	def fromConfig(config):
+		"""Create cache from [rulesets] section of config, None if the
+		section has no cache_file set.
+
+		@param config: ConfigParser object
+		"""
+		if not config.has_option("rulesets", "cache_file"):
+			return None
+		return RulesetCache(config.get("rulesets", "cache_file"))
+
+	def _load(self):
+		try:
+			with open(self.path, "rb") as f:
+				(version, entries) = cPickle.load(f)
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				logging.warn("Could not read ruleset cache: %s", e)
+			return
+		except Exception, e:
+			logging.warn("Ruleset cache is corrupt, starting empty: %s", e)
+			return
+		if version != self.FORMAT:
+			logging.info("Ruleset cache has old format %s, starting empty", version)
+			return
+		self.entries = entries
+
+	def lookup(self, filename, digest, needProblems, regexBudget=0):
+		"""Return cached parse result of file.
+
+		@param needProblems: entries without coverage problems are misses
+		@param regexBudget: entries whose regex preflight ran with another
+		time budget (or didn't run) are misses
+		@returns: ParsedRuleset or None on miss
+		"""
+		key = (digest, filename)
+		with self.lock:
+			self.current[filename] = digest
+			parsed = self.entries.get(key)
+			if parsed is None or (parsed.error is None and (
+					(needProblems and parsed.problems is None) or
+					parsed.regexBudget != regexBudget)):
+				self.misses += 1
+				return None
+			self.hits += 1
+			return parsed
+
+	def store(self, parsed):
+		"""Remember parse result, it's written by save()."""
+		key = (parsed.digest, parsed.filename)
+		with self.lock:
+			self.entries[key] = parsed
+			self.current[parsed.filename] = parsed.digest
+
+	def save(self):
+		"""Write entries to the cache file, leaving out those of files
+		that were looked up in this run with different contents.
+		"""
+		with self.lock:
+			entries = dict(((digest, filename), parsed)
+				for ((digest, filename), parsed) in self.entries.iteritems()
+				if self.current.get(filename, digest) == digest)
+			dirname = os.path.dirname(os.path.abspath(self.path))
+			try:
+				(fd, tmpPath) = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+				with os.fdopen(fd, "wb") as f:
+					cPickle.dump((self.FORMAT, entries), f, cPickle.HIGHEST_PROTOCOL)
+				os.rename(tmpPath, self.path)
+			except (IOError, OSError), e:
+				logging.error("Could not write ruleset cache: %s", e)
+
+	def statsString(self):
+		"""Return one-line summary for logging."""
+		return "%d files loaded from cache, %d parsed" % (self.hits, self.misses)
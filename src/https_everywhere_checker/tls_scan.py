@@ -0,0 +1,222 @@
+import collections
+import logging
+import time
+
+import pycurl
+
+import chain_verify
+from http_client import HTTPFetcher
+
+## Handshake-only TLS scan
+#
+# Answers just "does https://target/ present a chain that validates against
+# the ruleset's platform CA set" for every non-wildcard target, without
+# fetching and comparing pages. Every target gets one curl handle with
+# CONNECT_ONLY, so curl stops right after the TCP connect and verified TLS
+# handshake. All handles are driven by one pycurl.CurlMulti in the calling
+# thread, which keeps thousands of handshakes in flight.
+#
+# With offline_verify, curl doesn't verify at all. It captures the presented
+# chain (CERTINFO) and chain_verify.ChainVerifier checks it against every
+# platform, so one handshake gives the result for all CA sets.
+
+#curl error codes -> outcome category in the summary
+OUTCOMES = {
+	0: "ok",
+	pycurl.E_COULDNT_RESOLVE_HOST: "dns",
+	pycurl.E_COULDNT_CONNECT: "connect",
+	pycurl.E_OPERATION_TIMEOUTED: "timeout",
+	pycurl.E_SSL_CONNECT_ERROR: "tls",
+	pycurl.E_SSL_PEER_CERTIFICATE: "certificate",
+	pycurl.E_SSL_CACERT: "certificate",
+}
+
+class HandshakeJob(object):
+	"""One target to verify."""
+
+	def __init__(self, host, platform, ruleset):
+		"""
+		@param host: target host name from ruleset
+		@param platform: platform name selecting the CA set
+		@param ruleset: Ruleset the target belongs to, for reporting
+		"""
+		self.host = host
+		self.platform = platform
+		self.ruleset = ruleset
+		self.url = "https://%s/" % host
+		self.errorCode = None
+		self.error = None
+		#platform name -> None or verification error, offline_verify only
+		self.platformErrors = None
+
+	def outcome(self):
+		"""Category of the result, see OUTCOMES."""
+		return OUTCOMES.get(self.errorCode, "other")
+
+class TLSScanner(object):
+	"""Performs verified TLS handshakes with many hosts concurrently."""
+
+	def __init__(self, fetcher, maxHandshakes, verifier=None):
+		"""
+		@param fetcher: HTTPFetcher whose options, certificate platforms
+		and DNS cache are used
+		@param maxHandshakes: max number of handshakes in flight
+		@param verifier: chain_verify.ChainVerifier to verify captured
+		chains against all platforms, None to let curl verify against
+		the ruleset's platform
+		"""
+		self.fetcher = fetcher
+		self.options = fetcher.options
+		self.maxHandshakes = maxHandshakes
+		self.verifier = verifier
+
+	def platformPath(self, job):
+		"""CA path that decides the job's outcome."""
+		return self.options.staticCAPath or \
+			self.fetcher.certPlatforms.getCAPath(job.platform)
+
+	def _start(self, multi, job):
+		"""Add handle for job to multi, returns False if the job finished
+		without a handshake.
+		"""
+		try:
+			url = self.fetcher.idnEncodedUrl(job.url)
+			resolve = self.fetcher.curlResolve(url)
+		except Exception, e:
+			job.errorCode = pycurl.E_COULDNT_RESOLVE_HOST
+			job.error = str(e)
+			return False
+
+		c = pycurl.Curl()
+		HTTPFetcher.configureCurl(c, url, self.options, self.platformPath(job),
+			lambda data: None, lambda data: None, resolve)
+		c.setopt(pycurl.CONNECT_ONLY, 1)
+		if self.verifier:
+			c.setopt(pycurl.SSL_VERIFYPEER, 0)
+			c.setopt(pycurl.SSL_VERIFYHOST, 0)
+			c.setopt(pycurl.OPT_CERTINFO, 1)
+		c.job = job
+		multi.add_handle(c)
+		return True
+
+	def _done(self, multi, c, errno=0, errmsg=None):
+		job = c.job
+		multi.remove_handle(c)
+		job.errorCode = errno
+		job.error = errmsg
+		if self.verifier and not errno:
+			self._verifyOffline(job, chain_verify.certInfoChain(c.getinfo(pycurl.INFO_CERTINFO)))
+		c.job = None
+		c.close()
+
+	def _verifyOffline(self, job, pems):
+		"""Verify captured chain against all platforms, the outcome is
+		decided by the job's own platform.
+		"""
+		if self.options.staticCAPath:
+			platformPaths = {"static": self.options.staticCAPath}
+		else:
+			platformPaths = None
+		job.platformErrors = self.verifier.verifyAll(job.host, pems, platformPaths)
+		error = self.verifier.verify(job.host, pems, self.platformPath(job))
+		if error:
+			job.errorCode = pycurl.E_SSL_CACERT
+			job.error = error
+
+	def scan(self, jobs):
+		"""Verify TLS handshake of all jobs, sets their errorCode and
+		error attributes.
+
+		@param jobs: list of HandshakeJob instances
+		@returns: collections.Counter of outcome categories
+		"""
+		multi = pycurl.CurlMulti()
+		waiting = collections.deque(jobs)
+		active = 0
+
+		while waiting or active:
+			while waiting and active < self.maxHandshakes:
+				if self._start(multi, waiting.popleft()):
+					active += 1
+
+			while True:
+				ret, numHandles = multi.perform()
+				if ret != pycurl.E_CALL_MULTI_PERFORM:
+					break
+
+			while True:
+				numQueued, okList, errList = multi.info_read()
+				for c in okList:
+					self._done(multi, c)
+					active -= 1
+				for c, errno, errmsg in errList:
+					self._done(multi, c, errno, errmsg)
+					active -= 1
+				if numQueued == 0:
+					break
+
+			if active:
+				multi.select(0.05)
+
+		multi.close()
+		return collections.Counter(job.outcome() for job in jobs)
+
+def targetJobs(rulesets):
+	"""Return HandshakeJob for every non-wildcard target of rulesets."""
+	jobs = []
+	for ruleset in rulesets:
+		for target in ruleset.targets:
+			if "*" not in target:
+				jobs.append(HandshakeJob(target, ruleset.platform, ruleset))
+	return jobs
+
+def scanTargets(fetcher, rulesets, resQueue=None):
+	"""Run handshake-only scan of all targets, log failures and summary.
+
+	@param fetcher: HTTPFetcher providing options and CA platforms
+	@param rulesets: list of Ruleset instances
+	@param resQueue: if not None, results are put there in the same
+	format as comparison results for json output
+	@returns: list of HandshakeJob instances with results
+	"""
+	verifier = None
+	if fetcher.options.offlineVerify:
+		if chain_verify.available():
+			verifier = chain_verify.ChainVerifier(fetcher.certPlatforms)
+		else:
+			logging.warn("offline_verify needs pyOpenSSL, verifying in curl against one platform")
+
+	jobs = targetJobs(rulesets)
+	startTime = time.time()
+	scanner = TLSScanner(fetcher, fetcher.options.maxTransfers, verifier)
+	counts = scanner.scan(jobs)
+
+	validCounts = collections.Counter()
+	platforms = set()
+	for job in jobs:
+		if job.errorCode:
+			logging.error("%s: TLS handshake with %s failed (%s): %s",
+				job.ruleset.filename, job.host, job.outcome(), job.error)
+		if job.platformErrors is not None:
+			platforms.update(job.platformErrors)
+			validCounts.update(platform for (platform, error) in job.platformErrors.items()
+				if error is None)
+		if resQueue is not None:
+			res = {"result": "error" if job.errorCode else "success",
+				"details": job.error or "", "fname": job.ruleset.filename,
+				"url": job.url}
+			if job.platformErrors is not None:
+				res["platforms"] = dict((platform, error or "ok")
+					for (platform, error) in job.platformErrors.items())
+			resQueue.put(res)
+
+	logging.info("TLS handshakes with %d targets in %.2f seconds: %s.",
+		len(jobs), time.time() - startTime,
+		", ".join("%d %s" % (count, outcome) for (outcome, count) in counts.most_common()))
+	if verifier:
+		captured = sum(1 for job in jobs if job.platformErrors is not None)
+		logging.info("Chains valid per platform (of %d captured): %s.", captured,
+			", ".join("%s %d" % (platform, validCounts[platform])
+				for platform in sorted(platforms)))
+		logging.info("Offline verification: %s.", verifier.statsString())
+	return jobs
@@ -0,0 +1,119 @@
+import socket
+import struct
+import threading
+
+from https_everywhere_checker import dns_cache
+from https_everywhere_checker.check_rules import collectHosts
+
+#answer of StubNameserver: NXDOMAIN with SOA record cut short
+TRUNCATED_SOA = "truncated SOA"
+
+class StubNameserver(threading.Thread):
+	"""UDP DNS server on localhost answering A queries from a dict of
+	host -> IPv4 address, None for NXDOMAIN or TRUNCATED_SOA. Other hosts
+	get no answer.
+	"""
+
+	def __init__(self, answers):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self.answers = answers
+		self.queries = []
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(("127.0.0.1", 0))
+		self.address = self.sock.getsockname()
+
+	def run(self):
+		while True:
+			try:
+				(message, sender) = self.sock.recvfrom(512)
+			except socket.error:
+				return
+			#a query parses like an answer without records
+			(queryId, qname, _, _, _) = dns_cache.decodeResponse(message)
+			self.queries.append(qname)
+			if qname not in self.answers:
+				continue
+			question = message[12:]
+			address = self.answers[qname]
+			if address in (None, TRUNCATED_SOA):
+				soa = "\0\0" + struct.pack("!IIIII", 1, 3600, 600, 86400, 30)
+				if address == TRUNCATED_SOA:
+					soa = soa[:10]
+				reply = struct.pack("!HHHHHH", queryId, 0x8183, 1, 0, 1, 0) + question + \
+					"\xc0\x0c" + struct.pack("!HHIH", dns_cache.DNS_TYPE_SOA, 1, 300, len(soa)) + soa
+			else:
+				reply = struct.pack("!HHHHHH", queryId, 0x8180, 1, 1, 0, 0) + question + \
+					"\xc0\x0c" + struct.pack("!HHIH", dns_cache.DNS_TYPE_A, 1, 120, 4) + \
+					socket.inet_aton(address)
+			self.sock.sendto(reply, sender)
+
+	def close(self):
+		self.sock.close()
+
+def resolve(answers, hosts):
+	"""Resolve hosts against a StubNameserver with answers.
+
+	@returns: tuple (counts, DNSCache, list of names queried)
+	"""
+	stub = StubNameserver(answers)
+	stub.start()
+	try:
+		resolver = dns_cache.BulkResolver(stub.address, timeout=0.2, retries=1)
+		cache = dns_cache.DNSCache()
+		counts = resolver.resolveInto(cache, hosts)
+	finally:
+		stub.close()
+	return (counts, cache, stub.queries)
+
+def test_encode_query_round_trip():
+	(queryId, qname, rcode, addresses, ttl) = dns_cache.decodeResponse(
+		dns_cache.encodeQuery(0x1234, "www.Example.com."))
+	assert (queryId, qname, rcode, addresses) == (0x1234, "www.example.com", 0, [])
+
+def test_bulk_resolver_answers():
+	answers = {"ok.example": "192.0.2.1", "dead.example": None}
+	(counts, cache, queries) = resolve(answers, ["ok.example", "DEAD.example", "silent.example"])
+
+	assert counts == {"ok": 1, "nxdomain": 1, "failed": 1}
+	assert cache.lookup("ok.example").addresses == ["192.0.2.1"]
+	assert cache.lookup("dead.example").isNegative()
+	assert cache.lookup("silent.example") is None
+	#unanswered query was sent again once
+	assert queries.count("silent.example") == 2
+
+def test_truncated_soa_ignored():
+	answers = {"ok.example": "192.0.2.1", "broken.example": TRUNCATED_SOA}
+	(counts, cache, queries) = resolve(answers, ["ok.example", "broken.example"])
+
+	#malformed answers are dropped, the query times out
+	assert counts == {"ok": 1, "failed": 1}
+	assert cache.lookup("broken.example") is None
+	assert queries.count("broken.example") == 2
+
+def test_decode_truncated_messages():
+	soa = "\0\0" + struct.pack("!IIIII", 1, 3600, 600, 86400, 30)
+	message = struct.pack("!HHHHHH", 1, 0x8183, 1, 0, 1, 0) + \
+		dns_cache.encodeQuery(1, "dead.example")[12:] + \
+		"\xc0\x0c" + struct.pack("!HHIH", dns_cache.DNS_TYPE_SOA, 1, 300, len(soa)) + soa
+	assert dns_cache.decodeResponse(message)[1:] == ("dead.example", 3, [], 30)
+	for length in range(len(message)):
+		try:
+			dns_cache.decodeResponse(message[:length])
+		except dns_cache.DNSError:
+			continue
+		assert False, length
+
+def test_collect_hosts_idna():
+	hosts = collectHosts([], [u"http://B\xfccher.example/", "http://caf\xc3\xa9.example/x",
+		"http://plain.example/", "http://127.0.0.1/", "http://a..b/"])
+	assert hosts == set(["xn--bcher-kva.example", "xn--caf-dma.example", "plain.example"])
+
+def test_bulk_resolver_idn_host():
+	answers = {"xn--bcher-kva.example": "192.0.2.2"}
+	hosts = collectHosts([], [u"http://b\xfccher.example/"])
+	(counts, cache, queries) = resolve(answers, hosts)
+
+	assert counts == {"ok": 1}
+	#fetches look up the punycode-escaped name
+	assert cache.lookup("xn--bcher-kva.example").addresses == ["192.0.2.2"]
@@ -0,0 +1,41 @@
+import ConfigParser
+
+from https_everywhere_checker.http_client import FetchOptions, FetcherOutArgs
+from https_everywhere_checker.response_cache import ResponseCache
+
+def fetchOptions():
+	config = ConfigParser.RawConfigParser()
+	config.add_section("http")
+	for (option, value) in [("connect_timeout", "10"), ("read_timeout", "10"),
+			("redirect_depth", "10"), ("threads", "1")]:
+		config.set("http", option, value)
+	return FetchOptions(config)
+
+def test_store_and_reopen(tmpdir):
+	options = fetchOptions()
+	cache = ResponseCache(str(tmpdir))
+	cache.store("http://example.com/", "certs", options,
+		FetcherOutArgs(200, "body", "HTTP/1.1 200 OK\r\n"))
+	cache.close()
+
+	fetched = ResponseCache(str(tmpdir)).lookup("http://example.com/", "certs", options)
+	assert (fetched.httpCode, fetched.data) == (200, "body")
+
+def test_server_errors_not_stored(tmpdir):
+	options = fetchOptions()
+	cache = ResponseCache(str(tmpdir))
+	cache.store("http://example.com/", "certs", options,
+		FetcherOutArgs(503, "down", "HTTP/1.1 503 Service Unavailable\r\n"))
+	cache.store("http://example.com/gone", "certs", options,
+		FetcherOutArgs(404, "gone", "HTTP/1.1 404 Not Found\r\n"))
+
+	assert cache.lookup("http://example.com/", "certs", options) is None
+	assert cache.lookup("http://example.com/gone", "certs", options).httpCode == 404
+
+def test_cookie_responses_not_stored(tmpdir):
+	options = fetchOptions()
+	cache = ResponseCache(str(tmpdir))
+	cache.store("http://example.com/", "certs", options,
+		FetcherOutArgs(302, "", "HTTP/1.1 302 Found\r\nSet-Cookie: a=b\r\n"))
+
+	assert cache.lookup("http://example.com/", "certs", options) is None
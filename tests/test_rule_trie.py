@@ -0,0 +1,102 @@
+from https_everywhere_checker.rule_trie import LRUCache, RuleTrie
+from https_everywhere_checker.rules import Ruleset
+
+def makeRuleset(name, targets, rules=()):
+	"""Ruleset with given targets and (from, to) rules."""
+	return Ruleset.fromDescription((name, "default", None, name + ".xml",
+		[unicode(target).encode("idna") for target in targets], list(rules), [], []))
+
+targets = {
+	"Exact": ["example.com", "www.example.com"],
+	"Wildcard": ["*.example.com"],
+	"Deep": ["*.cdn.example.net"],
+	"Short": ["*.org"],
+	"Middle": ["www.*.com", "static.*.example.org"],
+	"Right": ["www.google.*"],
+	"Idn": [u"b\xfccher.example", u"*.b\xfccher.example"],
+	"Other": ["example.com"],
+}
+
+queries = [
+	"example.com", "www.example.com", "a.example.com", "a.b.example.com",
+	"x.y.z.example.com", "example.net", "cdn.example.net", "a.cdn.example.net",
+	"a.b.cdn.example.net", "org", "example.org", "a.example.org",
+	"www.foo.com", "www.foo.bar.com", "foo.com", "static.x.example.org",
+	"static.x.y.example.org", "www.google.com", "www.google.co", "google.com",
+	"example.com.", "www.example.com.", "a.example.com.", "",
+	u"b\xfccher.example", u"www.b\xfccher.example", "www.b\xc3\xbccher.example",
+	"xn--bcher-kva.example", "a.b.xn--bcher-kva.example", "miss.invalid",
+]
+
+def buildTrie(cacheSize=0):
+	trie = RuleTrie(cacheSize)
+	for name in sorted(targets):
+		trie.addRuleset(makeRuleset(name, targets[name]))
+	return trie
+
+def lookupResult(lookup, fqdn):
+	"""Names of rulesets found by lookup, type of exception if it raised."""
+	try:
+		return sorted(ruleset.name for ruleset in lookup(fqdn))
+	except Exception, e:
+		return type(e)
+
+def test_index_same_as_tree_walk():
+	trie = buildTrie()
+	derived = []
+	for names in targets.itervalues():
+		for target in names:
+			derived.append(target.replace("*", "x"))
+			derived.append("a.b." + target.replace("*", "x"))
+			derived.append(target.replace("*", "x.y"))
+	for fqdn in queries + derived:
+		assert lookupResult(trie.matchingRulesets, fqdn) == \
+			lookupResult(trie.root.matchingRulesets, fqdn), repr(fqdn)
+
+def test_index_results():
+	trie = buildTrie()
+	lookup = lambda fqdn: lookupResult(trie.matchingRulesets, fqdn)
+	assert lookup("example.com") == ["Exact", "Other"]
+	assert lookup("www.example.com") == ["Exact", "Middle", "Wildcard"]
+	#left-most wildcard at third level covers several labels
+	assert lookup("x.y.z.example.com") == ["Wildcard"]
+	assert lookup("a.b.cdn.example.net") == ["Deep"]
+	#second level wildcard covers one label only
+	assert lookup("example.org") == ["Short"]
+	assert lookup("a.example.org") == []
+	#wildcards in the middle and on the right cover one label
+	assert lookup("www.foo.com") == ["Middle"]
+	assert lookup("www.foo.bar.com") == []
+	assert lookup("static.x.example.org") == ["Middle"]
+	assert lookup("www.google.co") == ["Right"]
+	assert lookup(u"b\xfccher.example") == ["Idn"]
+	assert lookup("a.b.xn--bcher-kva.example") == ["Idn"]
+	assert lookup("example.com.") == []
+	assert lookup("") == []
+
+def test_caches_dropped_on_add_ruleset():
+	trie = RuleTrie(cacheSize=10)
+	trie.addRuleset(makeRuleset("Plain", ["example.com"]))
+	assert lookupResult(trie.matchingRulesets, "www.example.com") == []
+	assert trie.transformUrl("http://www.example.com/").ruleset is None
+
+	trie.addRuleset(makeRuleset("Www", ["www.example.com"],
+		[(r"^http://www\.example\.com/", "https://www.example.com/")]))
+	assert lookupResult(trie.matchingRulesets, "www.example.com") == ["Www"]
+	ruleMatch = trie.transformUrl("http://www.example.com/")
+	assert (ruleMatch.url, ruleMatch.ruleset.name) == ("https://www.example.com/", "Www")
+	#lookups after adding are cached again
+	assert trie.transformUrl("http://www.example.com/") is ruleMatch
+	#hits of transformUrl() on the host cache before and after adding,
+	#counters are kept when the caches are dropped
+	assert (trie.hostCache.hits, trie.urlCache.hits) == (2, 1)
+
+def test_lru_cache_evicts_least_recently_used():
+	cache = LRUCache(2)
+	cache.put("a", 1)
+	cache.put("b", 2)
+	assert cache.get("a") == 1
+	cache.put("c", 3)
+	assert cache.get("b") is None
+	assert (cache.get("a"), cache.get("c")) == (1, 3)
+	assert (cache.hits, cache.misses) == (3, 1)
@@ -0,0 +1,228 @@
+import uuid
+
+import regex
+from lxml import etree
+
+from https_everywhere_checker.check_rules import RulesetLoader
+from https_everywhere_checker.rules import CombinedMatcher, PatternTable, Ruleset, \
+	compiledPatterns, literalPrefixes
+
+def parseRulesets(xml):
+	"""Return tuple (ruleset using CombinedMatcher, same ruleset scanning
+	patterns one by one).
+	"""
+	combined = Ruleset(etree.fromstring(xml), "test.xml")
+	linear = Ruleset(etree.fromstring(xml), "test.xml")
+	linear._matcher = False
+	return (combined, linear)
+
+def outcome(func, url):
+	"""Result of func(url), type of exception if it raised."""
+	try:
+		return func(url)
+	except Exception, e:
+		return type(e)
+
+def applies(ruleset, url):
+	"""whatApplies() as ("exclusion" or "rule", index) or None."""
+	found = ruleset.whatApplies(url)
+	if found is None:
+		return None
+	for (kind, items) in [("exclusion", ruleset.exclusions), ("rule", ruleset.rules)]:
+		for (index, item) in enumerate(items):
+			if item is found:
+				return (kind, index)
+
+def assertSameResults(combined, linear, urls):
+	for url in urls:
+		assert combined.excludes(url) == linear.excludes(url), url
+		assert outcome(combined.apply, url) == outcome(linear.apply, url), url
+		assert outcome(lambda url: applies(combined, url), url) == \
+			outcome(lambda url: applies(linear, url), url), url
+
+mixedXml = r"""
+<ruleset name="Mixed">
+	<target host="example.com" />
+	<target host="*.example.com" />
+	<exclusion pattern="^http://example\.com/nossl" />
+	<exclusion pattern="\.pdf$" />
+	<rule from="^http://(www\.)?example\.com/" to="https://www.example.com/" />
+	<rule from="^http://(foo|bar)\.example\.com/|^http://baz\.example\.com/"
+		to="https://secure.example.com/" />
+	<rule from="^http://id\.example\.com/" to="http://id.example.com/" />
+	<rule from="^http://id\.example\.com/" to="https://id.example.com/" />
+	<rule from="cdn\.example\.com/(\w+)" to="cdn-ssl.example.com/$1" />
+	<rule from="^http://cdn\.example\.com/" to="https://cdn2.example.com/" />
+</ruleset>
+"""
+
+mixedUrls = [
+	"http://example.com/",
+	"http://www.example.com/page",
+	"http://example.com/nossl/page",
+	"http://example.com/nossl.pdf",
+	"http://www.example.com/doc.pdf",
+	"http://foo.example.com/",
+	"http://bar.example.com/x",
+	"http://baz.example.com/",
+	"http://qux.example.com/",
+	"http://id.example.com/",
+	"http://cdn.example.com/lib",
+	"http://cdn.example.com/",
+	"https://cdn.example.com/lib",
+	"http://other.org/?u=http://example.com/",
+	"",
+]
+
+def test_combined_matcher_is_used():
+	(combined, linear) = parseRulesets(mixedXml)
+	assert combined.combinedMatcher() is not None
+	assert linear.combinedMatcher() is None
+
+def test_combined_same_as_linear():
+	(combined, linear) = parseRulesets(mixedXml)
+	assertSameResults(combined, linear, mixedUrls)
+
+def test_combined_rule_order_and_identity_rewrites():
+	(combined, linear) = parseRulesets(mixedXml)
+	#first of two matching rules wins
+	assert combined.apply("http://cdn.example.com/lib") == "http://cdn-ssl.example.com/lib"
+	assert applies(combined, "http://cdn.example.com/lib") == ("rule", 4)
+	#rule that doesn't change the URL passes it on to later ones
+	assert applies(combined, "http://id.example.com/") == ("rule", 2)
+	assert combined.apply("http://id.example.com/") == "https://id.example.com/"
+	#exclusion listed first wins over the rule matching the same URL
+	assert combined.apply("http://example.com/nossl") == "http://example.com/nossl"
+	assert applies(combined, "http://example.com/nossl") == ("exclusion", 0)
+	#unanchored exclusion
+	assert combined.excludes("http://www.example.com/doc.pdf")
+
+def test_broken_replacement_not_combined():
+	xml = r"""
+	<ruleset name="Broken">
+		<target host="*.example.com" />
+		<rule from="^http://a\.example\.com/(\w+)" to="https://a.example.com/$1" />
+		<rule from="^http://b\.example\.com/" to="https://b.example.com/$2" />
+		<rule from="^http://c\.example\.com/" to="https://c.example.com/" />
+	</ruleset>
+	"""
+	(combined, linear) = parseRulesets(xml)
+	assert combined.combinedMatcher() is None
+	assertSameResults(combined, linear, ["http://a.example.com/x",
+		"http://b.example.com/", "http://c.example.com/", "http://d.example.com/"])
+	assert outcome(combined.apply, "http://b.example.com/") is Exception
+
+def test_combined_matcher_first_match():
+	matcher = CombinedMatcher([r"^http://a\.", r"b\.com", r"^http://(a|b)\."])
+	assert matcher.firstMatch("http://a.b.com/") == 0
+	assert matcher.firstMatch("http://x.b.com/") == 1
+	assert matcher.firstMatch("http://b.org/") == 2
+	assert matcher.firstMatch("http://c.org/") is None
+
+def test_combined_matcher_rejects_backreferences():
+	for pattern in [r"^http://(a)\1", r"^(?P<x>a)", r"(?i)^http://a"]:
+		try:
+			CombinedMatcher([pattern, "^b"])
+		except ValueError:
+			continue
+		assert False, pattern
+
+def assertPrefixes(pattern, expected, matching=()):
+	"""Check literalPrefixes() of pattern and that strings matching it
+	start with one of them.
+	"""
+	prefixes = literalPrefixes(pattern)
+	assert sorted(prefixes) == sorted(expected), pattern
+	for s in matching:
+		assert regex.search(pattern, s), s
+		assert s.startswith(prefixes), s
+
+def test_prefixes_optional_group():
+	assertPrefixes(r"^http://(www\.)?example\.com/",
+		["http://example.com/", "http://www.example.com/"],
+		["http://example.com/", "http://www.example.com/x"])
+
+def test_prefixes_alternatives():
+	assertPrefixes(r"^http://(?:a|b)\.example\.com/",
+		["http://a.example.com/", "http://b.example.com/"],
+		["http://a.example.com/", "http://b.example.com/"])
+	#literal after a quantified character ends the prefix
+	assertPrefixes(r"^https?://(?:a|b)\.", ["http"], ["https://a.", "http://b."])
+
+def test_prefixes_quantified_groups():
+	assertPrefixes(r"^http://(a|b)+\.x/", ["http://"], ["http://abba.x/"])
+	assertPrefixes(r"^http://(www\.)*x\.com", ["http://"], ["http://x.com"])
+	assertPrefixes(r"^http://x{2}", ["http://"], ["http://xx"])
+	assertPrefixes(r"^http://x[ab]", ["http://x"], ["http://xa"])
+
+def test_prefixes_escapes():
+	assertPrefixes(r"^http://a\.b\+c\?d/", ["http://a.b+c?d/"], ["http://a.b+c?d/"])
+	#escaped letters are classes, not literals
+	assertPrefixes(r"^http://a\w", ["http://a"], ["http://ab"])
+
+def test_prefixes_anything():
+	for pattern in [r"(?i)^http://example\.com/", r"^http://(?i:a)b", r"example\.com/",
+			r"^http://a\.com/|^http://b\.com/"]:
+		assertPrefixes(pattern, [""])
+	assertPrefixes(r"(?i)^http://example\.com/", [""], ["HTTP://EXAMPLE.COM/"])
+
+def test_prefixes_cap():
+	assertPrefixes(r"^http://(a|b)(c|d)(e|f)(g|h)\.com/",
+		["http://%s%s%s%s.com/" % (a, b, c, d) for a in "ab" for b in "cd"
+			for c in "ef" for d in "gh"])
+	#a group that would make more than 16 prefixes ends them
+	prefixes = literalPrefixes(r"^http://(a|b)(c|d)(e|f)(g|h)(i|j)\.com/")
+	assert len(prefixes) == 16
+	assert "http://bdfh" in prefixes
+	assertPrefixes(r"^http://(a|b|c|d|e|f|g|h|i|j|k|l|m|n|o|p|q)/", ["http://"],
+		["http://q/"])
+
+def test_prefixes_non_ascii():
+	assertPrefixes(u"^http://b\xfccher\\.example/", [""])
+	assertPrefixes(u"^http://\xfc(a|b)", [""])
+	assertPrefixes(u"^http://a\\.example/\xfc", [""])
+	#prefixes are str, so non-ASCII str URLs are not decoded
+	assert not "http://b\xc3\xbccher.example/".startswith(literalPrefixes(u"^http://a\\."))
+
+def test_pattern_table_counters():
+	table = PatternTable()
+	before = table.counters()
+	table.get(r"^http://a\.")
+	table.get(r"^http://a\.")
+	table.get(r"^http://b\.")
+	(compiles, compileTime, shared) = table.countersSince(before)
+	assert (compiles, shared) == (2, 1)
+
+	parent = PatternTable()
+	parent.get(r"^http://a\.")
+	parent.addWorkerCounters((compiles, compileTime, shared))
+	assert (parent.compiles, parent.shared, parent.workerCompiles) == (3, 1, 2)
+	assert parent.statsString().endswith("(2 compiled in worker processes)")
+
+def test_pattern_counters_from_worker_processes(tmpdir):
+	#patterns no process has compiled yet
+	tag = uuid.uuid4().hex
+	fnames = []
+	for name in ("a", "b"):
+		host = "%s-%s" % (name, tag)
+		xml = """<ruleset name="%s">
+			<target host="%s.example.com" />
+			<exclusion pattern="^http://%s\\.example\\.com/x" />
+			<rule from="^http://%s\\.example\\.com/" to="https://%s.example.com/" />
+		</ruleset>""" % (name, host, host, host, host)
+		path = tmpdir.join("%s.xml" % name)
+		path.write(xml)
+		fnames.append(str(path))
+
+	before = compiledPatterns.counters()
+	workersBefore = compiledPatterns.workerCompiles
+	loader = RulesetLoader(True, False, processes=2)
+	try:
+		rulesets = loader.loadMany(fnames)
+	finally:
+		loader.close()
+
+	assert len(rulesets) == 2
+	#rulesets rebuilt in this process compile nothing until used
+	assert compiledPatterns.countersSince(before)[0] == 4
+	assert compiledPatterns.workerCompiles - workersBefore == 4
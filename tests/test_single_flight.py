@@ -0,0 +1,54 @@
+import pycurl
+
+from https_everywhere_checker.http_client import FetcherOutArgs, SingleFlight
+
+def failingFetch():
+	raise pycurl.error(28, "Operation timed out")
+
+def test_success_shared_within_window():
+	flights = SingleFlight(60)
+	calls = []
+
+	def fetch():
+		calls.append(1)
+		return FetcherOutArgs(200, "body", "HTTP/1.1 200 OK\r\n")
+
+	first = flights.fetch("http://example.com/", "certs", fetch)
+	second = flights.fetch("http://example.com/", "certs", fetch)
+	assert second is first
+	assert len(calls) == 1
+	assert (flights.fetches, flights.saved) == (1, 1)
+
+def test_failure_not_shared_after_finish():
+	flights = SingleFlight(60)
+	try:
+		flights.fetch("http://example.com/", "certs", failingFetch)
+	except pycurl.error:
+		pass
+	else:
+		assert False, "exception was not raised"
+
+	fetched = flights.fetch("http://example.com/", "certs",
+		lambda: FetcherOutArgs(200, "body", "HTTP/1.1 200 OK\r\n"))
+	assert fetched.httpCode == 200
+	assert (flights.fetches, flights.saved) == (2, 0)
+
+def test_failure_reported_to_waiters():
+	flights = SingleFlight(60)
+	(flight, leader) = flights.claim("http://example.com/", "certs")
+	(joined, joinedLeader) = flights.claim("http://example.com/", "certs")
+	assert leader and not joinedLeader and joined is flight
+
+	outcomes = []
+	flights.addWaiter(joined, lambda flight: outcomes.append(flight.excInfo[1]))
+	error = pycurl.error(7, "Connection refused")
+	flights.finish(flight, excInfo=(pycurl.error, error, None))
+	assert outcomes == [error]
+	#the next request becomes a new leader
+	assert flights.claim("http://example.com/", "certs")[1]
+
+def test_cookie_responses_not_shared_after_finish():
+	flights = SingleFlight(60)
+	flights.fetch("http://example.com/", "certs",
+		lambda: FetcherOutArgs(302, "", "HTTP/1.1 302 Found\r\nSet-Cookie: a=b\r\n"))
+	assert flights.claim("http://example.com/", "certs")[1]